@@ -0,0 +1,168 @@
+"""Memoised topic classifications, so repeat topics don't go back to the LLM.
+
+Two tiers:
+    exact    normalised topic -> labels, LRU-bounded with a TTL
+    similar  if there is no exact hit, the cached topic whose title embedding
+             has the highest cosine similarity is reused when it clears
+             `similarity_threshold` ("Will the Lakers win the NBA
+             championship" vs "Will the Lakers win the NBA Championship?")
+
+The embeddings must be the full sentence embeddings (384 dims for
+all-MiniLM-L6-v2), not the ~10-dim PCA-reduced ones the volume model uses:
+in 10 dims unrelated titles routinely score above 0.95, so a near-duplicate
+test there reuses labels across different topics. Rows stored with a
+different dimension are kept for exact hits but never similarity-matched.
+
+Entries are written through to SQLite so they survive restarts; the most
+recent `capacity` non-expired rows are loaded at startup. The table is held
+to the same bound: expired rows and everything past the newest `capacity`
+are deleted at startup and every `prune_every` writes.
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_topic(topic):
+    return _WHITESPACE.sub(" ", str(topic)).strip().lower().rstrip("?!. ")
+
+
+class ClassificationCache:
+
+    def __init__(self, path=None, capacity=10000, ttl=30 * 24 * 3600, similarity_threshold=0.95, prune_every=100):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._writes = 0
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        # key -> (labels, stored_at, unit embedding or None)
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS classifications ("
+                " topic TEXT PRIMARY KEY,"
+                " labels TEXT NOT NULL,"
+                " embedding BLOB,"
+                " stored_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS classifications_stored_at ON classifications (stored_at)")
+            self._db.commit()
+            self.prune()
+            self._load()
+
+    def prune(self):
+        """Delete expired rows and all but the newest `capacity` from SQLite; returns how many went"""
+        if self._db is None:
+            return 0
+        deleted = self._db.execute(
+            "DELETE FROM classifications WHERE stored_at < ?", (time.time() - self.ttl,)).rowcount
+        deleted += self._db.execute(
+            "DELETE FROM classifications WHERE stored_at < ("
+            " SELECT stored_at FROM classifications ORDER BY stored_at DESC LIMIT 1 OFFSET ?)",
+            (self.capacity - 1,),
+        ).rowcount
+        self._db.commit()
+        return deleted
+
+    def _load(self):
+        rows = self._db.execute(
+            "SELECT topic, labels, embedding, stored_at FROM classifications"
+            " WHERE stored_at >= ? ORDER BY stored_at DESC LIMIT ?",
+            (time.time() - self.ttl, self.capacity),
+        ).fetchall()
+        for topic, labels, embedding, stored_at in reversed(rows):
+            vector = np.frombuffer(embedding, dtype=np.float32) if embedding is not None else None
+            self._entries[topic] = (json.loads(labels), stored_at, vector)
+
+    def _expired(self, stored_at, now):
+        return now - stored_at > self.ttl
+
+    def _unit(self, embedding):
+        if embedding is None:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _similar(self, vector, now):
+        if self._matrix is None:
+            keys = [k for k, (_, _, v) in self._entries.items() if v is not None and len(v) == len(vector)]
+            self._matrix_keys = keys
+            self._matrix = np.vstack([self._entries[k][2] for k in keys]) if keys else np.empty((0, len(vector)), np.float32)
+        if not len(self._matrix_keys):
+            return None
+        scores = self._matrix @ vector
+        candidates = np.flatnonzero(scores >= self.similarity_threshold)
+        # Best first, skipping matches that have expired or been evicted since the matrix was built
+        for i in candidates[np.argsort(-scores[candidates], kind="stable")].tolist():
+            entry = self._entries.get(self._matrix_keys[i])
+            if entry is not None and not self._expired(entry[1], now):
+                return entry[0]
+        return None
+
+    def get(self, topic, embedding=None):
+        """Cached labels for topic (exact, then nearest by embedding), or None"""
+        key = normalize_topic(topic)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[1], now):
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return dict(entry[0])
+            vector = self._unit(embedding)
+            if vector is not None:
+                labels = self._similar(vector, now)
+                if labels is not None:
+                    self.similar_hits += 1
+                    return dict(labels)
+            self.misses += 1
+            return None
+
+    def put(self, topic, labels, embedding=None):
+        key = normalize_topic(topic)
+        vector = self._unit(embedding)
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (dict(labels), now, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            # Rebuilt on the next similarity lookup
+            self._matrix = None
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO classifications (topic, labels, embedding, stored_at) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(labels), vector.tobytes() if vector is not None else None, now),
+                )
+                self._db.commit()
+                self._writes += 1
+                if self._writes % self.prune_every == 0:
+                    self.prune()
+
+    def stats(self):
+        hits = self.exact_hits + self.similar_hits
+        total = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
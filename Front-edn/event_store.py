@@ -0,0 +1,223 @@
+"""Process-wide, id-indexed copy of the comparison dataset.
+
+The JSON file is parsed once and kept with an id -> event dict. Every few
+seconds a request stats the file; if it changed, a new snapshot is built off
+to the side and swapped in with a single assignment, so requests always see
+either the old or the new data, never a half-built index.
+
+User predictions live in a separate overlay (page.py's prediction store,
+anything with get / values / len) that is consulted on lookup and chained
+on iteration, so they are never copied into the static list.
+
+Each snapshot also keeps the events sorted by final_volume, so the events
+closest in volume to a given one are found by bisecting and walking outwards
+instead of sorting everything per request.
+
+An .arrow file (market_io.py's shared format) is memory-mapped instead of
+parsed: the columns stay in the OS page cache, shared by every worker, and
+only the id and volume orderings are built per process.
+"""
+import bisect
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+
+def has_volume(event):
+    volume = event.get("final_volume")
+    return isinstance(volume, (int, float)) and not isinstance(volume, bool)
+
+
+def walk_outwards(volumes, volume):
+    """(distance, position) pairs over a sorted volume list, in order of increasing distance"""
+    right = bisect.bisect_left(volumes, volume)
+    left = right - 1
+    while left >= 0 or right < len(volumes):
+        left_gap = volume - volumes[left] if left >= 0 else None
+        right_gap = volumes[right] - volume if right < len(volumes) else None
+        if right_gap is None or (left_gap is not None and left_gap <= right_gap):
+            yield left_gap, left
+            left -= 1
+        else:
+            yield right_gap, right
+            right += 1
+
+
+class Snapshot:
+    __slots__ = ("events", "by_id", "by_volume", "volumes", "signature")
+
+    def __init__(self, events, signature):
+        self.events = events
+        self.by_id = {e.get("id"): e for e in events}
+        self.by_volume = sorted((e for e in events if has_volume(e)), key=lambda e: e["final_volume"])
+        self.volumes = [e["final_volume"] for e in self.by_volume]
+        self.signature = signature
+
+    def get(self, event_id):
+        return self.by_id.get(event_id)
+
+    def get_many(self, event_ids):
+        return [self.by_id.get(event_id) for event_id in event_ids]
+
+    def iter_events(self):
+        return iter(self.events)
+
+    def __len__(self):
+        return len(self.events)
+
+    def nearest_by_volume(self, volume):
+        """(distance, event) pairs in order of increasing |final_volume - volume|"""
+        for gap, position in walk_outwards(self.volumes, volume):
+            yield gap, self.by_volume[position]
+
+
+class ArrowSnapshot:
+    """Snapshot over a memory-mapped Arrow table; event dicts are only built for rows that are used"""
+    __slots__ = ("table", "sorted_ids", "id_rows", "by_volume", "volumes", "signature")
+
+    def __init__(self, table, signature):
+        self.table = table
+        self.signature = signature
+        ids = table.column("id").to_numpy()
+        self.id_rows = np.argsort(ids, kind="stable")
+        self.sorted_ids = ids[self.id_rows]
+        # Null volumes come back as NaN and are left out of the volume order
+        volumes = table.column("final_volume").to_numpy(zero_copy_only=False).astype(np.float64)
+        rows = np.flatnonzero(~np.isnan(volumes))
+        self.by_volume = rows[np.argsort(volumes[rows], kind="stable")]
+        self.volumes = volumes[self.by_volume]
+
+    def rows(self, positions):
+        return self.table.take(np.asarray(positions, dtype=np.int64)).to_pylist()
+
+    def get(self, event_id):
+        try:
+            i = int(np.searchsorted(self.sorted_ids, event_id))
+        except TypeError:
+            return None
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == event_id:
+            return self.rows([self.id_rows[i]])[0]
+        return None
+
+    def get_many(self, event_ids):
+        """Events for a list of ids (None where missing), fetched with one take"""
+        try:
+            wanted = np.asarray(event_ids, dtype=self.sorted_ids.dtype)
+        except (TypeError, ValueError):
+            return [self.get(event_id) for event_id in event_ids]
+        positions = np.minimum(np.searchsorted(self.sorted_ids, wanted), max(len(self.sorted_ids) - 1, 0))
+        found = self.sorted_ids[positions] == wanted if len(self.sorted_ids) else np.zeros(len(wanted), bool)
+        events = iter(self.rows(self.id_rows[positions[found]]))
+        return [next(events) if hit else None for hit in found]
+
+    def iter_events(self):
+        for batch in self.table.to_batches():
+            yield from batch.to_pylist()
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def nearest_by_volume(self, volume, block_size=64):
+        """(distance, event) pairs in order of increasing distance, rows fetched a block at a time"""
+        walk = walk_outwards(self.volumes, volume)
+        while True:
+            block = list(itertools.islice(walk, block_size))
+            if not block:
+                return
+            events = self.rows(self.by_volume[[position for _, position in block]])
+            yield from zip((float(gap) for gap, _ in block), events)
+
+
+class EventStore:
+
+    def __init__(self, path, overlay=None, check_interval=2.0):
+        self.path = path
+        self.overlay = overlay if overlay is not None else {}
+        self.check_interval = check_interval
+        self.reloads = 0
+        self._snapshot = Snapshot([], None)
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    @metrics.timed("events.load")
+    def _load(self, signature):
+        snapshot = Snapshot([], signature)
+        try:
+            if self.path.lower().endswith((".arrow", ".feather")):
+                import pyarrow as pa
+                snapshot = ArrowSnapshot(pa.ipc.open_file(pa.memory_map(self.path, "r")).read_all(), signature)
+            else:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    snapshot = Snapshot(json.load(f), signature)
+        except FileNotFoundError:
+            print(f"Error: {self.path} not found. Using only temporary data.")
+        except (ValueError, OSError) as e:
+            print(f"Error: Could not load {self.path} ({e}). Keeping the previous data.")
+            snapshot = self._snapshot
+        self._snapshot = snapshot
+        self.reloads += 1
+
+    def refresh(self, force=False):
+        """Reload if the file changed since the last load (checked at most every check_interval)"""
+        now = time.monotonic()
+        if not force and self.reloads and now - self._last_check < self.check_interval:
+            return
+        with self._lock:
+            self._last_check = now
+            signature = self._signature()
+            if force or not self.reloads or signature != self._snapshot.signature:
+                self._load(signature)
+
+    def get(self, event_id):
+        self.refresh()
+        event = self._snapshot.get(event_id)
+        if event is None:
+            event = self.overlay.get(event_id)
+        return event
+
+    def get_many(self, event_ids):
+        self.refresh()
+        events = self._snapshot.get_many(event_ids)
+        return [event if event is not None else self.overlay.get(event_id) for event_id, event in zip(event_ids, events)]
+
+    def iter_events(self):
+        """Static events followed by the overlay, without copying either"""
+        self.refresh()
+        return itertools.chain(self._snapshot.iter_events(), list(self.overlay.values()))
+
+    def nearest_by_volume(self, volume, exclude_id=None):
+        """Events ordered by closeness in final_volume, lazily, overlay included.
+
+        Only as many events as the caller consumes are visited, so taking the
+        first k costs O(log n + k) for the static data.
+        """
+        self.refresh()
+        if hasattr(self.overlay, "nearest_by_volume"):
+            # The prediction stores walk their own volume order, see prediction_store.py
+            overlay = self.overlay.nearest_by_volume(volume)
+        else:
+            overlay = sorted(
+                ((abs(e["final_volume"] - volume), e) for e in list(self.overlay.values()) if has_volume(e)),
+                key=lambda pair: pair[0],
+            ) if self.overlay else []
+        merged = heapq.merge(self._snapshot.nearest_by_volume(volume), overlay, key=lambda pair: pair[0])
+        for _, event in merged:
+            if event.get("id") != exclude_id:
+                yield event
+
+    def __len__(self):
+        return len(self._snapshot) + len(self.overlay)
@@ -0,0 +1,45 @@
+"""Production server for the web app, run from this directory:
+
+    gunicorn -c gunicorn.conf.py page:app
+
+Each worker process has its own volume model and LLM gateway; the
+threads within a worker share them, so concurrent /predict requests are
+micro-batched by the InferenceService and a slow LLM only ties up cheap
+waiting threads (bounded by LLM_MAX_CONCURRENCY and LLM_TIMEOUT, which is
+capped below WEB_TIMEOUT).
+
+WEB_PRELOAD=1 is the pre-fork mode: the master imports page.py and loads
+the volume and sentence models once, and the workers forked from it share
+those pages copy-on-write instead of each loading (and holding) a copy.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_WORKERS", min(4, multiprocessing.cpu_count())))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "32"))
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))
+# Exported so the workers cap the LLM wait (llm_client.llm_timeout) below the same value,
+# and requests fail cleanly before the worker is killed
+os.environ["WEB_TIMEOUT"] = str(timeout)
+graceful_timeout = 30
+keepalive = 5
+# Predictions must be visible to whichever worker serves the /compare redirect
+os.environ.setdefault("PREDICTION_STORE_PATH", "predictions.sqlite")
+# Threads and SQLite connections don't survive a fork, so with preloading page.after_fork()
+# reopens and starts them in each worker
+preload_app = os.getenv("WEB_PRELOAD", "0") == "1"
+
+
+def pre_fork(server, worker):
+    # Everything the master has allocated moves to a permanent GC generation, so collections
+    # in the workers don't write to (and so copy) the shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import page
+        page.after_fork()
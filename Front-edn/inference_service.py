@@ -0,0 +1,100 @@
+"""Volume predictions for the Flask app, from a warm predict.py pipeline.
+
+One background thread owns the Predictor. Request threads drop their event
+on a queue and wait on a Future; the thread takes whatever arrived within
+`max_wait` seconds (up to `max_batch` events) and runs them through a
+single encode + pipe.predict call. Concurrent /predict requests therefore
+share one model call, and every caller gives up after `timeout` seconds
+instead of queueing forever.
+"""
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+
+# predict.py and its artifacts live in the repository root, one level up
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+import predict  # noqa: E402
+
+MODEL_PATH = os.getenv("VOLUME_MODEL_PATH", os.path.join(ROOT_DIR, predict.MODEL_PATH))
+ARTIFACTS_PATH = os.getenv("VOLUME_ARTIFACTS_PATH", predict.default_artifacts_path(ROOT_DIR))
+
+
+class InferenceService:
+
+    def __init__(self, predictor=None, max_batch=64, max_wait=0.01, timeout=10.0, max_queue=1024):
+        self.predictor = predictor or predict.Predictor(MODEL_PATH, ARTIFACTS_PATH)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.batches = 0
+        self.batched_requests = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+                self._thread.start()
+        return self
+
+    def embed(self, titles):
+        """PCA-reduced title embeddings from the same warm model (and cache) the predictions use"""
+        return self.predictor.embed(titles, self.predictor.current())
+
+    def encode(self, titles):
+        """Full sentence embeddings, for comparisons the PCA-reduced ones are too coarse for"""
+        return self.predictor.encode(titles, self.predictor.current())
+
+    def predict_one(self, event, timeout=None):
+        """Predicted final volume for one event dict (title, duration, category, ...)"""
+        self.start()
+        future = Future()
+        try:
+            self._queue.put_nowait((event, future))
+        except queue.Full:
+            raise RuntimeError("Prediction queue is full, try again shortly")
+        try:
+            return future.result(timeout=timeout or self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            # Callers that already timed out don't need an answer
+            batch = [(event, future) for event, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                predictions = self.predictor.predict_records([event for event, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.batched_requests += len(batch)
+            for (_, future), prediction in zip(batch, predictions.tolist()):
+                future.set_result(prediction)
@@ -0,0 +1,297 @@
+"""Topic classification by LLM, behind a small interface.
+
+page.py only ever calls `classify(topic)` and gets back
+{"category", "frequency", "can_close_early"}, so the Gemini client can be
+swapped for StubClassifier in tests and offline runs (LLM_BACKEND=stub).
+
+Request threads don't talk to the LLM themselves: LLMGateway runs every
+call on one background event loop with a shared async client, so open
+connections are reused, at most `max_concurrency` calls are in flight, and
+a caller is released after `timeout` seconds whatever the upstream does.
+"""
+import abc
+import asyncio
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+# gunicorn.conf.py kills a worker after WEB_TIMEOUT seconds on one request and exports the value
+# it uses, so LLM waits are capped below it with room left for the rest of the request
+DEFAULT_WEB_TIMEOUT = 60.0
+WEB_TIMEOUT_MARGIN = 5.0
+
+
+class LLMError(ValueError):
+    """The LLM call failed or returned something we couldn't parse; .raw_text has the response"""
+
+    def __init__(self, message, raw_text=""):
+        super().__init__(message)
+        self.raw_text = raw_text
+
+
+class TopicClassifier(abc.ABC):
+    """Interface: classify(topic) -> {"category": str, "frequency": str, "can_close_early": bool}"""
+
+    @abc.abstractmethod
+    def classify(self, topic):
+        """Labels for one topic; raises LLMError if the backend fails"""
+
+    def warm_up(self):
+        """Do any slow setup (imports, clients) now rather than on the first call"""
+        return self
+
+    async def aclassify(self, topic):
+        """Async classify; by default the blocking call runs on the loop's thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.classify, topic)
+
+
+def parse_llm_json(text):
+    """Pull the JSON object out of an LLM response, tolerating code fences and chatter around it"""
+    json_text = text.strip()
+
+    # 1. Strip common markdown code fences before parsing
+    if json_text.startswith("```json"):
+        json_text = json_text[len("```json"):]
+    elif json_text.startswith("```"):
+        json_text = json_text[len("```"):]
+    json_text = json_text.rstrip("`").strip()
+
+    # 2. Keep only the content between the first { and last } to exclude any preamble or postscript text
+    start_index = json_text.find('{')
+    end_index = json_text.rfind('}')
+    if start_index != -1 and end_index > start_index:
+        json_text = json_text[start_index:end_index + 1]
+
+    llm_data = json.loads(json_text)
+    return {
+        "category": llm_data["category"],
+        "frequency": llm_data["frequency"],
+        "can_close_early": llm_data.get("can_end_early", False),
+    }
+
+
+PROMPT_TEMPLATE = (
+    "You are a mystical, predictive MetaBall. A user has provided a **TITLE** of an event. "
+    "Analyze this title and output a suitable **Category** (from the exact list: "
+    "['financials', 'crypto', 'sports', 'mentions', 'world', 'entertainment', 'social', 'climate and weather']), "
+    "and the **Frequency** this type of event occurs (e.g., 'Yearly' for a league winner, 'Daily' for breaking news). "
+    "Options for  **Frequency** are: ['Daily', 'one_off', 'weekly', 'hourly', 'custom'] so only these values can be used for **Frequency**"
+    "Also provide a boolean (True or False) value for **can_end_early**. This is dependant on whether the event can come true at anytime during"
+    " the bid period. For example, if the bid is that it is going to rain in the next week, as soon as it rains, the bid is over so you set can_end_early to True, whereas if it "
+    "were a bid on a team winning a football match, the bid is only won at the end of the match so you would set it to False"
+    "Generate a JSON object that strictly conforms to the provided schema.\n\n"
+    "Analyze this prediction title: '{topic}'"
+)
+
+
+class GeminiClassifier(TopicClassifier):
+
+    def __init__(self, client=None, model="gemini-2.5-flash"):
+        # google.genai takes about a second to import, so it is loaded by warm_up() or the first call
+        self._client = client
+        self.model = model
+        self.output_schema = None
+        self._types = None
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        if self._types is not None:
+            return self
+        with self._lock:
+            if self._types is None:
+                from google import genai
+                from google.genai import types
+
+                if self._client is None:
+                    self._client = genai.Client()
+                # --- Define the desired output structure ---
+                self.output_schema = types.Schema(
+                    type=types.Type.OBJECT,
+                    properties={
+                        "category": types.Schema(type=types.Type.STRING, description="The main topic category (e.g., Technology, Culture, Economics)."),
+                        "frequency": types.Schema(type=types.Type.STRING, description="A prediction of how often this topic will be discussed (e.g., Daily, Monthly, Annually)."),
+                        "can_end_early": types.Schema(type=types.Type.BOOLEAN, description="Determines whether the event can come true at any point in time rather than having to wait till the end of its time")
+                    },
+                    required=["category", "frequency", "can_end_early"]
+                )
+                self._types = types
+        return self
+
+    @property
+    def client(self):
+        return self.warm_up()._client
+
+    def request_kwargs(self, topic):
+        self.warm_up()
+        return dict(
+            model=self.model,
+            contents=[{"role": "user", "parts": [{"text": PROMPT_TEMPLATE.format(topic=topic)}]}],
+            config=self._types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=self.output_schema
+            ),
+        )
+
+    def classify(self, topic):
+        json_text = ""
+        try:
+            response = self.client.models.generate_content(**self.request_kwargs(topic))
+            json_text = response.text or ""
+            return parse_llm_json(json_text)
+        except Exception as e:
+            print(f"Gemini Prediction Error: {e}. Raw Text: {json_text}")
+            raise LLMError(f"LLM Generation or Parsing failed. Raw response was: {json_text}", json_text) from e
+
+    async def aclassify(self, topic):
+        json_text = ""
+        try:
+            # client.aio shares one HTTP connection pool across calls
+            response = await self.client.aio.models.generate_content(**self.request_kwargs(topic))
+            json_text = response.text or ""
+            return parse_llm_json(json_text)
+        except Exception as e:
+            print(f"Gemini Prediction Error: {e}. Raw Text: {json_text}")
+            raise LLMError(f"LLM Generation or Parsing failed. Raw response was: {json_text}", json_text) from e
+
+
+class StubClassifier(TopicClassifier):
+    """Offline stand-in: fixed answer (or a function of the topic) after an optional delay"""
+
+    def __init__(self, answer=None, latency=0.0):
+        self.answer = answer or {"category": "world", "frequency": "one_off", "can_close_early": False}
+        self.latency = latency
+        self.calls = 0
+
+    def classify(self, topic):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return dict(self.answer(topic) if callable(self.answer) else self.answer)
+
+    async def aclassify(self, topic):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return dict(self.answer(topic) if callable(self.answer) else self.answer)
+
+
+class LLMGateway(TopicClassifier):
+    """Thread-safe front for a TopicClassifier: calls run on a shared event loop, bounded and timed out"""
+
+    def __init__(self, classifier, max_concurrency=16, timeout=20.0, max_pending=256):
+        self.classifier = classifier
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pending = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                thread = threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True)
+                thread.start()
+        return self
+
+    async def _classify(self, topic):
+        async def bounded():
+            async with self._semaphore:
+                return await self.classifier.aclassify(topic)
+
+        # The timeout covers waiting for a free slot as well as the call itself
+        try:
+            return await asyncio.wait_for(bounded(), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise LLMError(f"LLM did not answer within {self.timeout:g}s")
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def submit(self, topic):
+        """concurrent.futures.Future for the labels; LLMError straight away if too many calls are queued"""
+        self.start()
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise LLMError("LLM is busy, try again shortly")
+            self.pending += 1
+        future = asyncio.run_coroutine_threadsafe(self._classify(topic), self._loop)
+        future.add_done_callback(self._done)
+        return future
+
+    def classify(self, topic):
+        future = self.submit(topic)
+        try:
+            # _classify already times out; this only guards against a wedged event loop
+            return future.result(timeout=self.timeout + 1.0)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.timeouts += 1
+            raise LLMError(f"LLM did not answer within {self.timeout:g}s")
+        except LLMError:
+            raise
+        except Exception as e:
+            raise LLMError(f"LLM call failed: {e}") from e
+
+    async def aclassify(self, topic):
+        return await asyncio.wrap_future(self.submit(topic))
+
+    def warm_up(self):
+        """Warm the wrapped classifier; the event loop itself is only started by the first call"""
+        self.classifier.warm_up()
+        return self
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "calls": getattr(self.classifier, "calls", 0),
+        }
+
+
+def client_from_env():
+    """The configured TopicClassifier, or None if no LLM is available"""
+    backend = os.getenv("LLM_BACKEND", "gemini")
+    if backend == "stub":
+        return StubClassifier(latency=float(os.getenv("LLM_STUB_LATENCY", "0")))
+    try:
+        # Check if the API key is available in the environment variables
+        if not os.getenv("GEMINI_API_KEY"):
+            raise EnvironmentError("GEMINI_API_KEY is not set.")
+        return GeminiClassifier()
+    except Exception as e:
+        print(f"Error initializing Gemini client: {e}")
+        return None
+
+
+def llm_timeout(other_waits=0.0):
+    """LLM_TIMEOUT, capped so it plus other_waits (e.g. the inference timeout) fits inside WEB_TIMEOUT"""
+    configured = float(os.getenv("LLM_TIMEOUT", "20"))
+    web_timeout = float(os.getenv("WEB_TIMEOUT", DEFAULT_WEB_TIMEOUT))
+    cap = max(1.0, web_timeout - other_waits - WEB_TIMEOUT_MARGIN)
+    if configured > cap:
+        print(f"LLM_TIMEOUT {configured:g}s doesn't fit in WEB_TIMEOUT {web_timeout:g}s, using {cap:g}s")
+    return min(configured, cap)
+
+
+def gateway_from_env(other_waits=0.0):
+    """client_from_env() behind an LLMGateway (LLM_MAX_CONCURRENCY, llm_timeout()), or None"""
+    classifier = client_from_env()
+    if classifier is None:
+        return None
+    return LLMGateway(
+        classifier,
+        max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+        timeout=llm_timeout(other_waits),
+    )
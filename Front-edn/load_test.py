@@ -0,0 +1,105 @@
+"""Load test for POST /predict: throughput and p50/p95/p99 latency.
+
+By default the app is started in this process with the stub LLM (LLM_BACKEND=stub)
+answering after --llm-latency seconds, so the numbers show how the server copes
+with a slow upstream rather than Gemini's own speed:
+
+    python load_test.py --requests 400 --concurrency 64 --llm-latency 0.5
+    python load_test.py --url http://localhost:8000     # an already running server
+
+Topics are unique per request unless --repeat-topics is given, so every
+request misses the classification cache and reaches the LLM.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+
+def start_local_server(llm_latency, llm_concurrency):
+    """Import page.py with the stub LLM and serve it on a free local port; returns (base url, page module)"""
+    os.environ["LLM_BACKEND"] = "stub"
+    os.environ["LLM_STUB_LATENCY"] = str(llm_latency)
+    os.environ["LLM_MAX_CONCURRENCY"] = str(llm_concurrency)
+    os.environ["CLASSIFICATION_CACHE_PATH"] = ""
+    from werkzeug.serving import make_server
+
+    import page
+
+    page.warm_up()
+    server = make_server("127.0.0.1", 0, page.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", page
+
+
+def run(url, n_requests, concurrency, repeat_topics=False, duration="86400"):
+    local = threading.local()
+
+    def one(i):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        topic = "Will it rain in London this week?" if repeat_topics else f"Will team {i} win the final on day {i % 365}?"
+        start = time.perf_counter()
+        try:
+            response = local.session.post(f"{url}/predict", data={"topic": topic, "duration": duration}, timeout=120)
+            ok = response.ok and response.json().get("result") == "Success"
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(n_requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = np.array([latency for latency, _ in results])
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "errors": sum(1 for _, ok in results if not ok),
+        "seconds": elapsed,
+        "throughput_rps": n_requests / elapsed,
+        "p50_ms": p50 * 1000,
+        "p95_ms": p95 * 1000,
+        "p99_ms": p99 * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test POST /predict")
+    parser.add_argument("--url", help="server to test (default: start page.py here with the stub LLM)")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="stub LLM delay in seconds (local server only)")
+    parser.add_argument("--llm-concurrency", type=int, default=16, help="LLM_MAX_CONCURRENCY (local server only)")
+    parser.add_argument("--repeat-topics", action="store_true", help="send the same topic every time")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    page = None
+    url = args.url
+    if url is None:
+        url, page = start_local_server(args.llm_latency, args.llm_concurrency)
+        print(f"Serving page.py at {url} (stub LLM, {args.llm_latency}s latency)")
+
+    results = run(url.rstrip("/"), args.requests, args.concurrency, args.repeat_topics)
+    if page is not None:
+        results["llm_calls"] = page.llm_client.classifier.calls if page.llm_client else 0
+        results["inference_batches"] = page.inference.batches
+
+    print(f"{results['requests']} requests, concurrency {results['concurrency']}: "
+          f"{results['throughput_rps']:.1f} req/s, {results['errors']} errors")
+    print(f"latency p50 {results['p50_ms']:.0f} ms, p95 {results['p95_ms']:.0f} ms, p99 {results['p99_ms']:.0f} ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
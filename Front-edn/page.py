@@ -1,40 +1,179 @@
 import os
-import json 
-import random # Added for random ID generation and volume
-from flask import Flask, render_template, request, jsonify, redirect, url_for # Added redirect and url_for
+import itertools
+import pickle
+import math
+import threading
+import time
+from flask import Flask, Response, g, render_template, request, jsonify, url_for
 from dotenv import load_dotenv
-
-from google import genai
-from google.genai import types
+import numpy as np
+
+# inference_service puts the repository root (predict.py, metrics.py, ...) on sys.path, so it goes first
+from inference_service import ROOT_DIR, InferenceService
+import metrics
+from event_store import EventStore, has_volume
+from prediction_store import store_from_env
+from classification_cache import ClassificationCache
+from llm_client import LLMError, gateway_from_env
+import title_classifier
+from vector_index import INDEX_DIR, VectorIndex
 
 # --- Load environment variables from the .env file ---
 load_dotenv() 
 
 app = Flask(__name__)
 
-# Global in-memory storage for newly created predictions
-# This is a simple way to store the data for the immediate next request (the redirect)
-temp_predictions = {} 
-
-try:
-    # Check if the API key is available in the environment variables
-    if not os.getenv("GEMINI_API_KEY"):
-        raise EnvironmentError("GEMINI_API_KEY is not set.")
-    
-    client = genai.Client()
-except Exception as e:
-    print(f"Error initializing Gemini client: {e}")
-    client = None
-
-
-def generate_six_digit_id():
-    """Generates a unique 6-digit integer ID not currently in temporary storage."""
-    while True:
-        # Generate a random number between 100000 and 999999
-        new_id = random.randint(100000, 999999)
-        # Ensure the ID is not already used in the temporary store
-        if new_id not in temp_predictions:
-            return new_id
+# Newly created predictions, kept for the redirect and a while after (size-capped, expiring).
+# Set PREDICTION_STORE_PATH to share them between workers through SQLite
+prediction_store = store_from_env()
+
+# Warm predict.py pipeline shared by all requests in this worker; concurrent calls are micro-batched
+inference = InferenceService()
+
+# Offline category/frequency/can_close_early classifier (see title_classifier.py); Gemini is the fallback.
+# Loaded by warm_up() or the first request, as unpickling it imports sklearn, and reloaded when the
+# file changes (stat'ed at most every TITLE_CLASSIFIER_CHECK_INTERVAL seconds), like the volume model
+TITLE_CLASSIFIER_PATH = os.getenv("TITLE_CLASSIFIER_PATH", os.path.join(ROOT_DIR, title_classifier.CLASSIFIER_PATH))
+TITLE_CLASSIFIER_CHECK_INTERVAL = 5.0
+title_classifier_model = None
+_title_classifier_mtime = None
+_title_classifier_checked = None
+_title_classifier_incompatible = False
+_title_classifier_lock = threading.Lock()
+
+
+def load_title_classifier():
+    """The current title classifier (None if there isn't one), reloading it if its file changed"""
+    global title_classifier_model, _title_classifier_mtime, _title_classifier_checked, _title_classifier_incompatible
+    checked = _title_classifier_checked
+    if checked is not None and time.monotonic() - checked < TITLE_CLASSIFIER_CHECK_INTERVAL:
+        return title_classifier_model
+    with _title_classifier_lock:
+        first = _title_classifier_checked is None
+        _title_classifier_checked = time.monotonic()
+        try:
+            mtime = os.path.getmtime(TITLE_CLASSIFIER_PATH)
+        except FileNotFoundError:
+            mtime = None
+        if first or mtime != _title_classifier_mtime:
+            _title_classifier_mtime = mtime
+            _title_classifier_incompatible = False
+            title_classifier_model = None
+            try:
+                if mtime is not None:
+                    title_classifier_model = title_classifier.load_classifier(TITLE_CLASSIFIER_PATH)
+                    print(f"Loaded the title classifier from {TITLE_CLASSIFIER_PATH}")
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError) as e:
+                # Caught mid-replace; the next check tries again
+                print(f"Could not load the title classifier: {e}")
+                _title_classifier_mtime = None
+            if title_classifier_model is None and first:
+                print(f"No title classifier at {TITLE_CLASSIFIER_PATH}, every topic goes to the LLM.")
+    return title_classifier_model
+
+
+# Gemini by default; LLM_BACKEND=stub swaps in an offline stand-in (see llm_client.py).
+# Calls run on a shared event loop, so a slow LLM is bounded by LLM_MAX_CONCURRENCY / LLM_TIMEOUT,
+# and the wait leaves the inference timeout inside gunicorn's WEB_TIMEOUT
+llm_client = gateway_from_env(other_waits=inference.timeout)
+
+# LLM answers are memoised per topic (and reused for near-duplicate topics) across restarts
+# (CLASSIFICATION_CACHE_PATH="" keeps them in memory only)
+CLASSIFICATION_CACHE_PATH = os.getenv("CLASSIFICATION_CACHE_PATH", os.path.join(ROOT_DIR, "classification_cache.sqlite"))
+classification_cache = ClassificationCache(CLASSIFICATION_CACHE_PATH or None)
+
+metrics.register_stats("classification_cache", lambda: classification_cache.stats())
+if llm_client is not None:
+    metrics.register_stats("llm_gateway", llm_client.stats)
+metrics.register_stats("inference", lambda: {"batches": inference.batches, "batched_requests": inference.batched_requests})
+metrics.register_stats("prediction_store", lambda: {"entries": len(prediction_store)})
+
+# PROFILE_REQUESTS=1 lets a request ask for a sampling profile with ?profile=1; the hottest
+# frames are logged and the collapsed stacks (for flame graph tools) written to PROFILE_DIR
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(ROOT_DIR, "profiles"))
+
+
+def warm_up(encode=True):
+    """Load the heavy parts now instead of on the first request: the volume and sentence
+    models, the title classifier and the LLM client (google.genai)"""
+    inference.predictor.warm_up(encode=encode)
+    load_title_classifier()
+    if llm_client is not None:
+        llm_client.warm_up()
+
+
+def warm_up_in_background():
+    def run():
+        try:
+            warm_up()
+            inference.start()
+        except Exception as e:
+            print(f"Warm-up failed, will retry on first request: {e}")
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def after_fork():
+    """Per-worker setup when gunicorn forks workers from a preloaded app (gunicorn.conf.py).
+
+    The models loaded before the fork are shared copy-on-write and kept; SQLite
+    connections can't be used across a fork, so the stores are reopened, and the
+    background threads are started here, in the worker.
+    """
+    global prediction_store, classification_cache
+    prediction_store = store_from_env()
+    event_store.overlay = prediction_store
+    classification_cache = ClassificationCache(CLASSIFICATION_CACHE_PATH or None)
+    warm_up_in_background()
+
+
+# With WEB_PRELOAD=1 this module is imported once by the gunicorn master, which loads the
+# models before forking; otherwise the import returns straight away and they load in the background
+if os.getenv("WEB_PRELOAD") == "1":
+    warm_up(encode=False)
+else:
+    warm_up_in_background()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.profiler = None
+    if PROFILE_REQUESTS and request.args.get("profile") == "1":
+        g.profiler = metrics.SamplingProfiler().start()
+
+
+@app.after_request
+def record_request_time(response):
+    started = g.get("request_started")
+    if started is not None:
+        metrics.observe(f"http.{request.endpoint or 'unknown'}", time.perf_counter() - started)
+        metrics.inc(f"http.status_{response.status_code}")
+    return response
+
+
+@app.teardown_request
+def finish_request_profile(exc):
+    # Teardown runs even when a view raised, so a profiler thread is never left sampling
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{request.endpoint}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.txt")
+        with open(path, "w") as f:
+            f.write(profiler.collapsed())
+        print(f"Profile of {request.path} ({path}):\n{profiler.report()}")
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus text format, or JSON with ?format=json. Numbers are for this worker process only."""
+    if request.args.get("format") == "json":
+        return jsonify(metrics.REGISTRY.snapshot())
+    return Response(metrics.REGISTRY.prometheus_text(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/")
@@ -42,102 +181,87 @@ def index():
     return render_template("index.html")
 
 
-@app.route("/predict", methods=["POST"])
-def predict():
-    print("START PREDICT")
-    topic = request.form.get("topic")
-    print("TOPIC", topic)
-    duration = request.form.get("duration")   
+def embed_topic(topic):
+    """PCA-reduced title embedding for the topic, or None if the model isn't available."""
+    try:
+        return inference.embed([topic])
+    except Exception as e:
+        print(f"Topic embedding error: {e}")
+        return None
 
 
-    print("TOPIC", topic, "DURATION", duration)
+def encode_topic(topic):
+    """Full sentence embedding for the topic, or None if the model isn't available."""
+    try:
+        return inference.encode([topic])
+    except Exception as e:
+        print(f"Topic encoding error: {e}")
+        return None
+
+
+def classify_locally(embedding):
+    """(labels, confident) from the offline title classifier, or (None, False) if there isn't one."""
+    global _title_classifier_incompatible
+    classifier = load_title_classifier()
+    if classifier is None or embedding is None:
+        return None, False
+    try:
+        # Checked per call, so a retrained classifier or volume model that matches again is picked up
+        if not classifier.compatible_with(inference.predictor.artifacts):
+            if not _title_classifier_incompatible:
+                print("Title classifier was trained on a different embedding model/PCA, ignoring it.")
+                _title_classifier_incompatible = True
+            return None, False
+        return classifier.classify(embedding)
+    except Exception as e:
+        print(f"Local classifier error: {e}")
+        return None, False
 
 
+@app.route("/predict", methods=["POST"])
+def predict():
+    topic = request.form.get("topic")
+    duration = request.form.get("duration")
+
     if not topic:
         return jsonify({"result": "Please provide a prediction title."}) 
 
-    if client is None:
-        return jsonify({"result": "LLM client failed to initialize. Check if GEMINI_API_KEY is set correctly."})
-
-    # --- Define the desired output structure (Schema remains the same) ---
-    output_schema = types.Schema(
-        type=types.Type.OBJECT,
-        properties={
-            "category": types.Schema(type=types.Type.STRING, description="The main topic category (e.g., Technology, Culture, Economics)."),
-            "frequency": types.Schema(type=types.Type.STRING, description="A prediction of how often this topic will be discussed (e.g., Daily, Monthly, Annually)."),
-            "can_end_early": types.Schema(type=types.Type.BOOLEAN, description="Determines whether the event can come true at any point in time rather than having to wait till the end of its time")
-        },
-        # Ensure prediction_text is expected, which guides the model to include it
-        required=["category", "frequency", "can_end_early"] 
-    )
-    
-    # --- New Combined Prompt ---
-    full_prompt = (
-        "You are a mystical, predictive MetaBall. A user has provided a **TITLE** of an event. "
-        "Analyze this title and output a suitable **Category** (from the exact list: "
-        "['financials', 'crypto', 'sports', 'mentions', 'world', 'entertainment', 'social', 'climate and weather']), "
-        "and the **Frequency** this type of event occurs (e.g., 'Yearly' for a league winner, 'Daily' for breaking news). "
-        "Options for  **Frequency** are: ['Daily', 'one_off', 'weekly', 'hourly', 'custom'] so only these values can be used for **Frequency**"
-        "Also provide a boolean (True or False) value for **can_end_early**. This is dependant on whether the event can come true at anytime during"
-        " the bid period. For example, if the bid is that it is going to rain in the next week, as soon as it rains, the bid is over so you set can_end_early to True, whereas if it "
-        "were a bid on a team winning a football match, the bid is only won at the end of the match so you would set it to False"
-        "Generate a JSON object that strictly conforms to the provided schema.\n\n"
-        f"Analyze this prediction title: '{topic}'"
-    )
-    
-    json_text = ""
+    # Local classifier first, then earlier LLM answers for the same (or a near-identical) topic,
+    # and only then a fresh LLM call
+    labels, confident = classify_locally(embed_topic(topic))
+    cached = sentence_embedding = None
+    if not confident:
+        # Near-identical topics are matched on the full embedding; the PCA-reduced one is too coarse
+        sentence_embedding = encode_topic(topic)
+        cached = classification_cache.get(topic, sentence_embedding)
+    if cached is not None:
+        metrics.inc("classification.cached")
+        labels = cached
+    elif not confident:
+        if llm_client is not None:
+            metrics.inc("classification.llm")
+            try:
+                with metrics.timer("llm.call"):
+                    labels = llm_client.classify(topic)
+            except LLMError as e:
+                metrics.inc("llm.errors")
+                return jsonify({"result": f"Error: {e}"})
+            classification_cache.put(topic, labels, sentence_embedding)
+        elif labels is None:
+            return jsonify({"result": "LLM client failed to initialize. Check if GEMINI_API_KEY is set correctly."})
+        else:
+            metrics.inc("classification.local_fallback")
+    else:
+        metrics.inc("classification.local")
 
     try:
-        response = client.models.generate_content(
-            model = "gemini-2.5-flash",
-            contents = [
-                {
-                    "role": "user", 
-                    "parts": [
-                        {"text": full_prompt}
-                    ]
-                }
-            ],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-                response_schema=output_schema
-            )
-        )
-
-        json_text = response.text.strip()
-        
-        # --- RESILIENCY FIX: Aggressively isolate JSON object ---
-        
-        # 1. Strip common markdown code fences before parsing
-        if json_text.startswith("```json"):
-            json_text = json_text.lstrip("```json").rstrip("```").strip()
-        elif json_text.startswith("```"):
-            json_text = json_text.lstrip("```").rstrip("```").strip()
-            
-        # 2. Find the start and end of the JSON object ({...}) to exclude any preamble or postscript text.
-        try:
-            start_index = json_text.index('{')
-            end_index = json_text.rindex('}')
-            # Slice the string to include only the content between the first { and last }
-            json_text = json_text[start_index:end_index + 1]
-        except ValueError:
-            # If the braces are not found, use the original text and let json.loads handle the error
-            pass
-        # --- END RESILIENCY FIX ---
-
-        llm_data = json.loads(json_text)
-
         # --- REDIRECT LOGIC: Return URL in JSON instead of a Flask redirect (302) ---
         
-        new_id = generate_six_digit_id()
-        # Generate a random volume score (required by the existing compare_events logic)
-        category = llm_data["category"]
-        frequency = llm_data["frequency"]
-        can_close_early = llm_data.get("can_end_early", False)
+        category = labels["category"]
+        frequency = labels["frequency"]
+        can_close_early = labels.get("can_close_early", False)
 
-        print("BOOLEAN:", can_close_early)
         new_event = {
-            "id": new_id,
             "title": topic,
             "category":category,
             "frequency": frequency,
@@ -145,54 +269,104 @@ def predict():
             "can_close_early": can_close_early
         }
 
-        interpolated_volume = generate_six_digit_id()
-        
-        new_event["final_volume"] = interpolated_volume
+        try:
+            predicted_volume = inference.predict_one(new_event)
+        except Exception as e:
+            print(f"Volume Prediction Error: {e}")
+            return jsonify({"result": f"Error: Volume prediction failed ({type(e).__name__}: {e})"})
+
+        new_event["final_volume"] = int(predicted_volume)
         
-        # Store the new event data temporarily using the integer ID as the key
-        temp_predictions[new_id] = new_event
+        # Store the new event data temporarily; the store assigns its integer ID
+        new_id = prediction_store.add(new_event)
         
         # Generate the target URL
         redirect_url = url_for('compare_events', event_id=new_id)
         
         # Return the URL in a JSON response for the client-side JavaScript to handle
-        print(f"DEBUG: Returning redirect URL to client: {redirect_url}")
         return jsonify({"redirect_url": redirect_url, "result": "Success"})
 
 
     except Exception as e:
-        debug_message = f"Error: LLM Generation or Parsing failed. Raw response was: {json_text}"
-        print(f"Gemini Prediction Error: {e}. Raw Text: {json_text}")
+        debug_message = f"Error: Prediction failed: {e}"
+        print(f"Prediction Error: {e}")
         return jsonify({"result": debug_message})
 
 
-DATA_FILE = 'data2.json'
+# The memory-mapped Arrow copy (python market_io.py data2.json data2.arrow) is preferred when present
+DATA_FILE = os.getenv("DATA_FILE") or ('data2.arrow' if os.path.exists('data2.arrow') else 'data2.json')
+
+# Parsed once per process and reloaded only when the file changes; new predictions are overlaid
+event_store = EventStore(DATA_FILE, overlay=prediction_store)
 
 def load_all_events():
-    """Loads all data from the JSON file and merges it with temporary predictions."""
-    # Load static data
-    all_events = []
-    try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            all_events = json.load(f)
-    except FileNotFoundError:
-        print(f"Error: {DATA_FILE} not found. Using only temporary data.")
-    except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from {DATA_FILE}. Using only temporary data.")
-        
-    # Merge with temporary predictions
-    # Note: temp_predictions keys are integers, and the values are dicts with integer 'id' fields.
-    all_events.extend(list(temp_predictions.values()))
-    print("ALL_EVENTS_LENGTH:", len(all_events))
-    return all_events
+    """All static events plus temporary predictions, as one iterable (nothing is copied)."""
+    return event_store.iter_events()
+
+# Title-embedding index over the comparison events (built with vector_index.py data2.json);
+# without one, similarity is by volume alone
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", os.path.join(ROOT_DIR, INDEX_DIR))
+title_index = VectorIndex(VECTOR_INDEX_DIR) if os.path.exists(os.path.join(VECTOR_INDEX_DIR, "meta.json")) else None
+# 0 = volume only, 1 = title similarity only
+TITLE_WEIGHT = float(os.getenv("COMPARE_TITLE_WEIGHT", "0.5"))
+# How many neighbours by volume and by title are blended
+COMPARE_CANDIDATES = 200
+
+
+def title_vector(event, event_id):
+    """Unit title embedding for an event: from the index if it's there, else computed"""
+    if title_index is None:
+        return None
+    title_index.refresh()
+    vectors, found = title_index.vectors_for([event_id])
+    if found[0]:
+        return vectors[0]
+    # User predictions aren't indexed; embed their title, if it's the model the index was built with
+    embedding = embed_topic(event.get("title", ""))
+    if embedding is None or embedding.shape[1] != title_index.dim:
+        return None
+    cache = inference.predictor.embedding_cache
+    if (title_index.model_name, title_index.pca_version) != (cache.model_name, cache.pca_version):
+        return None
+    return embedding[0] / (np.linalg.norm(embedding[0]) or 1.0)
+
+
+def similar_candidates(main_event, event_id):
+    """Events most like main_event, best first.
+
+    The nearest events by volume and by title are pooled and ranked on
+    TITLE_WEIGHT * cosine similarity + (1 - TITLE_WEIGHT) * exp(-|log volume difference|).
+    """
+    query = title_vector(main_event, event_id) if TITLE_WEIGHT > 0 else None
+    if query is None:
+        yield from event_store.nearest_by_volume(main_event["final_volume"], exclude_id=event_id)
+        return
+
+    candidates = {}
+    for event in itertools.islice(event_store.nearest_by_volume(main_event["final_volume"], exclude_id=event_id),
+                                  COMPARE_CANDIDATES):
+        candidates[event.get("id")] = event
+    with metrics.timer("compare.title_search"):
+        matches = title_index.search(query, k=COMPARE_CANDIDATES + 1)
+    ids = [int(id_) if id_.isdigit() else id_ for id_, _ in matches]
+    for event in event_store.get_many(ids):
+        if event is not None and event.get("id") != event_id and has_volume(event):
+            candidates[event.get("id")] = event
+
+    events = list(candidates.values())
+    vectors, _ = title_index.vectors_for([event.get("id") for event in events])
+    title_sim = vectors @ query
+    main_log_volume = math.log1p(max(main_event["final_volume"], 0))
+    volume_sim = np.array([math.exp(-abs(math.log1p(max(e["final_volume"], 0)) - main_log_volume)) for e in events])
+    scores = TITLE_WEIGHT * title_sim + (1 - TITLE_WEIGHT) * volume_sim
+    for i in np.argsort(-scores, kind="stable"):
+        yield events[i]
+
 
 @app.route("/compare/<int:event_id>")
 def compare_events(event_id):
-    # 1. Load all data (including the new prediction)
-    all_events = load_all_events()
-
-    # 2. Find the user-specified event (the central column item)
-    main_event = next((e for e in all_events if e.get("id") == event_id), None)
+    # 1. Find the user-specified event (the central column item) through the id index
+    main_event = event_store.get(event_id)
 
     if not main_event:
         return f"Error: Event with ID {event_id} not found.", 404
@@ -202,49 +376,23 @@ def compare_events(event_id):
     if main_volume is None or not isinstance(main_volume, (int, float)):
         return f"Error: Main event (ID {event_id}) does not have a valid 'final_volume' attribute for comparison.", 400
 
-    # 3. Find two similarly scored events based on volume
-    
-    # Filter out the main event and any events without a valid volume
-    comparable_events = [
-        e for e in all_events 
-        if e.get("id") != event_id
-    ]
-
-    # Calculate the similarity score (absolute difference in volume)
-    # The event is "more similar" if the absolute difference is smaller.
-    def volume_difference(event):
-        return abs(event.get("final_volume") - main_volume)
-
-    # Sort the comparable events using the difference function
-    comparable_events.sort(key=volume_difference)
-
-    # Take the two most similar events
-    # Use dummy data if static data runs out, to prevent index errors
-    DUMMY_EVENT = {"id": 0, "title": "No Similar Event Found", "category": "N/A", "frequency": "N/A", "final_volume": 0}
-    
+    # 3. Rank candidates by volume closeness (blended with title similarity when there is a
+    # title index), keeping at most one event per series, and stop once we have 8
     similar_events = []
-    used_categories = set()
     used_series = set()
 
+    with metrics.timer("compare.neighbour_search"):
+        for event in similar_candidates(main_event, event_id):
+            series = event.get("series", event.get("series_ticker"))
 
-
-    for event in comparable_events:
-        category = event.get("category")
-        series = event.get("series")
-        
-        # Only add the event if its category hasn't been used yet
-        if category not in used_categories:
-            if series not in used_series:
+            if series is None or series not in used_series:
                 similar_events.append(event)
-                used_categories.add(series)
-                #used_categories.add(category)
+                if series is not None:
+                    used_series.add(series)
 
-        
-        
-        # Stop once we have collected 8 similar events
-        if len(similar_events) == 8:
-            break
-    
+            # Stop once we have collected 8 similar events
+            if len(similar_events) == 8:
+                break
 
     all_events_for_template = similar_events[:4] + [main_event] + similar_events[4:]
     # 4. Render the new template, passing the three events
@@ -255,4 +403,5 @@ def compare_events(event_id):
     )
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Development only; in production run several workers with gunicorn -c gunicorn.conf.py page:app
+    app.run(debug=True, threaded=True)
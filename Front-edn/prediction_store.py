@@ -0,0 +1,210 @@
+"""Short-lived storage for predictions made through /predict.
+
+A prediction only has to live long enough for the redirect to
+/compare/<id> and a few reloads, so every store is capped at `capacity`
+entries and drops them after `ttl` seconds.
+
+Ids are six digits, like the originals, but are handed out by stepping a
+counter through a fixed permutation of 100000-999999 instead of drawing
+random numbers until a free one turns up: allocation is O(1) and an id
+cannot repeat until 900000 more predictions have been made, by which time
+the old one has long been evicted (capacity must stay below that).
+
+    MemoryPredictionStore   one process; the default
+    SQLitePredictionStore   a file shared by all gunicorn workers, so the
+                            redirect can land on any of them
+
+Both look like a read-only dict (get / values / len) to EventStore's overlay,
+plus nearest_by_volume(), which walks the predictions outwards from a volume
+without sorting the whole store on every /compare: the memory store keeps a
+volume-sorted list that is rebuilt only after a write or eviction, and the
+SQLite store has an indexed volume column it reads a block at a time.
+"""
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from event_store import has_volume, walk_outwards
+
+ID_MIN = 100000
+ID_SPACE = 900000
+# Coprime with ID_SPACE, so seq -> id is a bijection over one cycle of the counter
+ID_STEP = 654323
+ID_OFFSET = 271828
+
+
+def prediction_id(seq):
+    return ID_MIN + (seq * ID_STEP + ID_OFFSET) % ID_SPACE
+
+
+class MemoryPredictionStore:
+
+    def __init__(self, capacity=10000, ttl=3600):
+        if capacity >= ID_SPACE:
+            raise ValueError(f"capacity must be below {ID_SPACE}")
+        self.capacity = capacity
+        self.ttl = ttl
+        self._seq = 0
+        # id -> (event, created), oldest first
+        self._events = OrderedDict()
+        # (seq, len) the volume-sorted list was built at, and the list as (volumes, events)
+        self._sorted_at = None
+        self._sorted = ([], [])
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._events:
+            _, (_, created) = next(iter(self._events.items()))
+            if now - created <= self.ttl and len(self._events) <= self.capacity:
+                break
+            self._events.popitem(last=False)
+
+    def add(self, event):
+        """Store the event under a fresh id (also written to event["id"]) and return the id"""
+        now = time.time()
+        with self._lock:
+            self._seq += 1
+            event_id = prediction_id(self._seq)
+            event["id"] = event_id
+            self._events[event_id] = (event, now)
+            self._evict(now)
+        return event_id
+
+    def get(self, event_id, default=None):
+        entry = self._events.get(event_id)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            return default
+        return entry[0]
+
+    def values(self):
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            return [event for event, _ in self._events.values()]
+
+    def __len__(self):
+        return len(self._events)
+
+    def nearest_by_volume(self, volume):
+        """(distance, event) pairs in order of increasing |final_volume - volume|"""
+        with self._lock:
+            self._evict(time.time())
+            # Adds bump the seq and evictions only ever shrink the dict, so this names the contents
+            state = (self._seq, len(self._events))
+            if state != self._sorted_at:
+                events = sorted((e for e, _ in self._events.values() if has_volume(e)), key=lambda e: e["final_volume"])
+                self._sorted = ([e["final_volume"] for e in events], events)
+                self._sorted_at = state
+            volumes, events = self._sorted
+        for gap, position in walk_outwards(volumes, volume):
+            yield gap, events[position]
+
+
+class SQLitePredictionStore:
+
+    def __init__(self, path, capacity=10000, ttl=3600):
+        if capacity >= ID_SPACE:
+            raise ValueError(f"capacity must be below {ID_SPACE}")
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Transactions are managed explicitly; several processes write to the same file
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            " id INTEGER PRIMARY KEY,"
+            " seq INTEGER NOT NULL,"
+            " event TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS predictions_seq ON predictions (seq)")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(predictions)")]
+        if "volume" not in columns:
+            # Stores written before the volume column existed
+            self._db.execute("ALTER TABLE predictions ADD COLUMN volume REAL")
+            self._db.execute("UPDATE predictions SET volume = json_extract(event, '$.final_volume')")
+        self._db.execute("CREATE INDEX IF NOT EXISTS predictions_volume ON predictions (volume, id)")
+        self._db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('seq', 0)")
+
+    def add(self, event):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                seq = self._db.execute("UPDATE meta SET value = value + 1 WHERE key = 'seq' RETURNING value").fetchone()[0]
+                event_id = prediction_id(seq)
+                event["id"] = event_id
+                self._db.execute(
+                    "INSERT OR REPLACE INTO predictions (id, seq, event, created, volume) VALUES (?, ?, ?, ?, ?)",
+                    (event_id, seq, json.dumps(event), now, event["final_volume"] if has_volume(event) else None),
+                )
+                self._db.execute(
+                    "DELETE FROM predictions WHERE seq <= ? OR created < ?",
+                    (seq - self.capacity, now - self.ttl),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return event_id
+
+    def get(self, event_id, default=None):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT event FROM predictions WHERE id = ? AND created >= ?",
+                (event_id, time.time() - self.ttl),
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def values(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT event FROM predictions WHERE created >= ? ORDER BY seq",
+                (time.time() - self.ttl,),
+            ).fetchall()
+        return [json.loads(event) for event, in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM predictions WHERE created >= ?", (time.time() - self.ttl,)
+            ).fetchone()[0]
+
+    def _volume_side(self, volume, above, block_size):
+        """Events at or above (else below) volume, nearest first, read block_size rows per query"""
+        # Keyset pagination on (volume, id); -1 sorts before every id, so the first block is
+        # volume >= v going up, or volume < v going down
+        compare, order = (">", "ASC") if above else ("<", "DESC")
+        query = (f"SELECT volume, id, event FROM predictions WHERE (volume, id) {compare} (?, ?) AND created >= ?"
+                 f" ORDER BY volume {order}, id {order} LIMIT ?")
+        key = (volume, -1)
+        while True:
+            with self._lock:
+                rows = self._db.execute(query, (*key, time.time() - self.ttl, block_size)).fetchall()
+            for row_volume, _, event in rows:
+                yield abs(row_volume - volume), json.loads(event)
+            if len(rows) < block_size:
+                return
+            key = rows[-1][:2]
+
+    def nearest_by_volume(self, volume, block_size=32):
+        """(distance, event) pairs in order of increasing |final_volume - volume|"""
+        return heapq.merge(self._volume_side(volume, True, block_size), self._volume_side(volume, False, block_size),
+                           key=lambda pair: pair[0])
+
+
+def store_from_env():
+    """SQLitePredictionStore at PREDICTION_STORE_PATH if set, else an in-process MemoryPredictionStore"""
+    capacity = int(os.getenv("PREDICTION_CAPACITY", "10000"))
+    ttl = float(os.getenv("PREDICTION_TTL", "3600"))
+    path = os.getenv("PREDICTION_STORE_PATH")
+    if path:
+        return SQLitePredictionStore(path, capacity=capacity, ttl=ttl)
+    return MemoryPredictionStore(capacity=capacity, ttl=ttl)
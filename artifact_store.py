@@ -0,0 +1,218 @@
+"""Memory-mappable on-disk format for the prediction pipeline and its artifacts.
+
+A directory replaces the two pickles predict.py used to load:
+
+    manifest.json       feature_cols, title_emb_cols, sentence model name,
+                        pca_version, model_version and the file names
+    pca_*.npy           PCA components / mean (/ explained variance), plain .npy
+    pipeline.pkl        the fitted sklearn pipeline's object structure only
+    pipeline.buffers    every NumPy array inside the pipeline (tree nodes,
+                        encoder tables, ...), raw and 64-byte aligned
+    pipeline.offsets.npy  (start, size) of each of those arrays in the buffers file
+
+Everything numeric is memory-mapped, so loading takes milliseconds and every
+worker serving the same directory shares one copy of the pages in the OS
+cache instead of unpickling a private one. The pipeline's arrays are pickled
+out-of-band (protocol 5) and handed back to pickle.loads as views into the
+one mapped buffers file, so no array data is copied. The PCA is read with
+allow_pickle=False and applied by MappedPCA, so it needs no sklearn object
+at all; the pipeline structure is still a pickle, as sklearn estimators
+have no other serialised form.
+
+manifest.json is written last, so a directory without one is incomplete.
+save() never writes into an existing directory: it fills a new one and
+swaps it in (re-pointing a symlink), because truncating a file that a
+worker has mapped kills that worker with SIGBUS.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+MANIFEST = 'manifest.json'
+PIPELINE_FILE = 'pipeline.pkl'
+BUFFERS_FILE = 'pipeline.buffers'
+OFFSETS_FILE = 'pipeline.offsets.npy'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+class MappedPCA:
+    """The transform half of a fitted sklearn PCA, over (memory-mapped) arrays.
+
+    Uses the same operation order as sklearn's PCA.transform, so the
+    embeddings (and any tree splits that depend on them) come out bit for bit.
+    """
+
+    def __init__(self, components, mean, explained_variance=None):
+        self.components_ = components
+        self.mean_ = mean
+        self.explained_variance_ = explained_variance
+        self.whiten = explained_variance is not None
+        self.n_components_ = components.shape[0]
+        self._mean_projection = np.reshape(mean, (1, -1)) @ components.T
+        if self.whiten:
+            scale = np.sqrt(explained_variance)
+            self._scale = np.maximum(scale, np.finfo(scale.dtype).eps)
+
+    def transform(self, X):
+        X = np.asarray(X)
+        if X.dtype not in (np.float32, np.float64):
+            X = X.astype(np.float64)
+        X_transformed = X @ self.components_.T
+        X_transformed -= self._mean_projection
+        if self.whiten:
+            X_transformed /= self._scale
+        return X_transformed
+
+
+def is_artifact_dir(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST))
+
+
+def manifest_path(directory):
+    return os.path.join(directory, MANIFEST)
+
+
+def publish_dir(src, dst):
+    """Point the dst symlink at src, swapping it atomically"""
+    old = None
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        # A plain directory can't be replaced in one step: move it aside, swap, then delete it
+        old = f"{dst}.old-{os.getpid()}"
+        os.rename(dst, old)
+    tmp_path = dst + ".tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(os.path.abspath(src), tmp_path)
+    os.replace(tmp_path, dst)
+    if old is not None:
+        shutil.rmtree(old)
+
+
+def save(directory, pipe, artifacts):
+    """Write pipe and a predict.py artifacts dict (pca, feature_cols, ...) to directory"""
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=os.path.basename(os.path.normpath(directory)) + '.', dir=parent)
+    try:
+        os.chmod(staging, 0o755)
+        manifest = _write(staging, pipe, artifacts)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    if os.path.lexists(directory):
+        publish_dir(staging, directory)
+    else:
+        os.rename(staging, directory)
+    return manifest
+
+
+def _write(directory, pipe, artifacts):
+    import pickle
+
+    from embedding_cache import pca_fingerprint
+
+    pca = artifacts['pca']
+    arrays = {'components': 'pca_components.npy', 'mean': 'pca_mean.npy'}
+    # Saved in their own memory layout (sklearn's components_ is Fortran-ordered), which keeps
+    # the BLAS path, and therefore the rounding, the same as the fitted PCA's
+    np.save(os.path.join(directory, arrays['components']), pca.components_)
+    np.save(os.path.join(directory, arrays['mean']), pca.mean_)
+    if getattr(pca, 'whiten', False):
+        arrays['explained_variance'] = 'pca_explained_variance.npy'
+        np.save(os.path.join(directory, arrays['explained_variance']), pca.explained_variance_)
+    buffers = []
+    structure = pickle.dumps(pipe, protocol=5, buffer_callback=buffers.append)
+    with open(os.path.join(directory, PIPELINE_FILE), 'wb') as f:
+        f.write(structure)
+    offsets = []
+    position = 0
+    with open(os.path.join(directory, BUFFERS_FILE), 'wb') as f:
+        for buffer in buffers:
+            raw = buffer.raw()
+            padding = -position % ALIGNMENT
+            f.write(b'\0' * padding)
+            position += padding
+            offsets.append([position, raw.nbytes])
+            f.write(raw)
+            position += raw.nbytes
+    np.save(os.path.join(directory, OFFSETS_FILE), np.array(offsets, dtype=np.int64).reshape(-1, 2))
+
+    manifest = {key: value for key, value in artifacts.items() if key != 'pca'}
+    manifest.update({
+        'format_version': FORMAT_VERSION,
+        'pca_version': artifacts.get('pca_version') or pca_fingerprint(pca),
+        'pca_arrays': arrays,
+        'pipeline': PIPELINE_FILE,
+        'pipeline_buffers': BUFFERS_FILE,
+        'pipeline_offsets': OFFSETS_FILE,
+    })
+    tmp_path = manifest_path(directory) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path(directory))
+    return manifest
+
+
+def load(directory, mmap=True):
+    """(pipe, artifacts) in the same shape load_model() returns for the pickles"""
+    import pickle
+
+    with open(manifest_path(directory), 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('format_version', 0) > FORMAT_VERSION:
+        raise ValueError(f"{directory} was written by a newer artifact format ({manifest['format_version']})")
+    mmap_mode = 'r' if mmap else None
+
+    arrays = {
+        name: np.load(os.path.join(directory, filename), mmap_mode=mmap_mode, allow_pickle=False)
+        for name, filename in manifest['pca_arrays'].items()
+    }
+    with open(os.path.join(directory, manifest['pipeline']), 'rb') as f:
+        structure = f.read()
+    buffers_path = os.path.join(directory, manifest['pipeline_buffers'])
+    offsets = np.load(os.path.join(directory, manifest['pipeline_offsets']), allow_pickle=False).tolist()
+    if not offsets:
+        blob = np.empty(0, dtype=np.uint8)
+    elif mmap:
+        blob = np.memmap(buffers_path, dtype=np.uint8, mode='r')
+    else:
+        blob = np.fromfile(buffers_path, dtype=np.uint8)
+    pipe = pickle.loads(structure, buffers=[blob[start:start + size] for start, size in offsets])
+
+    internal = ('pca_arrays', 'pipeline', 'pipeline_buffers', 'pipeline_offsets', 'format_version')
+    artifacts = {key: value for key, value in manifest.items() if key not in internal}
+    artifacts['pca'] = MappedPCA(arrays['components'], arrays['mean'], arrays.get('explained_variance'))
+    return pipe, artifacts
+
+
+def convert(model_path, artifacts_path, directory):
+    """Rewrite a pickled model + artifacts pair in this format"""
+    import pickle
+
+    with open(model_path, 'rb') as f:
+        pipe = pickle.load(f)
+    with open(artifacts_path, 'rb') as f:
+        artifacts = pickle.load(f)
+    return save(directory, pipe, artifacts)
+
+
+def main():
+    import argparse
+
+    from predict import ARTIFACT_DIR, ARTIFACTS_PATH, MODEL_PATH
+
+    parser = argparse.ArgumentParser(description="Convert the pickled model and artifacts to the memory-mappable format")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--artifacts", default=ARTIFACTS_PATH)
+    parser.add_argument("-o", "--output", default=ARTIFACT_DIR)
+    args = parser.parse_args()
+    manifest = convert(args.model, args.artifacts, args.output)
+    print(f"Wrote {args.output} (pca_version {manifest['pca_version']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+"""End-to-end benchmarks, run offline against kalshi_stub.py.
+
+    python benchmark.py                                   # every suite, default sizes
+    python benchmark.py --suites crawl --sizes 1000 20000 --latency 0.05
+    python benchmark.py --baseline last_run.json          # flag regressions against an earlier run
+
+Suites:
+    crawl    data_collection.py's sync loop, crawler.py's single cursor chain
+             and its per-series sharded crawl, paging through a stub server
+             (generated markets, or --recording) that adds --latency to
+             every response; markets per second
+    poll     volume_poller.py polling open stub markets into a snapshot
+             store, with 5% of them trading between polls; markets per
+             second and bytes stored per poll
+    predict  predict.py: single-market latency with a cold and a warm
+             embedding cache, bulk Predictor.predict_records and
+             predict_file throughput
+    web      Front-edn/page.py through Flask's test client: POST /predict
+             with the stub LLM, GET /compare/<id> over an Arrow comparison
+             dataset (and title index) of each size
+    startup  fresh interpreters: how long `import predict` and `import page`
+             take, and how long until the first prediction / first /predict
+             response (cold start for a CLI run or a new worker)
+
+predict, web and startup need a trained model: predict.py's default paths, or
+--model/--artifacts, or --train to fit a small one on the stub markets
+first (needs sentence_transformers).
+
+Results are written to --output as JSON, one entry per (suite, name, size)
+with its metrics, plus the git commit and machine they were measured on.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import data_collection
+import kalshi_stub
+import market_io
+import predict
+from series_cache import SeriesCache
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+SUITES = ("crawl", "poll", "predict", "web", "startup")
+DEFAULT_SIZES = (1000, 10000)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hide the per-page / per-request prints of the code being timed"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def latency_stats(seconds):
+    samples = np.asarray(seconds) * 1000
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {
+        "n": len(samples),
+        "mean_ms": float(samples.mean()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+    }
+
+
+def result(suite, name, size, **metrics):
+    entry = {"suite": suite, "name": name, "size": size}
+    entry.update(metrics)
+    print(f"{suite:8} {name:24} {size:>8}  " + ", ".join(
+        f"{key} {value:.4g}" if isinstance(value, float) else f"{key} {value}" for key, value in metrics.items()))
+    return entry
+
+
+def stub_markets(size, recording=None):
+    if recording:
+        markets, series = kalshi_stub.load_recording(recording)
+        return markets[:size], series
+    return kalshi_stub.generate_markets(size)
+
+
+def crawl_to_file(markets, series, path):
+    """Write the rows the crawler would produce for markets to a crawl output file"""
+    data_collection.SERIES_CACHE = SeriesCache()
+    data_collection.SERIES_CACHE.put_many([(t, s.get("category"), s.get("frequency")) for t, s in series.items()])
+    with market_io.open_sink(path) as sink:
+        for start in range(0, len(markets), 1000):
+            sink.write_page(data_collection.page_rows(data_collection.parse_markets_page(markets[start:start + 1000])))
+    return path
+
+
+def bench_crawl(sizes, latency=0.0, rate=10.0, recording=None):
+    import crawler
+
+    results = []
+    base_url = data_collection.BASE_URL
+    for size in sizes:
+        markets, series = stub_markets(size, recording)
+        with kalshi_stub.StubServer(markets, series, latency=latency) as server:
+            for mode in ("sync", "async", "sharded"):
+                # A fresh in-memory series cache, so both modes pay for the lookups
+                data_collection.SERIES_CACHE = SeriesCache()
+                data_collection.BASE_URL = server.base_url
+                crawl_params = dict(data_collection.params)
+                crawled = []
+
+                def on_page(columns, next_cursor, series_ticker=None):
+                    crawled.append(len(columns["full_ticker"]))
+
+                requests_before = server.request_count
+                started = time.perf_counter()
+                with quiet():
+                    if mode == "sync":
+                        data_collection.fetch_markets_sync(crawl_params, base_url=server.base_url, on_page=on_page)
+                    elif mode == "async":
+                        crawler.crawl(crawl_params, base_url=server.base_url, rate=rate, on_page=on_page)
+                    else:
+                        crawler.crawl_sharded(crawl_params, base_url=server.base_url, rate=rate, on_page=on_page)
+                seconds = time.perf_counter() - started
+                results.append(result(
+                    "crawl", f"crawl_{mode}", len(markets),
+                    seconds=seconds,
+                    markets_per_s=sum(crawled) / seconds,
+                    pages=len(crawled),
+                    requests=server.request_count - requests_before,
+                ))
+    data_collection.BASE_URL = base_url
+    return results
+
+
+def bench_poll(sizes, work_dir, latency=0.0, rate=10.0, polls=5):
+    import asyncio
+    import random
+
+    import volume_poller
+    from crawler import AsyncCrawler
+    from snapshot_store import SnapshotStore
+
+    results = []
+    rng = random.Random(0)
+    for size in sizes:
+        markets, series = kalshi_stub.generate_markets(size, status="open")
+        store_dir = os.path.join(work_dir, f"snapshots_{size}")
+        shutil.rmtree(store_dir, ignore_errors=True)
+        store = SnapshotStore(store_dir)
+        with kalshi_stub.StubServer(markets, series, latency=latency) as server:
+
+            async def poll():
+                seconds = []
+                async with AsyncCrawler(server.base_url, rate=rate) as crawler:
+                    for _ in range(polls):
+                        server.trade(size // 20, rng)
+                        started = time.perf_counter()
+                        await volume_poller.poll_once(crawler, store)
+                        seconds.append(time.perf_counter() - started)
+                return seconds
+
+            # The first poll stores every market, the rest only what traded
+            seconds = asyncio.run(poll())
+        store.close()
+        stats = store.stats()
+        results.append(result(
+            "poll", "poll_open_markets", size,
+            seconds=float(np.mean(seconds[1:] or seconds)),
+            markets_per_s=size / float(np.mean(seconds[1:] or seconds)),
+            bytes_per_poll=stats["bytes"] / polls,
+            records=stats["records_written"],
+        ))
+    return results
+
+
+def bench_predict(predictor, sizes, work_dir, recording=None, n_single=200):
+    results = []
+    with quiet():
+        predictor.warm_up()
+    markets, series = stub_markets(max(sizes), recording)
+    rows = list(market_io.iter_rows(crawl_to_file(markets, series, os.path.join(work_dir, "predict_input.arrow"))))
+    run = time.time_ns()
+
+    # Unique titles miss the embedding cache and pay for the sentence model; repeats hit it
+    for name, title in (("single_cold_cache", None), ("single_warm_cache", rows[0]["title"])):
+        samples = []
+        for i in range(n_single):
+            row = dict(rows[i % len(rows)], title=title or f"{rows[i % len(rows)]['title']} ({run}-{i})")
+            started = time.perf_counter()
+            predictor.predict_records([row])
+            samples.append(time.perf_counter() - started)
+        results.append(result("predict", name, 1, **latency_stats(samples)))
+
+    for size in sizes:
+        batch = [dict(row, title=f"{row['title']} ({run}-{size})") for row in rows[:size]]
+        started = time.perf_counter()
+        predictor.predict_records(batch)
+        seconds = time.perf_counter() - started
+        results.append(result("predict", "bulk_records", len(batch), seconds=seconds, markets_per_s=len(batch) / seconds))
+
+        input_path = os.path.join(work_dir, f"predict_{size}.ndjson")
+        with market_io.open_sink(input_path) as sink:
+            sink.write_page(batch)
+        output_path = os.path.join(work_dir, f"predicted_{size}.arrow")
+        started = time.perf_counter()
+        with quiet():
+            written = predict.predict_file(input_path, output_path, model_path=predictor.model_path,
+                                           artifacts_path=predictor.artifacts_path)
+        seconds = time.perf_counter() - started
+        results.append(result("predict", "predict_file", written, seconds=seconds, markets_per_s=written / seconds))
+    return results
+
+
+def comparison_dataset(markets, series, path):
+    """Crawl rows shaped like the web app's data2 events (integer id, series)"""
+    rows = list(market_io.iter_rows(crawl_to_file(markets, series, path + ".crawl.arrow")))
+    for i, row in enumerate(rows):
+        row["id"] = i
+        row["series"] = row["series_ticker"]
+    with market_io.open_sink(path, columns=None) as sink:
+        for start in range(0, len(rows), 10000):
+            sink.write_page(rows[start:start + 10000])
+    os.remove(path + ".crawl.arrow")
+    return rows
+
+
+def bench_web(predictor, sizes, work_dir, recording=None, n_requests=200, llm_latency=0.0, title_index=True):
+    import vector_index
+
+    os.environ.update({
+        "LLM_BACKEND": "stub",
+        "LLM_STUB_LATENCY": str(llm_latency),
+        "CLASSIFICATION_CACHE_PATH": "",
+        "VOLUME_MODEL_PATH": predictor.model_path,
+        "VOLUME_ARTIFACTS_PATH": predictor.artifacts_path,
+        "DATA_FILE": os.path.join(work_dir, "empty.arrow"),
+        "VECTOR_INDEX_DIR": os.path.join(work_dir, "no_index"),
+    })
+    os.environ.pop("PREDICTION_STORE_PATH", None)
+    front_end = os.path.join(ROOT_DIR, "Front-edn")
+    if front_end not in sys.path:
+        sys.path.insert(0, front_end)
+    with quiet():
+        import page
+        from event_store import EventStore
+        page.warm_up()
+    client = page.app.test_client()
+    rng = np.random.default_rng(0)
+    run = time.time_ns()
+
+    results = []
+    for size in sizes:
+        markets, series = stub_markets(size, recording)
+        data_path = os.path.join(work_dir, f"events_{size}.arrow")
+        rows = comparison_dataset(markets, series, data_path)
+        page.event_store = EventStore(data_path, overlay=page.prediction_store)
+        page.title_index = None
+        if title_index:
+            with quiet():
+                page.title_index = vector_index.update_from_file(
+                    data_path, page.inference.predictor, os.path.join(work_dir, f"index_{size}"))
+
+        samples = []
+        for i in range(n_requests):
+            topic = f"Will {rows[i % len(rows)]['title']} happen? ({run}-{size}-{i})"
+            started = time.perf_counter()
+            with quiet():
+                response = client.post("/predict", data={"topic": topic, "duration": "86400"})
+            samples.append(time.perf_counter() - started)
+            assert response.get_json().get("result") == "Success", response.get_json()
+        results.append(result("web", "predict", len(rows), **latency_stats(samples)))
+
+        samples = []
+        for event_id in rng.integers(0, len(rows), n_requests):
+            started = time.perf_counter()
+            with quiet():
+                response = client.get(f"/compare/{event_id}")
+            samples.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.status_code
+        results.append(result("web", "compare", len(rows), **latency_stats(samples)))
+    return results
+
+
+# Run in a fresh interpreter by bench_startup; prints the stage timings as JSON
+STARTUP_SCRIPTS = {
+    "predict": """
+import json, sys, time
+started = time.perf_counter()
+import predict
+imported = time.perf_counter()
+predict.Predictor(sys.argv[1], sys.argv[2]).predict_records([{"title": "Will it rain in London tomorrow?",
+    "duration": 86400.0, "can_close_early": False, "category": "Climate and Weather", "frequency": "daily"}])
+print(json.dumps({"import": imported - started, "first_result": time.perf_counter() - started}))
+""",
+    "page": """
+import contextlib, io, json, time
+started = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    import page
+    imported = time.perf_counter()
+    response = page.app.test_client().post("/predict", data={"topic": "Will it rain in London tomorrow?", "duration": "86400"})
+assert response.get_json().get("result") == "Success", response.get_json()
+print(json.dumps({"import": imported - started, "first_result": time.perf_counter() - started}))
+""",
+}
+
+
+def bench_startup(predictor, work_dir, runs=3):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join([ROOT_DIR, os.path.join(ROOT_DIR, "Front-edn")] +
+                                      ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])),
+        "LLM_BACKEND": "stub",
+        "CLASSIFICATION_CACHE_PATH": "",
+        "VOLUME_MODEL_PATH": os.path.abspath(predictor.model_path),
+        "VOLUME_ARTIFACTS_PATH": os.path.abspath(predictor.artifacts_path),
+        "DATA_FILE": os.path.join(work_dir, "empty.arrow"),
+        "VECTOR_INDEX_DIR": os.path.join(work_dir, "no_index"),
+    })
+    env.pop("PREDICTION_STORE_PATH", None)
+    env.pop("WEB_PRELOAD", None)
+
+    results = []
+    for name, script in STARTUP_SCRIPTS.items():
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            output = subprocess.run(
+                [sys.executable, "-c", script, env["VOLUME_MODEL_PATH"], env["VOLUME_ARTIFACTS_PATH"]],
+                cwd=work_dir, env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            timing = json.loads(output.strip().splitlines()[-1])
+            timing["process"] = time.perf_counter() - started
+            timings.append(timing)
+        results.append(result(
+            "startup", name, runs,
+            import_s=min(t["import"] for t in timings),
+            first_result_s=min(t["first_result"] for t in timings),
+            process_s=min(t["process"] for t in timings),
+        ))
+    return results
+
+
+def train_model(work_dir, size, recording=None):
+    """Fit a small model on stub markets; returns (model_path, artifacts_dir)"""
+    import model
+
+    markets, series = stub_markets(size, recording)
+    data_path = crawl_to_file(markets, series, os.path.join(work_dir, "train.arrow"))
+    model_path = os.path.join(work_dir, predict.MODEL_PATH)
+    artifact_dir = os.path.join(work_dir, predict.ARTIFACT_DIR)
+    with quiet():
+        model.train(
+            data_path,
+            model_path=model_path,
+            artifacts_path=os.path.join(work_dir, predict.ARTIFACTS_PATH),
+            artifact_dir=artifact_dir,
+            cache_dir=os.path.join(work_dir, "train_cache"),
+            models_dir=os.path.join(work_dir, "models"),
+            max_iter=100,
+        )
+    return model_path, artifact_dir
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Print how results changed against a baseline run; returns the regressions"""
+    previous = {(r["suite"], r["name"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    for entry in results:
+        old = previous.get((entry["suite"], entry["name"], entry["size"]))
+        if old is None:
+            continue
+        for key, value in entry.items():
+            if not isinstance(value, float) or not old.get(key):
+                continue
+            if key.endswith("_per_s"):
+                slower = old[key] / value - 1 if value else float("inf")
+            elif key.endswith(("_ms", "_s")) or key == "seconds":
+                slower = value / old[key] - 1
+            else:
+                continue
+            flag = ""
+            if slower > tolerance:
+                regressions.append((entry["suite"], entry["name"], entry["size"], key, old[key], value))
+                flag = "  REGRESSION"
+            print(f"{entry['suite']:8} {entry['name']:24} {entry['size']:>8}  {key:14} "
+                  f"{old[key]:10.4g} -> {value:10.4g} ({-slower:+.0%}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark crawling, polling, prediction and the web app against the Kalshi stub")
+    parser.add_argument("--suites", nargs="+", choices=SUITES, default=list(SUITES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES), help="markets per dataset")
+    parser.add_argument("--recording", help="replay markets saved by kalshi_stub.py --record instead of generated ones")
+    parser.add_argument("--latency", type=float, default=0.0, help="stub API delay per response, seconds")
+    parser.add_argument("--rate", type=float, default=10.0, help="crawler.py requests per second")
+    parser.add_argument("--requests", type=int, default=200, help="samples per latency measurement")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="stub LLM delay for /predict, seconds")
+    parser.add_argument("--startup-runs", type=int, default=3, help="fresh interpreters per startup measurement (best is kept)")
+    parser.add_argument("--no-title-index", action="store_true", help="compare by volume only in the web suite")
+    parser.add_argument("--model", default=predict.MODEL_PATH)
+    parser.add_argument("--artifacts", default=predict.default_artifacts_path())
+    parser.add_argument("--train", action="store_true", help="train a small model on stub markets instead")
+    parser.add_argument("--train-size", type=int, default=5000)
+    parser.add_argument("--work-dir", help="keep datasets and models here (default: a temporary directory)")
+    parser.add_argument("-o", "--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="earlier --output file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="kalshi_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    sizes = sorted(set(args.sizes))
+    results = []
+    try:
+        if "crawl" in args.suites:
+            results += bench_crawl(sizes, latency=args.latency, rate=args.rate, recording=args.recording)
+        if "poll" in args.suites:
+            results += bench_poll(sizes, work_dir, latency=args.latency, rate=args.rate)
+
+        if {"predict", "web", "startup"} & set(args.suites):
+            model_path, artifacts_path = args.model, args.artifacts
+            if args.train:
+                print(f"Training a model on {args.train_size} stub markets")
+                model_path, artifacts_path = train_model(work_dir, args.train_size, args.recording)
+            predictor = predict.Predictor(model_path, artifacts_path,
+                                          embedding_cache_dir=os.path.join(work_dir, "embedding_cache"))
+            if "predict" in args.suites:
+                results += bench_predict(predictor, sizes, work_dir, args.recording, n_single=args.requests)
+            if "web" in args.suites:
+                results += bench_web(predictor, sizes, work_dir, args.recording, n_requests=args.requests,
+                                     llm_latency=args.llm_latency, title_index=not args.no_title_index)
+            if "startup" in args.suites:
+                results += bench_startup(predictor, work_dir, runs=args.startup_runs)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        print(f"{len(regressions)} regressions beyond {args.tolerance:.0%}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
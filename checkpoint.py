@@ -0,0 +1,122 @@
+"""Crawl checkpointing so a failed or killed crawl can pick up where it stopped.
+
+Two files sit next to the output:
+    <output>.checkpoint         small JSON state: query params, next cursor, spool size
+    <output>.checkpoint.ndjson  every market row collected so far, one JSON object per line
+
+When the output is itself NDJSON the rows are appended straight to it and
+no separate spool is kept.
+
+A sharded crawl (one cursor chain per series, see crawler.py) keeps a cursor
+per shard in the state instead of the single one, and on resume only the
+shards that hadn't finished are walked again, each from its own cursor.
+
+Each page is appended to the spool and fsynced before the state is replaced
+(write to a temp file + os.replace), so the state never points past data
+that made it to disk. On resume the spool is truncated back to the size the
+state recorded, dropping any half-written page from the crash.
+"""
+import json
+import os
+
+
+class CrawlCheckpoint:
+
+    def __init__(self, output_path, spool_path=None):
+        self.state_path = output_path + ".checkpoint"
+        self.spool_path = spool_path or output_path + ".checkpoint.ndjson"
+        self.state = None
+
+    def load(self):
+        """The saved state dict, or None if there is no unfinished crawl"""
+        try:
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.state = None
+            return None
+
+        # Drop anything appended after the last state write
+        if os.path.exists(self.spool_path):
+            with open(self.spool_path, "r+b") as f:
+                f.truncate(self.state["spool_bytes"])
+        return self.state
+
+    def matches(self, params):
+        """True if the saved crawl was started with the same query (ignoring cursor)"""
+        if self.state is None:
+            return False
+        return _without_cursor(self.state["params"]) == _without_cursor(params)
+
+    def start(self, params, keep_existing=False):
+        """Begin a new crawl; keep_existing appends after rows already in the spool"""
+        with open(self.spool_path, "a" if keep_existing else "w") as f:
+            spool_bytes = f.tell()
+        self.state = {
+            "params": _without_cursor(params),
+            "cursor": None,
+            "pages": 0,
+            "markets": 0,
+            "spool_start": spool_bytes,
+            "spool_bytes": spool_bytes,
+        }
+        self._write_state()
+
+    def set_shards(self, shards):
+        """Record the shards of a sharded crawl, none of them started yet"""
+        self.state["shards"] = {shard: {"cursor": None, "done": False} for shard in shards}
+        self._write_state()
+
+    def pending_shards(self):
+        """shard -> cursor to resume from, for every shard that hasn't finished"""
+        return {shard: s["cursor"] for shard, s in (self.state.get("shards") or {}).items() if not s["done"]}
+
+    def finish_shard(self, shard):
+        self.state["shards"][shard] = {"cursor": None, "done": True}
+        self._write_state()
+
+    def append_page(self, rows, next_cursor, shard=None):
+        """Persist one page of market dicts and the cursor for the page after it (in shard, if sharded)"""
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(row, allow_nan=False) + "\n" for row in rows))
+            f.flush()
+            os.fsync(f.fileno())
+            spool_bytes = f.tell()
+
+        if shard is None:
+            self.state["cursor"] = next_cursor
+        else:
+            self.state["shards"][shard]["cursor"] = next_cursor
+        self.state["pages"] += 1
+        self.state["markets"] += len(rows)
+        self.state["spool_bytes"] = spool_bytes
+        self._write_state()
+
+    def iter_rows(self):
+        """Every market dict this crawl has spooled so far, in crawl order"""
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, "r", encoding="utf-8") as f:
+            f.seek(self.state.get("spool_start", 0))
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def clear(self, keep_spool=False):
+        paths = [self.state_path] if keep_spool else [self.state_path, self.spool_path]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.state = None
+
+    def _write_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+
+def _without_cursor(params):
+    return {k: v for k, v in params.items() if k != "cursor" and v is not None}
@@ -0,0 +1,339 @@
+"""Asyncio crawler for the Kalshi /markets endpoint.
+
+Pages are cursor-chained so they are still requested one after another, but
+the request for page N+1 is in flight while the series lookups for page N run
+concurrently. Every request goes through one pooled aiohttp session and a
+shared token bucket, and 429/5xx responses are retried with backoff.
+
+A single cursor chain never has more than one page in flight. The sharded
+crawl (crawl_sharded) lists every series from /series first and gives each
+one its own chain (/markets?series_ticker=...), walked by a pool of worker
+tasks. All workers share the session and the token bucket, so the rate
+limit stays global. A shard that still fails after the per-request retries
+is retried from its last cursor, and markets are de-duplicated by
+full_ticker across shards. Markets of series missing from /series are not
+reached this way.
+"""
+import asyncio
+import random
+import time
+
+import aiohttp
+import numpy as np
+
+import data_collection
+import metrics
+from data_collection import BASE_URL, ENDPOINT, lookup_series, page_rows, parse_markets_page
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average with bursts up to `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncCrawler:
+    """Pooled, rate-limited client for the markets and series endpoints"""
+
+    def __init__(self, base_url=BASE_URL, rate=10.0, burst=None, max_connections=20,
+                 max_retries=5, backoff=0.5, max_backoff=30.0, timeout=30.0, series_cache=None):
+        """series_cache defaults to data_collection.SERIES_CACHE as it is at construction"""
+        self.base_url = base_url.rstrip("/")
+        self.series_cache = series_cache if series_cache is not None else data_collection.SERIES_CACHE
+        self.bucket = TokenBucket(rate, burst)
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = None
+        self.request_count = 0
+        self.retry_count = 0
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def _retry_delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(self.max_backoff, float(retry_after))
+            except ValueError:
+                pass
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def get_json(self, path, params=None):
+        """GET base_url + path, retrying 429/5xx and connection errors"""
+        url = self.base_url + path
+        if params:
+            # aiohttp refuses None values, the API treats missing and empty the same
+            params = {k: v for k, v in params.items() if v is not None}
+
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            self.request_count += 1
+            metrics.inc("crawl.requests")
+            try:
+                # Timed from the request leaving the token bucket to the parsed body
+                with metrics.timer("crawl.http_fetch"):
+                    async with self.session.get(url, params=params) as response:
+                        retry = response.status in RETRY_STATUSES and attempt < self.max_retries
+                        if not retry:
+                            response.raise_for_status()
+                            return await response.json()
+                        retry_after = response.headers.get("Retry-After")
+                self.retry_count += 1
+                metrics.inc("crawl.retries")
+                await asyncio.sleep(self._retry_delay(attempt, retry_after))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.max_retries:
+                    raise
+                self.retry_count += 1
+                metrics.inc("crawl.retries")
+                await asyncio.sleep(self._retry_delay(attempt))
+
+    def lookup_series(self, series_ticker):
+        """Blocking cache-then-API lookup against this crawler's cache and base URL"""
+        return lookup_series(series_ticker, cache=self.series_cache, base_url=self.base_url)
+
+    async def fetch_series(self, series_ticker):
+        with metrics.timer("crawl.series_lookup"):
+            data = await self.get_json(f"/series/{series_ticker}")
+        series = data.get("series") or {}
+        return series.get("category"), series.get("frequency")
+
+    async def list_series(self):
+        """Every series from the /series list endpoint, also stored in the series cache; raises on failure"""
+        data = await self.get_json("/series")
+        rows = [
+            (s.get("ticker"), s.get("category"), s.get("frequency"))
+            for s in data.get("series") or []
+            if s.get("ticker")
+        ]
+        self.series_cache.put_many(rows)
+        return [ticker for ticker, _, _ in rows]
+
+    async def warm_series_cache(self):
+        """Bulk-load every series from the /series list endpoint in one request"""
+        try:
+            return len(await self.list_series())
+        except aiohttp.ClientError as e:
+            print(f"Series list unavailable, falling back to per-series lookups: {e}")
+            return 0
+
+    async def prefetch_series(self, series_tickers):
+        """Look up every series not in the series cache concurrently and store the results"""
+        cache = self.series_cache
+        missing = sorted({t for t in series_tickers if t not in cache})
+        if not missing:
+            return
+        results = await asyncio.gather(*(self.fetch_series(t) for t in missing), return_exceptions=True)
+        found = []
+        for ticker, result in zip(missing, results):
+            if isinstance(result, Exception):
+                print(f"Series lookup failed for {ticker}: {result}")
+                # Remember the failure for this run only so Market doesn't retry synchronously
+                cache.put(ticker, None, None, persist=False)
+            else:
+                found.append((ticker, *result))
+        cache.put_many(found)
+
+    async def pages(self, params, max_pages=1500, verbose=True, parse=None):
+        """Yield (columns, next_cursor) for each /markets page; request errors are raised.
+
+        parse(markets) replaces parse_markets_page, and then series aren't looked up.
+        """
+        params = dict(params)
+        page_counter = 0
+        next_page = asyncio.ensure_future(self.get_json(ENDPOINT, params))
+
+        try:
+            while next_page is not None:
+                page_counter += 1
+                try:
+                    data = await next_page
+                except aiohttp.ClientError as e:
+                    if verbose:
+                        print(f"An error occurred during API request: {e}")
+                    raise
+                next_page = None
+
+                markets_on_this_page = data.get("markets", [])
+                if not markets_on_this_page:
+                    if verbose:
+                        print("No markets found on this page.")
+                    break
+
+                next_cursor = data.get("cursor")
+                if next_cursor and page_counter < max_pages:
+                    # Start on the next page while this page's series are looked up
+                    params["cursor"] = next_cursor
+                    next_page = asyncio.ensure_future(self.get_json(ENDPOINT, dict(params)))
+
+                if parse is None:
+                    await self.prefetch_series(m.get("ticker", "").split("-", 1)[0] for m in markets_on_this_page)
+
+                if verbose:
+                    print(f"Page {page_counter}: received {len(markets_on_this_page)} markets. Next cursor: {next_cursor}")
+                if parse is None:
+                    yield parse_markets_page(markets_on_this_page, lookup=self.lookup_series), next_cursor
+                else:
+                    yield parse(markets_on_this_page), next_cursor
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+
+async def crawl_async(params, base_url=BASE_URL, max_pages=1500, warm_series=True, on_page=None, **crawler_kwargs):
+    """Crawl every page; on_page(columns, next_cursor) gets each parsed page, otherwise rows are returned"""
+    market_list = []
+    async with AsyncCrawler(base_url, **crawler_kwargs) as crawler:
+        if warm_series and len(crawler.series_cache) == 0:
+            print(f"Series cache empty, warmed {await crawler.warm_series_cache()} series from /series")
+        async for page, next_cursor in crawler.pages(params, max_pages=max_pages):
+            if on_page is not None:
+                on_page(page, next_cursor)
+            else:
+                market_list.extend(page_rows(page))
+        print(f"{crawler.request_count} requests made, {crawler.retry_count} retried")
+    return market_list
+
+
+def crawl(params, base_url=BASE_URL, max_pages=1500, **crawler_kwargs):
+    """Blocking wrapper around crawl_async for scripts"""
+    return asyncio.run(crawl_async(params, base_url=base_url, max_pages=max_pages, **crawler_kwargs))
+
+
+def drop_seen(columns, seen):
+    """The page without markets whose full_ticker is in seen (which is updated with the rest)"""
+    keep = np.ones(len(columns["full_ticker"]), dtype=bool)
+    for i, ticker in enumerate(columns["full_ticker"].tolist()):
+        if ticker in seen:
+            keep[i] = False
+        else:
+            seen.add(ticker)
+    if keep.all():
+        return columns
+    return {field: values[keep] for field, values in columns.items()}
+
+
+async def crawl_sharded_async(params, base_url=BASE_URL, max_pages=1500, shards=None, workers=8, shard_retries=3,
+                              seen=None, on_shards=None, on_page=None, on_shard_done=None, **crawler_kwargs):
+    """Crawl one cursor chain per series with `workers` chains in flight.
+
+    shards maps series_ticker -> cursor to start from (None for the first
+    page), e.g. the unfinished shards of a checkpoint; by default every
+    series from /series, which are passed to on_shards(tickers) first.
+    max_pages is per shard. on_page(columns, next_cursor, series_ticker) gets
+    each page with markets already in `seen` dropped; without it the rows are
+    returned. on_shard_done(series_ticker) is called as each chain finishes.
+    Shards that fail shard_retries times are skipped, and an error naming
+    them is raised once every other shard is done.
+    """
+    seen = seen if seen is not None else set()
+    market_list = []
+    failed = {}
+    started = time.monotonic()
+
+    async with AsyncCrawler(base_url, **crawler_kwargs) as crawler:
+        if shards is None:
+            tickers = await crawler.list_series()
+            print(f"Sharding the crawl over {len(tickers)} series from /series")
+            if on_shards is not None:
+                on_shards(tickers)
+            shards = dict.fromkeys(tickers)
+        elif len(crawler.series_cache) == 0:
+            print(f"Series cache empty, warmed {await crawler.warm_series_cache()} series from /series")
+
+        queue = asyncio.Queue()
+        for shard in shards.items():
+            queue.put_nowait(shard)
+        progress = {"shards": 0, "pages": 0, "markets": 0}
+
+        async def crawl_shard(series_ticker, cursor):
+            pages = markets = 0
+            for attempt in range(shard_retries + 1):
+                if pages >= max_pages:
+                    break
+                shard_params = dict(params, series_ticker=series_ticker, cursor=cursor)
+                try:
+                    async for page, next_cursor in crawler.pages(shard_params, max_pages=max_pages - pages, verbose=False):
+                        page = drop_seen(page, seen)
+                        if on_page is not None:
+                            on_page(page, next_cursor, series_ticker)
+                        else:
+                            market_list.extend(page_rows(page))
+                        cursor = next_cursor
+                        pages += 1
+                        markets += len(page["full_ticker"])
+                        progress["pages"] += 1
+                        progress["markets"] += len(page["full_ticker"])
+                    return pages, markets
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == shard_retries:
+                        raise
+                    metrics.inc("crawl.shard_retries")
+                    print(f"Shard {series_ticker}: {e}, retry {attempt + 1}/{shard_retries} after page {pages}")
+                    await asyncio.sleep(crawler._retry_delay(attempt))
+            return pages, markets
+
+        async def worker():
+            while not queue.empty():
+                series_ticker, cursor = queue.get_nowait()
+                try:
+                    pages, markets = await crawl_shard(series_ticker, cursor)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    failed[series_ticker] = e
+                    print(f"Shard {series_ticker} failed after {shard_retries} retries: {e}")
+                    continue
+                if on_shard_done is not None:
+                    on_shard_done(series_ticker)
+                progress["shards"] += 1
+                print(f"[{progress['shards']}/{len(shards)}] {series_ticker}: {pages} pages, {markets} markets "
+                      f"({progress['markets']} total, {progress['markets'] / (time.monotonic() - started):.0f}/s)")
+
+        tasks = [asyncio.ensure_future(worker()) for _ in range(max(1, workers))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Anything other than a network error (e.g. from on_page) stops the crawl; the other
+            # workers are cancelled and awaited so none is still using the session when it closes
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        print(f"{crawler.request_count} requests made, {crawler.retry_count} retried")
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(shards)} shards failed: {', '.join(sorted(failed)[:10])}")
+    return market_list
+
+
+def crawl_sharded(params, base_url=BASE_URL, max_pages=1500, **crawler_kwargs):
+    """Blocking wrapper around crawl_sharded_async for scripts"""
+    return asyncio.run(crawl_sharded_async(params, base_url=base_url, max_pages=max_pages, **crawler_kwargs))
@@ -1,15 +1,24 @@
+import argparse
+import calendar
+import os
+import sys
 import requests
-import json
-from datetime import datetime
 import time
 
+import numpy as np
+
+import market_io
+import metrics
+from checkpoint import CrawlCheckpoint
+from series_cache import SeriesCache
+
 BASE_URL = "https://api.elections.kalshi.com/trade-api/v2"
 ENDPOINT = "/markets"
 URL = BASE_URL + ENDPOINT
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
-global SERIES_IDs
-SERIES_IDs = {}
+# series_ticker -> (category, frequency). main() swaps this for an on-disk cache
+SERIES_CACHE = SeriesCache()
 
 params = {
     "status": "settled",
@@ -22,70 +31,33 @@ params = {
 
 
 class Market:
+    """One market as a compact per-row record; the crawler itself uses parse_markets_page"""
 
+    __slots__ = (
+        "full_ticker", "series_ticker", "event_ticker", "outcome", "title",
+        "open_time", "close_time", "duration", "can_close_early", "volume",
+        "settlement_price", "category", "frequency",
+    )
 
-
-
-    
     def __init__(self, market):
 
         ticker_str = market.get("ticker")
-        close_time_str = market.get("close_time").split(".")[0]
-        open_time_str = market.get("open_time").split(".")[0]
-        self.settlement_price = market.get("settlement_value")
         self.title = market.get("title", "N/A")
         self.volume = market.get("volume")
         self.can_close_early = market.get("can_close_early")
+        self.settlement_price = market.get("settlement_value", market.get("settlement_price"))
 
-        #print ("close", close_time_str.rstrip('Z'))
-        #print("open", open_time_str.rstrip('Z'))
-
-
-
-        close_time_dt = datetime.strptime(close_time_str.rstrip('Z'), DATE_FORMAT)
-        self.close_time = close_time_dt.timestamp()
-        open_time_dt = datetime.strptime(open_time_str.rstrip('Z'), DATE_FORMAT)
-        self.open_time = open_time_dt.timestamp()
-        
-
-        self.duration = self.close_time-self.open_time
+        self.close_time = parse_time(market.get("close_time"))
+        self.open_time = parse_time(market.get("open_time"))
+        self.duration = self.close_time - self.open_time
 
-
-        self.settlement_price = market.get("settlement_price")
-        
-        self.title = market.get("title", "N/A")
-        
         parts = ticker_str.split('-', 2)
-
-
-        try:
-            self.series_ticker = parts[0]
-        except:
-            self.series_ticker =""
-
-        if self.series_ticker not in SERIES_IDs:
-            response = requests.get(f"https://api.elections.kalshi.com/trade-api/v2/series/{self.series_ticker}")
-            response.raise_for_status()
-            data = response.json()
-            series = data.get("series", [])
-
-            SERIES_IDs[self.series_ticker] = (series.get("category"), series.get("frequency"))
-            
-
-        self.category, self.frequency = SERIES_IDs[self.series_ticker]
-
-
-        try:
-            self.event_ticker = parts[1]
-        except:
-            self.event_ticker =""
-
-        try:
-            self.outcome = parts[2]
-        except:
-            self.outcome =""
+        parts += [""] * (3 - len(parts))
+        self.series_ticker, self.event_ticker, self.outcome = parts
         self.full_ticker = ticker_str
 
+        self.category, self.frequency = lookup_series(self.series_ticker)
+
 
     def to_dict(self):
         return{
@@ -95,6 +67,7 @@ class Market:
             "outcome": self.outcome,
             "title": self.title,
             "duration": self.duration,
+            "close_time": self.close_time,
             "can_close_early": self.can_close_early,
             "final_volume": self.volume,
             "settlement_price": self.settlement_price,
@@ -102,64 +75,337 @@ class Market:
             "frequency": self.frequency
         }
 
-print(f"Attemping to fetch data from {URL}")
 
-market_list = []
-skipped = 0
-counter = 0
-page_counter = 0
-while True:
-    page_counter += 1
-    print(f"\n--- Requesting Page {page_counter}. Markets fetched so far: {len(market_list)} ---")
-    
-    try:
-        response = requests.get(URL, params=params)
+# Key order of Market.to_dict(), which is also the column order of a parsed page
+MARKET_FIELDS = [
+    "full_ticker", "series_ticker", "event_ticker", "outcome", "title", "duration", "close_time",
+    "can_close_early", "final_volume", "settlement_price", "category", "frequency",
+]
+
+
+def parse_time(value):
+    """Epoch seconds (UTC) for an API timestamp like 2025-01-01T00:00:00.000Z"""
+    return float(calendar.timegm(time.strptime(value[:19], DATE_FORMAT)))
+
+
+def parse_times(values):
+    """Vectorised parse_time: float epoch seconds, NaN where the timestamp is missing"""
+    # A fixed-width U19 array keeps just "YYYY-MM-DDTHH:MM:SS", dropping fractions and the Z
+    stamps = np.array([v or "NaT" for v in values], dtype="U19").astype("datetime64[s]")
+    seconds = stamps.astype(np.int64).astype(np.float64)
+    seconds[np.isnat(stamps)] = np.nan
+    return seconds
+
+
+def split_tickers(tickers):
+    """Split full tickers into series / event / outcome arrays in one pass each"""
+    series, _, rest = np.char.partition(tickers, "-").T
+    event, _, outcome = np.char.partition(rest, "-").T
+    return series, event, outcome
+
+
+def parse_markets_page(markets, lookup=None):
+    """Turn a /markets page into a dict of column arrays keyed by MARKET_FIELDS.
+
+    lookup(series_ticker) -> (category, frequency) defaults to lookup_series.
+    """
+    lookup = lookup or lookup_series
+    tickers = np.array([m.get("ticker") or "" for m in markets], dtype=str)
+    series, event, outcome = split_tickers(tickers)
+
+    close_time = parse_times([m.get("close_time") for m in markets])
+    open_time = parse_times([m.get("open_time") for m in markets])
+
+    # Each distinct series is looked up once and broadcast back over the page
+    unique_series, inverse = np.unique(series, return_inverse=True)
+    looked_up = [lookup(t) for t in unique_series.tolist()]
+    category = np.array([c for c, _ in looked_up], dtype=object)[inverse]
+    frequency = np.array([f for _, f in looked_up], dtype=object)[inverse]
+
+    return {
+        "full_ticker": tickers,
+        "series_ticker": series,
+        "event_ticker": event,
+        "outcome": outcome,
+        "title": np.array([m.get("title", "N/A") for m in markets], dtype=object),
+        "duration": close_time - open_time,
+        "close_time": close_time,
+        "can_close_early": np.array([m.get("can_close_early") for m in markets], dtype=object),
+        "final_volume": np.array([m.get("volume") for m in markets], dtype=object),
+        "settlement_price": np.array(
+            [m.get("settlement_value", m.get("settlement_price")) for m in markets], dtype=object),
+        "category": category,
+        "frequency": frequency,
+    }
+
+
+def parse_volumes(markets):
+    """(full_ticker, volume) arrays for a /markets page, skipping markets without a volume.
+
+    The cheap counterpart of parse_markets_page for volume_poller.py, which
+    needs no series lookups or times.
+    """
+    markets = [m for m in markets if m.get("ticker") and m.get("volume") is not None]
+    tickers = np.array([m["ticker"] for m in markets], dtype=str)
+    volumes = np.array([m["volume"] for m in markets], dtype=np.int64)
+    return tickers, volumes
+
+
+def page_rows(columns):
+    """Row dicts (same shape as Market.to_dict) from a parsed page, for the output sinks.
+
+    NaN (a missing timestamp) becomes None, which every sink writes as null.
+    """
+    values = []
+    for field in MARKET_FIELDS:
+        column = columns[field]
+        if column.dtype.kind == "f":
+            column = np.where(np.isnan(column), None, column)
+        values.append(column.tolist())
+    return [dict(zip(MARKET_FIELDS, row)) for row in zip(*values)]
+
+
+def lookup_series(series_ticker, cache=None, base_url=None):
+    """(category, frequency) for a series, from the cache or the API on a miss.
+
+    cache and base_url default to this module's SERIES_CACHE and BASE_URL.
+    """
+    cache = cache if cache is not None else SERIES_CACHE
+    cached = cache.get(series_ticker)
+    if cached is not None:
+        return cached
+
+    with metrics.timer("crawl.series_lookup"):
+        response = requests.get(f"{base_url or BASE_URL}/series/{series_ticker}")
         response.raise_for_status()
         data = response.json()
-    except requests.RequestException as e:
-        print(f"An error occurred during API request: {e}")
-        break
-
-    markets_on_this_page = data.get("markets", [])
-    if not markets_on_this_page:
-        print("No markets found on this page.")
-        break
-        
-    for market in markets_on_this_page:
-        m = Market(market)
-        market_list.append(m)
+    series = data.get("series", {})
 
-    next_cursor = data.get("cursor")
-    print(f"Received {len(markets_on_this_page)} markets. Next cursor: {next_cursor}")
-    
-    # Check if this is the final page
-    if page_counter == 1500:
-        break
+    cache.put(series_ticker, series.get("category"), series.get("frequency"))
+    return series.get("category"), series.get("frequency")
 
-    if not next_cursor:
-        print("\nPagination complete. No further cursor returned.")
-        break
-    
-    params["cursor"] = next_cursor
-    
-    #time.sleep(1)
-    time.sleep(0.2) 
 
-    print(f"\n Successfully retrieved {len(market_list)} settled market tickers.")
-    print("skipped:", skipped)
+def fetch_markets_sync(params, base_url=BASE_URL, max_pages=1500, on_page=None):
+    """Original blocking crawl: one page at a time with a fixed sleep between requests.
 
+    on_page(columns, next_cursor) is called with each parsed page (see
+    parse_markets_page); without it the rows are collected and returned.
+    Request errors are re-raised so a checkpointed crawl can be resumed
+    instead of looking finished.
+    """
+    market_list = []
+    page_counter = 0
+    while True:
+        page_counter += 1
+        print(f"\n--- Requesting Page {page_counter}. Markets fetched so far: {len(market_list)} ---")
 
-if market_list:
-    for i in range(0, 10):
-        print(f"{i+1}.  {(market_list[i]).full_ticker}")
-
-
-
-
-json_data_list = [m.to_dict() for m in market_list]
-next_cursor
-output_filename = "data.json"
-
-with open(output_filename, "w") as f:
-    json.dump(json_data_list, f, indent=4)
+        try:
+            with metrics.timer("crawl.http_fetch"):
+                response = requests.get(base_url + ENDPOINT, params=params)
+                response.raise_for_status()
+                data = response.json()
+        except requests.RequestException as e:
+            print(f"An error occurred during API request: {e}")
+            raise
+
+        markets_on_this_page = data.get("markets", [])
+        if not markets_on_this_page:
+            print("No markets found on this page.")
+            break
+
+        page = parse_markets_page(markets_on_this_page)
+
+        next_cursor = data.get("cursor")
+        print(f"Received {len(markets_on_this_page)} markets. Next cursor: {next_cursor}")
+
+        if on_page is not None:
+            on_page(page, next_cursor)
+        else:
+            market_list.extend(page_rows(page))
+
+        # Check if this is the final page
+        if page_counter == max_pages:
+            break
+
+        if not next_cursor:
+            print("\nPagination complete. No further cursor returned.")
+            break
+
+        params["cursor"] = next_cursor
+
+        time.sleep(0.2)
+
+    return market_list
+
+
+def main():
+    global BASE_URL, SERIES_CACHE
+    parser = argparse.ArgumentParser(description="Crawl settled Kalshi markets into an NDJSON, JSON or Parquet file")
+    parser.add_argument("--output", default="data.arrow",
+                        help="format follows the extension: .arrow (memory-mappable), .ndjson/.jsonl, .json, .parquet")
+    parser.add_argument("--row-group-pages", type=int, default=10, help="pages per Parquet row group")
+    parser.add_argument("--max-pages", type=int, default=1500)
+    parser.add_argument("--base-url", default=BASE_URL, help="API root, e.g. a local kalshi_stub server")
+    parser.add_argument("--rate", type=float, default=10.0, help="max requests per second")
+    parser.add_argument("--concurrency", type=int, default=20, help="max open connections")
+    parser.add_argument("--sync", action="store_true", help="use the old one-page-at-a-time loop")
+    parser.add_argument("--shard-by-series", action="store_true",
+                        help="list the series first and crawl each one's pages in parallel (--max-pages is then per series)")
+    parser.add_argument("--shard-workers", type=int, default=8, help="series crawled at once with --shard-by-series")
+    parser.add_argument("--shard-retries", type=int, default=3, help="times a failing series is resumed before it is skipped")
+    parser.add_argument("--series-cache", default="series_cache.sqlite", help="SQLite file for series metadata")
+    parser.add_argument("--series-ttl", type=float, default=7 * 24 * 3600, help="seconds before a cached series is refetched")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only fetch markets closed since the newest close_time already in --output")
+    parser.add_argument("--overlap", type=float, default=3 * 24 * 3600,
+                        help="seconds to re-scan before the newest close_time, for markets that settled late")
+    parser.add_argument("--fresh", action="store_true", help="ignore any checkpoint and start from the first page")
+    parser.add_argument("--vector-index", help="afterwards, add the new markets' title embeddings to this vector_index.py directory")
+    args = parser.parse_args()
+    if args.sync and args.shard_by_series:
+        parser.error("--shard-by-series needs the async crawler, drop --sync")
+
+    # lookup_series() builds its URLs from BASE_URL
+    BASE_URL = args.base_url
+    SERIES_CACHE = SeriesCache(args.series_cache, ttl=args.series_ttl)
+    metrics.register_stats("series_cache", SERIES_CACHE.stats)
+    print(f"Loaded {SERIES_CACHE.warm()} cached series from {args.series_cache}")
+
+    fmt = market_io.output_format(args.output)
+    # NDJSON output is appended to page by page and doubles as the checkpoint spool
+    checkpoint = CrawlCheckpoint(args.output, spool_path=args.output if fmt == "ndjson" else None)
+
+    crawl_params = dict(params)
+    seen_tickers = None
+    if args.incremental:
+        seen_tickers = set()
+        newest = None
+        for batch in market_io.iter_row_batches(args.output):
+            for row in batch:
+                seen_tickers.add(row["full_ticker"])
+                if row.get("close_time") is not None and (newest is None or row["close_time"] > newest):
+                    newest = row["close_time"]
+        if newest is not None:
+            crawl_params["min_close_ts"] = int(newest - args.overlap)
+            print(f"Incremental crawl: {len(seen_tickers)} stored markets, fetching closes since {crawl_params['min_close_ts']}")
+
+    # A sharded checkpoint can only be resumed by a sharded crawl, and the other way round
+    if (not args.fresh and checkpoint.load() is not None and checkpoint.matches(crawl_params)
+            and ("shards" in checkpoint.state) == args.shard_by_series):
+        if args.shard_by_series:
+            print(f"Resuming after page {checkpoint.state['pages']} ({checkpoint.state['markets']} markets) "
+                  f"with {len(checkpoint.pending_shards())} of {len(checkpoint.state['shards'])} series left")
+            # Shards are de-duplicated against everything crawled before the restart
+            seen_tickers = seen_tickers if seen_tickers is not None else set()
+            seen_tickers.update(row["full_ticker"] for row in checkpoint.iter_rows())
+        else:
+            crawl_params["cursor"] = checkpoint.state["cursor"]
+            print(f"Resuming after page {checkpoint.state['pages']} ({checkpoint.state['markets']} markets) "
+                  f"from cursor {crawl_params['cursor']}")
+            if seen_tickers is not None and fmt != "ndjson":
+                seen_tickers.update(row["full_ticker"] for row in checkpoint.iter_rows())
+    else:
+        checkpoint.start(crawl_params, keep_existing=(fmt == "ndjson" and args.incremental))
+
+    def on_page(columns, next_cursor):
+        rows = page_rows(columns)
+        if seen_tickers is not None:
+            # Only the overlap window can repeat markets we already have
+            rows = [row for row in rows if row["full_ticker"] not in seen_tickers]
+            seen_tickers.update(row["full_ticker"] for row in rows)
+        checkpoint.append_page(rows, next_cursor)
+
+    def on_shard_page(columns, next_cursor, series_ticker):
+        # The crawler already dropped markets in seen_tickers
+        checkpoint.append_page(page_rows(columns), next_cursor, shard=series_ticker)
+
+    # A saved state with pages but no cursor (or no unfinished shard) means the crawl
+    # finished and only the final write is left
+    if "shards" in checkpoint.state:
+        finished = not checkpoint.pending_shards()
+    else:
+        finished = checkpoint.state["pages"] > 0 and not checkpoint.state["cursor"]
+
+    print(f"Attemping to fetch data from {args.base_url + ENDPOINT}")
 
+    try:
+        if finished:
+            pass
+        elif args.sync:
+            fetch_markets_sync(crawl_params, base_url=args.base_url, max_pages=args.max_pages, on_page=on_page)
+        elif args.shard_by_series:
+            import crawler
+            crawler.crawl_sharded(
+                crawl_params,
+                base_url=args.base_url,
+                max_pages=args.max_pages,
+                shards=checkpoint.pending_shards() if "shards" in checkpoint.state else None,
+                workers=args.shard_workers,
+                shard_retries=args.shard_retries,
+                seen=seen_tickers if seen_tickers is not None else set(),
+                on_shards=checkpoint.set_shards,
+                on_page=on_shard_page,
+                on_shard_done=checkpoint.finish_shard,
+                rate=args.rate,
+                max_connections=args.concurrency,
+                series_cache=SERIES_CACHE,
+            )
+        else:
+            import crawler
+            crawler.crawl(
+                crawl_params,
+                base_url=args.base_url,
+                max_pages=args.max_pages,
+                rate=args.rate,
+                max_connections=args.concurrency,
+                series_cache=SERIES_CACHE,
+                on_page=on_page,
+            )
+    except Exception as e:
+        print(f"\nCrawl stopped after {checkpoint.state['pages']} pages: {e}")
+        print("Progress is checkpointed, run the same command again to resume.")
+        print("\nCrawl metrics:\n" + metrics.REGISTRY.summary())
+        SERIES_CACHE.close()
+        sys.exit(1)
+
+    print(f"\n Successfully retrieved {checkpoint.state['markets']} settled market tickers.")
+    print("\nCrawl metrics:\n" + metrics.REGISTRY.summary())
+    SERIES_CACHE.close()
+
+    if fmt == "ndjson":
+        print(f"Appended {checkpoint.state['markets']} markets to {args.output}")
+        checkpoint.clear(keep_spool=True)
+        update_vector_index(args.output, args.vector_index)
+        return
+
+    # Other formats are rewritten by streaming the previous output and the spool into a new file
+    tmp_path = args.output + ".tmp"
+    with market_io.open_sink(tmp_path, fmt=fmt, pages_per_group=args.row_group_pages) as sink:
+        if args.incremental:
+            for batch in market_io.iter_row_batches(args.output, batch_size=params["limit"]):
+                sink.write_page(batch)
+        page = []
+        for row in checkpoint.iter_rows():
+            page.append(row)
+            if len(page) == params["limit"]:
+                sink.write_page(page)
+                page = []
+        if page:
+            sink.write_page(page)
+    os.replace(tmp_path, args.output)
+    checkpoint.clear()
+    print(f"Wrote {sink.rows_written} markets to {args.output}")
+    update_vector_index(args.output, args.vector_index)
+
+
+def update_vector_index(output_path, index_dir):
+    """Embed the markets in output_path that the title index doesn't have yet"""
+    if not index_dir:
+        return
+    import predict
+    import vector_index
+    vector_index.update_from_file(output_path, predict.get_predictor(), index_dir)
+
+
+if __name__ == "__main__":
+    main()
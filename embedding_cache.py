@@ -0,0 +1,222 @@
+"""Content-addressed cache of PCA-reduced title embeddings.
+
+Kalshi titles repeat heavily (every daily "Highest temperature in NYC"
+market has the same wording), so encoding + PCA only runs for titles the
+cache hasn't seen. Keys hash the normalised title together with the
+sentence model name and a PCA fingerprint, so a retrained PCA or a new model
+never serves stale vectors.
+
+Two tiers:
+    memory  an LRU dict of the most recently used vectors
+    disk    optional directory with an append-only file of (key hash, float32
+            vector) records, memory-mapped for reads and shared by processes
+"""
+import fcntl
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+_WHITESPACE = re.compile(r"\s+")
+KEY_BYTES = 20
+
+
+def normalize_title(title):
+    return _WHITESPACE.sub(" ", str(title)).strip().lower()
+
+
+def key_digest(key):
+    """The sha1 a disk record stores for its key"""
+    return hashlib.sha1(key.encode("utf-8")).digest()
+
+
+def pca_fingerprint(pca):
+    """Short hash of a fitted PCA's parameters, used as the PCA version in cache keys"""
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(pca.components_).tobytes())
+    h.update(np.ascontiguousarray(pca.mean_).tobytes())
+    return h.hexdigest()[:16]
+
+
+class DiskTier:
+    """Append-only file of (key digest, float32 vector) records, read through a memory map.
+
+    Safe for several processes sharing one directory (predict_file --workers):
+    appends hold an fcntl lock and land at the end of the file as it is under
+    that lock, rows other processes added are picked up on a miss, and every
+    record carries the sha1 of its key, which reads check, so a row is never
+    served for a different key.
+    """
+
+    def __init__(self, directory, dim):
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.dtype = np.dtype([("key", "u1", (KEY_BYTES,)), ("vector", "<f4", (dim,))])
+        self.path = os.path.join(directory, f"embeddings_{dim}.bin")
+        # key digest -> row
+        self.index = {}
+        self._rows = 0
+        self._map = None
+        self.refresh()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key_digest(key) in self.index
+
+    def _file_rows(self):
+        try:
+            # A torn record at the end (a writer died mid-append) isn't counted
+            return os.path.getsize(self.path) // self.dtype.itemsize
+        except FileNotFoundError:
+            return 0
+
+    def _mapped(self):
+        if self._map is None or self._map.shape[0] < self._rows:
+            self._map = np.memmap(self.path, dtype=self.dtype, mode="r", shape=(self._rows,))
+        return self._map
+
+    def refresh(self):
+        """Index the rows appended since the last look, by this process or another"""
+        n_rows = self._file_rows()
+        if n_rows <= self._rows:
+            return 0
+        first = self._rows
+        self._rows = n_rows
+        digests = np.ascontiguousarray(self._mapped()["key"][first:n_rows]).tobytes()
+        for i in range(n_rows - first):
+            self.index.setdefault(digests[i * KEY_BYTES:(i + 1) * KEY_BYTES], first + i)
+        return n_rows - first
+
+    def get(self, key):
+        vectors, found = self.get_many([key])
+        return vectors[0] if found[0] else None
+
+    def get_many(self, keys):
+        """(n, dim) vectors for keys and a mask of which were found (missing rows are zero)"""
+        digests = [key_digest(key) for key in keys]
+        if any(d not in self.index for d in digests):
+            self.refresh()
+        rows = np.array([self.index.get(d, -1) for d in digests], dtype=np.int64)
+        found = rows >= 0
+        out = np.zeros((len(rows), self.dim), dtype=np.float32)
+        if found.any():
+            records = self._mapped()[rows[found]]
+            # A row whose stored key doesn't match (zeroed by a crash) is treated as a miss
+            expected = np.frombuffer(b"".join(d for d, ok in zip(digests, found) if ok), dtype=np.uint8)
+            valid = (records["key"] == expected.reshape(-1, KEY_BYTES)).all(axis=1)
+            hits = np.flatnonzero(found)
+            out[hits[valid]] = records["vector"][valid]
+            for i in hits[~valid].tolist():
+                self.index.pop(digests[i], None)
+            found[hits[~valid]] = False
+        return out, found
+
+    def add_many(self, keys, vectors):
+        records = np.empty(len(keys), dtype=self.dtype)
+        records["key"] = np.frombuffer(b"".join(key_digest(key) for key in keys), dtype=np.uint8).reshape(-1, KEY_BYTES)
+        records["vector"] = vectors
+        with open(self.path, "ab") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if size % self.dtype.itemsize:
+                    # Every append happens under this lock, so a partial record is left over from a crash
+                    f.truncate(size - size % self.dtype.itemsize)
+                f.write(records.tobytes())
+                f.flush()
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        self.refresh()
+
+
+class EmbeddingCache:
+
+    def __init__(self, model_name, pca_version, dim=None, capacity=100000, disk_dir=None):
+        self.model_name = model_name
+        self.pca_version = pca_version
+        self.capacity = capacity
+        self.disk_dir = disk_dir
+        # Without dim the disk tier is opened once the first batch shows the vector size
+        self.disk = DiskTier(disk_dir, dim) if disk_dir is not None and dim else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, title):
+        raw = f"{self.model_name}\0{self.pca_version}\0{normalize_title(title)}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+
+    def get_many(self, titles, encode, batch_size=256):
+        """Vectors for every title, calling encode(list_of_titles) -> 2D array only for misses"""
+        keys = [self.key(t) for t in titles]
+        found = {}
+        missing = OrderedDict()
+
+        with self._lock:
+            for key, title in zip(keys, titles):
+                if key in found or key in missing:
+                    # Repeats within one call are only encoded once
+                    self.memory_hits += 1
+                    continue
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    found[key] = vector
+                    continue
+                missing[key] = title
+
+            # Everything memory didn't have goes to the disk tier in one lookup
+            if missing and self.disk is not None:
+                vectors, on_disk = self.disk.get_many(list(missing))
+                for key, vector, hit in zip(list(missing), vectors, on_disk.tolist()):
+                    if hit:
+                        self.disk_hits += 1
+                        self._remember(key, vector)
+                        found[key] = vector
+                        del missing[key]
+            self.misses += len(missing)
+
+        if missing:
+            missing_keys = list(missing)
+            missing_titles = list(missing.values())
+            for start in range(0, len(missing_titles), batch_size):
+                batch_keys = missing_keys[start:start + batch_size]
+                vectors = np.asarray(encode(missing_titles[start:start + batch_size]), dtype=np.float32)
+                with self._lock:
+                    if self.disk_dir is not None:
+                        if self.disk is None:
+                            self.disk = DiskTier(self.disk_dir, vectors.shape[1])
+                        new = [i for i, k in enumerate(batch_keys) if k not in self.disk]
+                        if new:
+                            self.disk.add_many([batch_keys[i] for i in new], vectors[new])
+                    for key, vector in zip(batch_keys, vectors):
+                        self._remember(key, vector)
+                        found[key] = vector
+
+        return np.vstack([found[key] for key in keys]) if keys else np.empty((0, 0), dtype=np.float32)
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self.disk) if self.disk is not None else 0,
+        }
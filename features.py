@@ -0,0 +1,127 @@
+"""Feature matrix construction shared by predict.py and training.
+
+Works straight from a list of market dicts into preallocated NumPy arrays
+in `feature_cols` order, instead of building and concatenating DataFrames.
+All keyword flags come out of a single scan of each title.
+"""
+import re
+
+import numpy as np
+
+# flag column -> keywords, matched case-insensitively anywhere in the title
+KEYWORD_FLAGS = {
+    "is_major_event": ["championship", "final", "cup", "election", "champion"],
+    "is_major_sport": ["NFL", "NBA", "MLB", "Premier League"],
+}
+
+NUMERIC_COLUMNS = {"duration", "can_close_early"}
+
+
+class KeywordMatcher:
+    """One precompiled pattern that reports every flag whose keywords appear in a text.
+
+    Each flag is a named group inside a lookahead, so matches are zero-width
+    and a keyword starting inside another keyword's match is still seen.
+    The scan stops as soon as every flag has been seen.
+    """
+
+    def __init__(self, keyword_flags=KEYWORD_FLAGS):
+        self.flags = list(keyword_flags)
+        self._groups = {f"f{i}": i for i in range(len(self.flags))}
+        alternatives = []
+        for i, flag in enumerate(self.flags):
+            keywords = "|".join(re.escape(k) for k in keyword_flags[flag])
+            alternatives.append(f"(?P<f{i}>{keywords})")
+        self._pattern = re.compile(f"(?=(?:{'|'.join(alternatives)}))", re.IGNORECASE)
+
+    def match(self, text):
+        """Set of flag indexes present in text"""
+        found = set()
+        for m in self._pattern.finditer(text):
+            found.add(self._groups[m.lastgroup])
+            if len(found) == len(self.flags):
+                break
+        return found
+
+    def flag_matrix(self, texts, out=None):
+        """(len(texts), n_flags) 0/1 matrix; written into out if given"""
+        if out is None:
+            out = np.zeros((len(texts), len(self.flags)), dtype=np.float64)
+        for row, text in enumerate(texts):
+            for col in self.match(text):
+                out[row, col] = 1
+        return out
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _to_category(value):
+    # Missing labels are their own category, the same at training and serving time
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return "unknown"
+    return str(value)
+
+
+class FeatureBuilder:
+    """Fills the model's feature matrix in artifacts['feature_cols'] order"""
+
+    def __init__(self, feature_cols, title_emb_cols, keyword_flags=KEYWORD_FLAGS):
+        self.feature_cols = list(feature_cols)
+        self.title_emb_cols = list(title_emb_cols)
+        self.matcher = KeywordMatcher(keyword_flags)
+
+        numeric = NUMERIC_COLUMNS | set(self.title_emb_cols) | set(keyword_flags)
+        self.numeric_cols = [c for c in self.feature_cols if c in numeric]
+        # Anything else (category, frequency, ...) is passed through as strings
+        self.categorical_cols = [c for c in self.feature_cols if c not in numeric]
+        position = {c: i for i, c in enumerate(self.numeric_cols)}
+
+        self._emb_positions = np.array([position[c] for c in self.title_emb_cols if c in position], dtype=np.intp)
+        self._emb_source = np.array([i for i, c in enumerate(self.title_emb_cols) if c in position], dtype=np.intp)
+        self._flag_positions = [(position[flag], i) for i, flag in enumerate(self.matcher.flags) if flag in position]
+        self._duration = position.get("duration")
+        self._can_close_early = position.get("can_close_early")
+
+    def build(self, records, title_emb):
+        """(numeric matrix, {categorical col: object array}) for a list of market dicts"""
+        n = len(records)
+        values = np.zeros((n, len(self.numeric_cols)), dtype=np.float64)
+
+        if self._duration is not None:
+            values[:, self._duration] = [_to_float(r.get("duration")) for r in records]
+        if self._can_close_early is not None:
+            values[:, self._can_close_early] = [int(r.get("can_close_early") or 0) for r in records]
+        if len(self._emb_positions):
+            values[:, self._emb_positions] = np.asarray(title_emb)[:, self._emb_source]
+        if self._flag_positions:
+            flags = self.matcher.flag_matrix([str(r.get("title", "")) for r in records])
+            for position, flag in self._flag_positions:
+                values[:, position] = flags[:, flag]
+
+        categorical = {
+            col: np.array([_to_category(r.get(col)) for r in records], dtype=object)
+            for col in self.categorical_cols
+        }
+        return values, categorical
+
+    def to_model_input(self, values, categorical, as_frame=True):
+        """Model input in feature_cols order: a plain array when possible, else one DataFrame"""
+        if not self.categorical_cols and not as_frame:
+            return values
+        import pandas as pd
+
+        position = {c: i for i, c in enumerate(self.numeric_cols)}
+        columns = {
+            col: categorical[col] if col in categorical else values[:, position[col]]
+            for col in self.feature_cols
+        }
+        return pd.DataFrame(columns, columns=self.feature_cols, copy=False)
+
+    def transform(self, records, title_emb, as_frame=True):
+        values, categorical = self.build(records, title_emb)
+        return self.to_model_input(values, categorical, as_frame=as_frame)
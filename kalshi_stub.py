@@ -0,0 +1,255 @@
+"""Local stand-in for the Kalshi trade API.
+
+Serves recorded (or generated) /markets pages with cursors and /series
+lookups so the crawler can be exercised without touching the real API.
+
+    server = StubServer(markets, series).start()
+    ... point the crawler at server.base_url ...
+    server.stop()
+
+A recording is a JSON file with the raw markets from some real /markets
+pages and the /series objects they refer to; it is replayed with the
+stub's own cursors and page sizes:
+
+    python kalshi_stub.py --record recording.json --pages 20
+    python kalshi_stub.py --recording recording.json --latency 0.1
+
+For volume_poller.py, serve open markets whose volumes keep moving:
+
+    python kalshi_stub.py --status open --markets 50000 --trades-per-second 200
+"""
+import calendar
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+API_PREFIX = "/trade-api/v2"
+
+CATEGORIES = ["Financials", "Crypto", "Sports", "Mentions", "World", "Entertainment", "Social", "Climate and Weather"]
+FREQUENCIES = ["daily", "weekly", "hourly", "one_off", "custom"]
+
+
+def generate_markets(n_markets, n_series=50, status="settled", seed=0):
+    """Build n fake market dicts shaped like the /markets response, plus their series"""
+    rng = random.Random(seed)
+    series = {}
+    for i in range(n_series):
+        ticker = f"KXSTUB{i}"
+        series[ticker] = {
+            "ticker": ticker,
+            "title": f"Stub series {i}",
+            "category": rng.choice(CATEGORIES),
+            "frequency": rng.choice(FREQUENCIES),
+        }
+
+    series_tickers = list(series)
+    markets = []
+    base_ts = 1735689600  # 2025-01-01T00:00:00Z
+    for i in range(n_markets):
+        series_ticker = series_tickers[i % n_series]
+        open_ts = base_ts + i * 60
+        close_ts = open_ts + rng.randint(3600, 30 * 86400)
+        markets.append({
+            "ticker": f"{series_ticker}-25E{i // 10}-T{i % 10}",
+            "event_ticker": f"{series_ticker}-25E{i // 10}",
+            "title": f"Will stub market {i} in {series_ticker} resolve yes?",
+            "status": status,
+            "open_time": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(open_ts)),
+            "close_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(close_ts)),
+            "volume": rng.randint(0, 500000),
+            "can_close_early": rng.random() < 0.5,
+            "settlement_value": rng.choice([0, 100]),
+        })
+    return markets, series
+
+
+def record(path, base_url="https://api.elections.kalshi.com/trade-api/v2", params=None, max_pages=10):
+    """Save max_pages of live /markets pages, plus their series, to path; returns the market count"""
+    import requests
+
+    params = dict(params or {"status": "settled", "limit": 1000})
+    markets = []
+    for _ in range(max_pages):
+        response = requests.get(f"{base_url}/markets", params=params)
+        response.raise_for_status()
+        data = response.json()
+        markets.extend(data.get("markets", []))
+        if not data.get("cursor"):
+            break
+        params["cursor"] = data["cursor"]
+        time.sleep(0.2)
+
+    series = {}
+    for ticker in sorted({m["ticker"].split("-", 1)[0] for m in markets}):
+        response = requests.get(f"{base_url}/series/{ticker}")
+        if response.ok:
+            series[ticker] = response.json().get("series", {})
+        time.sleep(0.1)
+
+    with open(path, "w") as f:
+        json.dump({"markets": markets, "series": series}, f)
+    return len(markets)
+
+
+def load_recording(path):
+    """(markets, series) from a file written by record()"""
+    with open(path, "r") as f:
+        data = json.load(f)
+    return data["markets"], data["series"]
+
+
+class StubServer:
+    """Threaded HTTP server replaying markets/series with optional latency and faults"""
+
+    def __init__(self, markets, series, latency=0.0, fail_every=0, fail_status=429, host="127.0.0.1", port=0):
+        self.markets = markets
+        self.series = series
+        self.latency = latency
+        # Every fail_every-th request answers with fail_status, to exercise retry/backoff
+        self.fail_every = fail_every
+        self.fail_status = fail_status
+        self.request_count = 0
+        self.path_counts = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}{API_PREFIX}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def trade(self, count, rng=random):
+        """Add volume to `count` random markets, like trades landing between two polls"""
+        with self._lock:
+            for market in rng.sample(self.markets, min(count, len(self.markets))):
+                market["volume"] = (market.get("volume") or 0) + rng.randint(1, 500)
+
+    def markets_page(self, query):
+        """Slice the market list the same way the real endpoint pages through it"""
+        limit = int(query.get("limit", ["100"])[0])
+        cursor = query.get("cursor", [""])[0]
+        start = int(cursor) if cursor else 0
+
+        selected = self.markets
+        status = query.get("status", [None])[0]
+        if status:
+            selected = [m for m in selected if m.get("status") == status]
+        series_ticker = query.get("series_ticker", [None])[0]
+        if series_ticker:
+            selected = [m for m in selected if m["ticker"].split("-", 1)[0] == series_ticker]
+        min_close_ts = query.get("min_close_ts", [None])[0]
+        if min_close_ts:
+            min_close_ts = int(min_close_ts)
+            selected = [m for m in selected if _iso_to_ts(m["close_time"]) >= min_close_ts]
+
+        page = selected[start:start + limit]
+        next_cursor = str(start + limit) if start + limit < len(selected) else ""
+        return {"markets": page, "cursor": next_cursor}
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                with stub._lock:
+                    stub.request_count += 1
+                    count = stub.request_count
+                    stub.path_counts[url.path] = stub.path_counts.get(url.path, 0) + 1
+
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                if stub.fail_every and count % stub.fail_every == 0:
+                    self._send(stub.fail_status, {"error": "stub fault"})
+                    return
+
+                path = url.path[len(API_PREFIX):] if url.path.startswith(API_PREFIX) else url.path
+                if path == "/markets":
+                    self._send(200, stub.markets_page(parse_qs(url.query)))
+                elif path.startswith("/series/"):
+                    ticker = path[len("/series/"):]
+                    if ticker in stub.series:
+                        self._send(200, {"series": stub.series[ticker]})
+                    else:
+                        self._send(404, {"error": "series not found"})
+                elif path == "/series":
+                    self._send(200, {"series": list(stub.series.values())})
+                else:
+                    self._send(404, {"error": "not found"})
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _iso_to_ts(value):
+    return calendar.timegm(time.strptime(value.split(".")[0].rstrip("Z"), "%Y-%m-%dT%H:%M:%S"))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Kalshi markets/series API")
+    parser.add_argument("--markets", type=int, default=5000, help="generated markets, when there's no --recording")
+    parser.add_argument("--recording", help="replay the markets and series saved in this file")
+    parser.add_argument("--record", help="save live pages to this file instead of serving")
+    parser.add_argument("--pages", type=int, default=10, help="pages to save with --record")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--status", default="settled", help="status of the generated markets (open for volume_poller.py)")
+    parser.add_argument("--trades-per-second", type=float, default=0.0, help="markets whose volume grows each second")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.record:
+        print(f"Saved {record(args.record, max_pages=args.pages)} markets to {args.record}")
+        return
+
+    if args.recording:
+        markets, series = load_recording(args.recording)
+    else:
+        markets, series = generate_markets(args.markets, status=args.status)
+    server = StubServer(markets, series, latency=args.latency, port=args.port).start()
+    print(f"Stub Kalshi API serving {len(markets)} markets at {server.base_url}")
+    try:
+        while True:
+            if args.trades_per_second:
+                time.sleep(1)
+                server.trade(int(args.trades_per_second))
+            else:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
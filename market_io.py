@@ -0,0 +1,349 @@
+"""Append-only writers and streaming readers for crawled market rows.
+
+Rows are the dicts produced by Market.to_dict(). The crawler writes them a
+page at a time so memory stays flat however long the crawl runs:
+
+    NDJSONSink    one JSON object per line, can be appended to and resumed
+    JSONArraySink the old data.json layout, written incrementally
+    ParquetSink   columnar, one row group per `pages_per_group` pages (needs pyarrow)
+    ArrowSink     uncompressed Arrow IPC file (.arrow), the shared on-disk format
+
+The output format is picked from the file extension.
+
+Arrow files are what the crawler, predict.py and the web app exchange: they
+are opened with a memory map (open_table), so loading costs no parsing, the
+columns are used in place, and every process reading the same file shares
+its pages through the OS cache. The low-cardinality string columns are
+dictionary-encoded.
+
+    python market_io.py data2.json data2.arrow      # convert between formats
+"""
+import json
+import os
+
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
+ARROW_EXTENSIONS = (".arrow", ".feather")
+
+# Column types for Market.to_dict() rows, so a page that happens to be all-null
+# in some column doesn't fix the wrong Parquet type for the rest of the file
+MARKET_COLUMNS = {
+    "full_ticker": "string",
+    "series_ticker": "string",
+    "event_ticker": "string",
+    "outcome": "string",
+    "title": "string",
+    "duration": "float64",
+    "close_time": "float64",
+    "can_close_early": "bool",
+    "final_volume": "int64",
+    "settlement_price": "float64",
+    "category": "string",
+    "frequency": "string",
+}
+
+# Stored as dictionary<int32, string> in Arrow files
+DICTIONARY_COLUMNS = ("series_ticker", "series", "category", "frequency")
+
+
+def output_format(path):
+    lower = path.lower()
+    if lower.endswith(NDJSON_EXTENSIONS):
+        return "ndjson"
+    if lower.endswith(".parquet"):
+        return "parquet"
+    if lower.endswith(ARROW_EXTENSIONS):
+        return "arrow"
+    return "json"
+
+
+class NDJSONSink:
+
+    def __init__(self, path, append=True):
+        self.path = path
+        self.rows_written = 0
+        self._f = open(path, "a" if append else "w", encoding="utf-8")
+
+    def write_page(self, rows):
+        self._f.write("".join(json.dumps(row, allow_nan=False) + "\n" for row in rows))
+        self._f.flush()
+        self.rows_written += len(rows)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JSONArraySink:
+    """Writes a JSON array one page at a time instead of one json.dump at the end"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rows_written = 0
+        self._f = open(path, "w", encoding="utf-8")
+        self._f.write("[")
+
+    def write_page(self, rows):
+        for row in rows:
+            self._f.write(",\n" if self.rows_written else "\n")
+            self._f.write(json.dumps(row, allow_nan=False))
+            self.rows_written += 1
+
+    def close(self):
+        self._f.write("\n]\n")
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParquetSink:
+    """Buffers `pages_per_group` pages and flushes them as one Parquet row group"""
+
+    def __init__(self, path, pages_per_group=10, columns=MARKET_COLUMNS):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet  # noqa: F401
+        except ImportError as e:
+            raise ImportError("Parquet output needs pyarrow: pip install pyarrow") from e
+        self.path = path
+        self.pages_per_group = pages_per_group
+        self.schema = pa.schema([(name, pa.type_for_alias(t)) for name, t in columns.items()]) if columns else None
+        self.rows_written = 0
+        self._buffer = []
+        self._buffered_pages = 0
+        self._writer = None
+
+    def write_page(self, rows):
+        self._buffer.extend(rows)
+        self._buffered_pages += 1
+        if self._buffered_pages >= self.pages_per_group:
+            self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self._buffer:
+            return
+        table = pa.Table.from_pylist(self._buffer, schema=self.schema)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+        self._writer.write_table(table)
+        self.rows_written += len(self._buffer)
+        self._buffer = []
+        self._buffered_pages = 0
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArrowSink:
+    """Buffers `pages_per_group` pages and writes them as one Arrow record batch.
+
+    Dictionary columns are encoded against a vocabulary that only ever grows,
+    so each batch adds a dictionary delta instead of repeating the strings
+    (an Arrow file can't replace a dictionary part way through).
+    """
+
+    def __init__(self, path, pages_per_group=10, columns=MARKET_COLUMNS):
+        try:
+            import pyarrow as pa
+        except ImportError as e:
+            raise ImportError("Arrow output needs pyarrow: pip install pyarrow") from e
+        self.path = path
+        self.pages_per_group = pages_per_group
+        # Without columns the schema is taken from the first batch written
+        self.plain_schema = pa.schema([(name, pa.type_for_alias(t)) for name, t in columns.items()]) if columns else None
+        self.schema = None
+        self.rows_written = 0
+        self._vocab = {}
+        self._buffer = []
+        self._buffered_pages = 0
+        self._writer = None
+
+    def write_page(self, rows):
+        self._buffer.extend(rows)
+        self._buffered_pages += 1
+        if self._buffered_pages >= self.pages_per_group:
+            self.flush()
+
+    def _open(self, table):
+        import pyarrow as pa
+
+        if self.plain_schema is None:
+            # All-null columns in the first batch are assumed to be strings
+            self.plain_schema = pa.schema([
+                (field.name, pa.string() if pa.types.is_null(field.type) else field.type) for field in table.schema
+            ])
+        self.schema = pa.schema([
+            pa.field(field.name, pa.dictionary(pa.int32(), pa.string()))
+            if field.name in DICTIONARY_COLUMNS and pa.types.is_string(field.type) else field
+            for field in self.plain_schema
+        ])
+        self._vocab = {field.name: {} for field in self.schema if pa.types.is_dictionary(field.type)}
+        options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+        self._writer = pa.ipc.new_file(self.path, self.schema, options=options)
+
+    def flush(self):
+        import pyarrow as pa
+
+        if not self._buffer:
+            return
+        table = pa.Table.from_pylist(self._buffer, schema=self.plain_schema)
+        if self._writer is None:
+            self._open(table)
+            table = table.cast(self.plain_schema)
+        arrays = []
+        for field in self.schema:
+            column = table.column(field.name)
+            vocab = self._vocab.get(field.name)
+            if vocab is None:
+                arrays.append(column.combine_chunks())
+                continue
+            indices = [None if v is None else vocab.setdefault(v, len(vocab)) for v in column.to_pylist()]
+            arrays.append(pa.DictionaryArray.from_arrays(
+                pa.array(indices, type=pa.int32()), pa.array(list(vocab), type=pa.string())))
+        self._writer.write_batch(pa.record_batch(arrays, schema=self.schema))
+        self.rows_written += len(self._buffer)
+        self._buffer = []
+        self._buffered_pages = 0
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_sink(path, fmt=None, pages_per_group=10, columns=MARKET_COLUMNS):
+    """A fresh sink for path, in fmt or else the format its extension implies.
+
+    columns only matters for Parquet and Arrow; pass None for rows that aren't markets.
+    """
+    fmt = fmt or output_format(path)
+    if fmt == "ndjson":
+        return NDJSONSink(path, append=False)
+    if fmt == "parquet":
+        return ParquetSink(path, pages_per_group=pages_per_group, columns=columns)
+    if fmt == "arrow":
+        return ArrowSink(path, pages_per_group=pages_per_group, columns=columns)
+    return JSONArraySink(path)
+
+
+def decoded_schema(schema):
+    """schema with dictionary columns turned back into their value type"""
+    import pyarrow as pa
+
+    return pa.schema([
+        pa.field(field.name, field.type.value_type) if pa.types.is_dictionary(field.type) else field
+        for field in schema
+    ])
+
+
+def open_table(path):
+    """Zero-copy pyarrow Table over a memory-mapped Arrow file"""
+    import pyarrow as pa
+
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+def iter_row_batches(path, batch_size=10000):
+    """Stream an existing output file as lists of row dicts; nothing if it doesn't exist"""
+    if not os.path.exists(path):
+        return
+    fmt = output_format(path)
+    if fmt == "ndjson":
+        batch = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    batch.append(json.loads(line))
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
+    elif fmt == "parquet":
+        import pyarrow.parquet as pq
+        for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield record_batch.to_pylist()
+    elif fmt == "arrow":
+        for record_batch in open_table(path).to_batches(max_chunksize=batch_size):
+            yield record_batch.to_pylist()
+    else:
+        # The legacy layout has to be parsed in one go
+        with open(path, "r", encoding="utf-8") as f:
+            rows = json.load(f)
+        for i in range(0, len(rows), batch_size):
+            yield rows[i:i + batch_size]
+
+
+def iter_rows(path):
+    for batch in iter_row_batches(path):
+        yield from batch
+
+
+def read_dataframe(path, columns=None):
+    """Load a crawl output into pandas, using the fast reader for each format"""
+    import pandas as pd
+
+    fmt = output_format(path)
+    if fmt == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    if fmt == "arrow":
+        table = open_table(path)
+        table = table.select(columns) if columns is not None else table
+        # Plain string columns, as from the other formats, rather than pandas Categoricals
+        return table.cast(decoded_schema(table.schema)).to_pandas()
+    # convert_dates=False keeps close_time as the epoch seconds the crawler wrote
+    df = pd.read_json(path, lines=(fmt == "ndjson"), orient="records", convert_dates=False)
+    return df[columns] if columns is not None else df
+
+
+def convert(src_path, dst_path, pages_per_group=10, batch_size=10000):
+    """Rewrite src_path in the format dst_path's extension implies; returns the rows written"""
+    batches = iter_row_batches(src_path, batch_size=batch_size)
+    first = next(batches, [])
+    # Market rows keep the fixed column types; anything else (e.g. the web app's events) is inferred
+    columns = MARKET_COLUMNS if first and set(first[0]) <= set(MARKET_COLUMNS) else None
+    with open_sink(dst_path, pages_per_group=pages_per_group, columns=columns) as sink:
+        if first:
+            sink.write_page(first)
+        for batch in batches:
+            sink.write_page(batch)
+    return sink.rows_written
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert market rows between .json, .ndjson, .parquet and .arrow")
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    args = parser.parse_args()
+    print(f"Wrote {convert(args.src, args.dst)} rows to {args.dst}")
+
+
+if __name__ == "__main__":
+    main()
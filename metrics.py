@@ -0,0 +1,261 @@
+"""In-process timing histograms, counters and an opt-in sampling profiler.
+
+Shared by the crawler, predict.py and the web app. Everything goes into one
+process-wide REGISTRY:
+
+    with metrics.timer("predict.encode"):     # histogram of durations, seconds
+        ...
+    metrics.inc("crawl.retries")              # counter
+    metrics.register_stats("embedding_cache", cache.stats)   # gauges read on demand
+
+Stage names used across the repo:
+
+    crawl.http_fetch, crawl.series_lookup       data_collection.py / crawler.py
+    poll.sweep                                  volume_poller.py
+    predict.encode, predict.pca, predict.model  predict.py
+    events.load                                 Front-edn/event_store.py
+    compare.neighbour_search, llm.call, http.*  Front-edn/page.py
+
+Histograms use fixed log-spaced buckets, so recording is a bisect and a few
+additions under a lock, and percentiles are estimated from the buckets.
+Metrics are per process: behind gunicorn each worker reports its own.
+
+snapshot() returns a JSON-able dict, prometheus_text() the Prometheus text
+format (page.py serves both at /metrics) and summary() a few printable lines
+(shown at the end of a crawl).
+"""
+import bisect
+import collections
+import contextlib
+import functools
+import sys
+import threading
+import time
+
+# Upper bounds in seconds, 50us to ~100s, doubling
+BUCKETS = tuple(0.00005 * 2 ** i for i in range(22))
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        """Estimated q-th percentile (0-100), interpolated within the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                value = lower + (upper - lower) * (rank - seen) / count
+                return min(max(value, self.min), self.max)
+            seen += count
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min or 0.0,
+            "max": self.max or 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class Registry:
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self.stats_sources = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def timed(self, name):
+        """Decorator form of timer()"""
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def register_stats(self, name, stats):
+        """Report the numbers in stats() (e.g. a cache's stats method) as gauges under name"""
+        self.stats_sources[name] = stats
+
+    def gauges(self):
+        values = {}
+        for name, stats in list(self.stats_sources.items()):
+            try:
+                data = stats()
+            except Exception as e:
+                print(f"Metrics: {name} stats failed: {e}")
+                continue
+            for key, value in data.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[f"{name}.{key}"] = value
+        return values
+
+    def snapshot(self):
+        return {
+            "histograms": {name: h.snapshot() for name, h in sorted(self.histograms.items())},
+            "counters": dict(sorted(self.counters.items())),
+            "gauges": self.gauges(),
+        }
+
+    def summary(self):
+        """Human-readable lines: one per stage, then counters and gauges"""
+        lines = []
+        for name, h in sorted(self.histograms.items()):
+            s = h.snapshot()
+            lines.append(f"{name:34} n={s['count']:<7} total {s['sum']:8.2f}s  mean {s['mean'] * 1000:8.2f}ms  "
+                         f"p50 {s['p50'] * 1000:8.2f}ms  p95 {s['p95'] * 1000:8.2f}ms  max {s['max'] * 1000:8.2f}ms")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:34} {value}")
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"{name:34} {value:.4g}" if isinstance(value, float) else f"{name:34} {value}")
+        return "\n".join(lines)
+
+    def prometheus_text(self, prefix="kalshi_"):
+        def metric_name(name):
+            return prefix + "".join(c if c.isalnum() else "_" for c in name)
+
+        lines = []
+        for name, h in sorted(self.histograms.items()):
+            metric = metric_name(name) + "_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+            lines.append(f"{metric}_sum {h.total}")
+            lines.append(f"{metric}_count {h.count}")
+        for name, value in sorted(self.counters.items()):
+            metric = metric_name(name) + "_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE {metric_name(name)} gauge")
+            lines.append(f"{metric_name(name)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = collections.Counter()
+
+
+REGISTRY = Registry()
+timer = REGISTRY.timer
+timed = REGISTRY.timed
+observe = REGISTRY.observe
+inc = REGISTRY.inc
+register_stats = REGISTRY.register_stats
+
+
+class SamplingProfiler:
+    """Samples one thread's Python stack every `interval` seconds from a helper thread.
+
+    Costs nothing unless started. report() gives the hottest frames and
+    collapsed() the stacks in the "a;b;c count" format flame graph tools read.
+    """
+
+    def __init__(self, thread_id=None, interval=0.001, max_depth=64):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def report(self, top=15):
+        """The frames most often on top of the stack, with their share of the samples"""
+        leaves = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        lines = [f"{self.samples} samples every {self.interval * 1000:g}ms"]
+        for frame, count in leaves.most_common(top):
+            lines.append(f"{count / self.samples:6.1%}  {frame}" if self.samples else frame)
+        return "\n".join(lines)
@@ -0,0 +1,263 @@
+"""Train the volume model and write the artifacts predict.py loads.
+
+    python model.py data.arrow                        # retrain, publish to the default paths
+    python model.py data.arrow --refit-pca --components 16
+
+Steps:
+    1. markets with a title and a final_volume are read from a crawl output
+       (any market_io format)
+    2. raw sentence embeddings are cached per market in --cache-dir, keyed by
+       full_ticker and title, so a retrain only encodes markets crawled since
+       the last one
+    3. the PCA is kept from the current artifacts when they used the same
+       sentence model (so pca_version, the embedding caches and the vector
+       index stay valid), otherwise fitted on a random sample of rows
+    4. the feature matrix is built with features.FeatureBuilder, the same
+       code predict.py uses, so training and serving can't drift apart
+    5. a HistGradientBoostingRegressor on log1p(final_volume) is fitted using
+       every core, and scored on a held-out split
+
+Every run is written to its own directory under --models-dir with a
+manifest, both as the two pickles and as a memory-mappable artifact_store
+directory. It is published by replacing MODEL_PATH and ARTIFACTS_PATH and
+re-pointing the ARTIFACT_DIR symlink; running Predictors pick the new files
+up through their mtime check.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+
+import numpy as np
+
+import artifact_store
+import market_io
+from embedding_cache import DiskTier, pca_fingerprint
+from features import KEYWORD_FLAGS, FeatureBuilder
+from predict import ARTIFACT_DIR, ARTIFACTS_PATH, MODEL_PATH
+
+SENTENCE_MODEL_NAME = 'all-MiniLM-L6-v2'
+CACHE_DIR = 'train_cache'
+MODELS_DIR = 'models'
+CATEGORICAL_COLUMNS = ['category', 'frequency']
+TRAINING_FIELDS = ['full_ticker', 'title', 'duration', 'can_close_early', 'category', 'frequency', 'final_volume']
+
+
+def load_training_rows(data_path, batch_size=50000):
+    """Market dicts that can be trained on, trimmed to the fields training uses"""
+    rows = []
+    for batch in market_io.iter_row_batches(data_path, batch_size=batch_size):
+        for row in batch:
+            if row.get("title") and isinstance(row.get("final_volume"), (int, float)):
+                rows.append({field: row.get(field) for field in TRAINING_FIELDS})
+    return rows
+
+
+def embedding_key(row):
+    """Cache key for a market's raw embedding: its ticker plus a hash of the title it had"""
+    title_hash = hashlib.sha1(row["title"].encode("utf-8")).hexdigest()[:12]
+    return f"{row.get('full_ticker') or 'untitled'}:{title_hash}"
+
+
+def cached_embeddings(rows, sentence_model, sentence_model_name, cache_dir=CACHE_DIR, batch_size=4096):
+    """Raw sentence embeddings for every row, encoding only rows the cache hasn't seen"""
+    keys = [embedding_key(row) for row in rows]
+    directory = os.path.join(cache_dir, sentence_model_name.replace("/", "_"))
+    dim = sentence_model.get_sentence_embedding_dimension()
+    tier = DiskTier(directory, dim)
+
+    missing = {}
+    for key, row in zip(keys, rows):
+        if key not in tier and key not in missing:
+            missing[key] = row["title"]
+    print(f"Embeddings: {len(keys) - len(missing)} cached, {len(missing)} to encode")
+
+    missing_keys = list(missing)
+    for start in range(0, len(missing_keys), batch_size):
+        batch = missing_keys[start:start + batch_size]
+        tier.add_many(batch, sentence_model.encode([missing[key] for key in batch]))
+
+    embeddings, found = tier.get_many(keys)
+    if not found.all():
+        # Rows that didn't read back (e.g. a torn tail another writer truncated) are encoded here
+        misses = np.flatnonzero(~found)
+        print(f"Embeddings: {len(misses)} missing from the cache after writing, encoding them directly")
+        embeddings[misses] = sentence_model.encode([rows[i]["title"] for i in misses])
+    return embeddings
+
+
+def fit_pca(embeddings, n_components, sample_size=100000, seed=0):
+    from sklearn.decomposition import PCA
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(embeddings), min(sample_size, len(embeddings)), replace=False)
+    pca = PCA(n_components=n_components, random_state=seed)
+    pca.fit(embeddings[np.sort(sample)])
+    return pca
+
+
+def previous_pca(artifacts_path, sentence_model_name):
+    """The PCA from the current artifacts, if they exist and used this sentence model"""
+    try:
+        with open(artifacts_path, 'rb') as f:
+            artifacts = pickle.load(f)
+    except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+        return None
+    if artifacts.get('sentence_model_name') != sentence_model_name:
+        return None
+    return artifacts['pca']
+
+
+def make_pipeline(max_iter=300, learning_rate=0.1, seed=0):
+    from sklearn.compose import ColumnTransformer
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import OneHotEncoder
+
+    preprocess = ColumnTransformer(
+        [('categorical', OneHotEncoder(handle_unknown='ignore'), CATEGORICAL_COLUMNS)],
+        remainder='passthrough',
+    )
+    # HistGradientBoosting builds its histograms on every core through OpenMP
+    model = HistGradientBoostingRegressor(max_iter=max_iter, learning_rate=learning_rate, random_state=seed)
+    return Pipeline([('preprocess', preprocess), ('model', model)])
+
+
+def publish(src, dst):
+    """Copy src over dst atomically, so a reader never sees a half-written file"""
+    tmp_path = dst + ".tmp"
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def new_version_dir(models_dir):
+    """(version, path) of a newly created, empty directory under models_dir named by the UTC time"""
+    os.makedirs(models_dir, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+    attempt = 0
+    while True:
+        # Two runs finishing in the same second get -1, -2, ... rather than sharing a directory
+        version = stamp if attempt == 0 else f"{stamp}-{attempt}"
+        path = os.path.join(models_dir, version)
+        try:
+            os.mkdir(path)
+            return version, path
+        except FileExistsError:
+            attempt += 1
+
+
+def train(data_path, model_path=MODEL_PATH, artifacts_path=ARTIFACTS_PATH, artifact_dir=ARTIFACT_DIR,
+          sentence_model_name=SENTENCE_MODEL_NAME, n_components=10, refit_pca=False, pca_sample=100000,
+          cache_dir=CACHE_DIR, models_dir=MODELS_DIR, validation_fraction=0.1, max_iter=300, seed=0):
+    """Train on a crawl output and publish the model; returns the manifest"""
+    from sentence_transformers import SentenceTransformer
+
+    started = time.time()
+    rows = load_training_rows(data_path)
+    if len(rows) < 10:
+        raise ValueError(f"only {len(rows)} usable markets in {data_path}")
+    print(f"Training on {len(rows)} markets from {data_path}")
+
+    sentence_model = SentenceTransformer(sentence_model_name)
+    embeddings = cached_embeddings(rows, sentence_model, sentence_model_name, cache_dir)
+
+    pca = None if refit_pca else previous_pca(artifacts_path, sentence_model_name)
+    if pca is None:
+        pca = fit_pca(embeddings, n_components, pca_sample, seed)
+        print(f"Fitted PCA with {pca.n_components_} components on {min(pca_sample, len(rows))} markets")
+    else:
+        print(f"Reusing the current PCA ({pca.n_components_} components)")
+    title_emb = pca.transform(embeddings)
+
+    title_emb_cols = [f'title_emb_{i}' for i in range(pca.n_components_)]
+    feature_cols = ['duration', 'can_close_early'] + CATEGORICAL_COLUMNS + title_emb_cols + list(KEYWORD_FLAGS)
+    X = FeatureBuilder(feature_cols, title_emb_cols).transform(rows, title_emb, as_frame=True)
+    y = np.log1p(np.maximum(np.array([row["final_volume"] for row in rows], dtype=np.float64), 0))
+
+    rng = np.random.default_rng(seed)
+    holdout = rng.random(len(rows)) < validation_fraction
+    pipe = make_pipeline(max_iter=max_iter, seed=seed)
+    pipe.fit(X[~holdout], y[~holdout])
+    metrics = {}
+    if holdout.any():
+        from sklearn.metrics import mean_absolute_error, r2_score
+        y_pred = pipe.predict(X[holdout])
+        metrics = {
+            "validation_rows": int(holdout.sum()),
+            "mae_log1p": float(mean_absolute_error(y[holdout], y_pred)),
+            "r2_log1p": float(r2_score(y[holdout], y_pred)),
+        }
+        print(f"Validation: {metrics}")
+
+    version, version_dir = new_version_dir(models_dir)
+    artifacts = {
+        'pca': pca,
+        'pca_version': pca_fingerprint(pca),
+        'title_emb_cols': title_emb_cols,
+        'feature_cols': feature_cols,
+        'sentence_model_name': sentence_model_name,
+        'model_version': version,
+    }
+    manifest = {
+        "model_version": version,
+        "pca_version": artifacts['pca_version'],
+        "sentence_model_name": sentence_model_name,
+        "data": os.path.abspath(data_path),
+        "rows": len(rows),
+        "feature_cols": feature_cols,
+        "metrics": metrics,
+        "seconds": round(time.time() - started, 1),
+    }
+
+    with open(os.path.join(version_dir, os.path.basename(MODEL_PATH)), 'wb') as f:
+        pickle.dump(pipe, f)
+    with open(os.path.join(version_dir, os.path.basename(ARTIFACTS_PATH)), 'wb') as f:
+        pickle.dump(artifacts, f)
+    artifact_store.save(os.path.join(version_dir, ARTIFACT_DIR), pipe, artifacts)
+    with open(os.path.join(version_dir, "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    publish(os.path.join(version_dir, os.path.basename(MODEL_PATH)), model_path)
+    publish(os.path.join(version_dir, os.path.basename(ARTIFACTS_PATH)), artifacts_path)
+    artifact_store.publish_dir(os.path.join(version_dir, ARTIFACT_DIR), artifact_dir)
+    print(f"Model {version} written to {version_dir} and published to {model_path}, {artifacts_path}, {artifact_dir}")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the volume model from crawled markets")
+    parser.add_argument("data", help="crawl output (.arrow, .ndjson, .json or .parquet)")
+    parser.add_argument("--model", default=MODEL_PATH, help="where to publish the fitted pipeline")
+    parser.add_argument("--artifacts", default=ARTIFACTS_PATH, help="where to publish the artifacts")
+    parser.add_argument("--artifact-dir", default=ARTIFACT_DIR, help="symlink to the memory-mappable copy")
+    parser.add_argument("--sentence-model", default=SENTENCE_MODEL_NAME)
+    parser.add_argument("--components", type=int, default=10, help="PCA components, when the PCA is fitted")
+    parser.add_argument("--refit-pca", action="store_true", help="fit a new PCA even if the current one can be reused")
+    parser.add_argument("--pca-sample", type=int, default=100000, help="markets sampled to fit the PCA")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="per-market embedding cache")
+    parser.add_argument("--models-dir", default=MODELS_DIR, help="one subdirectory per trained version")
+    parser.add_argument("--max-iter", type=int, default=300, help="boosting iterations")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    train(
+        args.data,
+        model_path=args.model,
+        artifacts_path=args.artifacts,
+        artifact_dir=args.artifact_dir,
+        sentence_model_name=args.sentence_model,
+        n_components=args.components,
+        refit_pca=args.refit_pca,
+        pca_sample=args.pca_sample,
+        cache_dir=args.cache_dir,
+        models_dir=args.models_dir,
+        max_iter=args.max_iter,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,414 @@
 # predict_from_file.py
 import json
+import os
 import pickle
+import threading
+import time
+from collections import namedtuple
+
 import numpy as np
-import pandas as pd
-from sentence_transformers import SentenceTransformer
 
-def load_model():
-    """Load the trained model and artifacts"""
-    with open('volume_prediction_model.pkl', 'rb') as f:
+import artifact_store
+import market_io
+import metrics
+from embedding_cache import EmbeddingCache, pca_fingerprint
+from features import FeatureBuilder
+
+MODEL_PATH = 'volume_prediction_model.pkl'
+ARTIFACTS_PATH = 'model_artifacts.pkl'
+# Memory-mapped format (artifact_store.py) holding both; preferred when it exists
+ARTIFACT_DIR = 'model_artifacts'
+
+
+def default_artifacts_path(root=''):
+    """ARTIFACT_DIR under root if it has been written, else the pickled artifacts"""
+    directory = os.path.join(root, ARTIFACT_DIR)
+    return directory if artifact_store.is_artifact_dir(directory) else os.path.join(root, ARTIFACTS_PATH)
+
+
+def load_model(model_path=MODEL_PATH, artifacts_path=ARTIFACTS_PATH):
+    """Load the trained model and artifacts.
+
+    artifacts_path may be an artifact_store directory, which holds the
+    pipeline too (model_path is then ignored) and is memory-mapped.
+    """
+    if artifact_store.is_artifact_dir(artifacts_path):
+        return artifact_store.load(artifacts_path)
+
+    with open(model_path, 'rb') as f:
         pipe = pickle.load(f)
     
-    with open('model_artifacts.pkl', 'rb') as f:
+    with open(artifacts_path, 'rb') as f:
         artifacts = pickle.load(f)
     
     return pipe, artifacts
 
-def preprocess_new_data(data_json, artifacts):
-    # convert to df
-    if isinstance(data_json, dict):
-        df = pd.DataFrame([data_json])
-    else:
-        df = pd.DataFrame(data_json)
-    
-    df["duration"] = pd.to_numeric(df["duration"], errors="coerce")
-    df["can_close_early"] = df["can_close_early"].astype(int)
-    
-    titles = df['title'].tolist()
-    sentence_model = SentenceTransformer(artifacts['sentence_model_name'])  # FIXED
-    title_embeddings = sentence_model.encode(titles)
-    
+
+# Everything one loaded artifact set needs to predict. A reload builds a new one and swaps it
+# in with a single assignment, so a call that took a snapshot never mixes two model versions
+LoadedModel = namedtuple(
+    'LoadedModel', ['pipe', 'artifacts', 'sentence_model', 'embedding_cache', 'feature_builder', 'as_frame'])
+
+
+class Predictor:
+    """Keeps the pipeline, PCA and SentenceTransformer loaded for the life of the process.
+
+    The artifact files are stat'ed at most every `check_interval` seconds and
+    reloaded if their mtime changed, so a retrained model is picked up
+    without restarting. Each call works from one LoadedModel snapshot.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, artifacts_path=None, check_interval=5.0,
+                 embedding_cache_size=100000, embedding_cache_dir=None):
+        self.model_path = model_path
+        self.artifacts_path = artifacts_path or default_artifacts_path()
+        self.check_interval = check_interval
+        self.embedding_cache_size = embedding_cache_size
+        self.embedding_cache_dir = embedding_cache_dir
+        self.model = None
+        self._mtimes = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _file_mtimes(self):
+        if artifact_store.is_artifact_dir(self.artifacts_path):
+            # The manifest is replaced last; realpath notices a re-pointed symlink
+            manifest = artifact_store.manifest_path(self.artifacts_path)
+            return os.path.realpath(manifest), os.path.getmtime(manifest)
+        return os.path.getmtime(self.model_path), os.path.getmtime(self.artifacts_path)
+
+    def load(self):
+        """(Re)load everything from disk"""
+        with self._lock:
+            mtimes = self._file_mtimes()
+            pipe, artifacts = load_model(self.model_path, self.artifacts_path)
+            previous = self.model
+            # The sentence model is the slow part, only rebuild it if the name changed
+            if previous is None or artifacts['sentence_model_name'] != previous.artifacts['sentence_model_name']:
+                sentence_model = load_sentence_model(artifacts['sentence_model_name'])
+            else:
+                sentence_model = previous.sentence_model
+            embedding_cache = make_embedding_cache(
+                artifacts, capacity=self.embedding_cache_size, disk_dir=self.embedding_cache_dir)
+            self.model = LoadedModel(
+                pipe=pipe,
+                artifacts=artifacts,
+                sentence_model=sentence_model,
+                embedding_cache=embedding_cache,
+                feature_builder=FeatureBuilder(artifacts['feature_cols'], artifacts['title_emb_cols']),
+                # Pipelines fitted on a DataFrame look columns up by name
+                as_frame=hasattr(pipe, 'feature_names_in_'),
+            )
+            metrics.register_stats("embedding_cache", embedding_cache.stats)
+            self._mtimes = mtimes
+            self._last_check = time.monotonic()
+
+    def reload_if_changed(self):
+        """Reload if the artifact files changed on disk; returns True if it did"""
+        if self._mtimes is not None:
+            now = time.monotonic()
+            if now - self._last_check < self.check_interval:
+                return False
+            self._last_check = now
+            if self._file_mtimes() == self._mtimes:
+                return False
+        self.load()
+        return True
+
+    def warm_up(self, encode=True):
+        """Load everything and run one encode so the first real request isn't slow.
+
+        encode=False only loads, for a process that is about to fork: torch's
+        thread pools don't survive a fork once they have been used.
+        """
+        self.reload_if_changed()
+        if encode:
+            self.model.sentence_model.encode(["warm up"])
+        return self
+
+    def current(self):
+        """The LoadedModel in use now, reloading first if the files changed"""
+        self.reload_if_changed()
+        return self.model
+
+    # Read-only views of the current snapshot, for callers that need just one piece
+    @property
+    def pipe(self):
+        return self.model.pipe if self.model is not None else None
+
+    @property
+    def artifacts(self):
+        return self.model.artifacts if self.model is not None else None
+
+    @property
+    def sentence_model(self):
+        return self.model.sentence_model if self.model is not None else None
+
+    @property
+    def embedding_cache(self):
+        return self.model.embedding_cache if self.model is not None else None
+
+    @property
+    def feature_builder(self):
+        return self.model.feature_builder if self.model is not None else None
+
+    def embed(self, titles, model=None):
+        """PCA-reduced embeddings for a list of titles, through the embedding cache"""
+        model = model or self.model
+        pca = model.artifacts['pca']
+        return model.embedding_cache.get_many(
+            titles, lambda batch: encode_titles(batch, model.sentence_model, pca))
+
+    def encode(self, titles, model=None):
+        """Full sentence embeddings for a list of titles, before the PCA (not cached)"""
+        model = model or self.model
+        with metrics.timer("predict.encode"):
+            return model.sentence_model.encode(titles)
+
+    def predict_records(self, records):
+        """Predicted volumes for a list of market dicts, without building intermediate DataFrames"""
+        model = self.current()
+        if isinstance(records, dict):
+            records = [records]
+        title_emb = self.embed([str(r.get('title', '')) for r in records], model)
+        X = model.feature_builder.transform(records, title_emb, as_frame=model.as_frame)
+        with metrics.timer("predict.model"):
+            return np.expm1(model.pipe.predict(X))
+
+    def predict(self, data_json):
+        """(predictions, DataFrame of the inputs) for callers that want the frame too"""
+        import pandas as pd
+
+        records = [data_json] if isinstance(data_json, dict) else list(data_json)
+        y_pred = self.predict_records(records)
+        return y_pred, pd.DataFrame(records)
+
+
+def make_embedding_cache(artifacts, capacity=100000, disk_dir=None):
+    """EmbeddingCache keyed to this artifact set's sentence model and PCA"""
     pca = artifacts['pca']
-    title_emb_reduced = pca.transform(title_embeddings)
-    
-    # create embedding df
-    title_emb_cols = artifacts['title_emb_cols']
-    title_emb_df = pd.DataFrame(title_emb_reduced, columns=title_emb_cols)
-    df = pd.concat([df.reset_index(drop=True), title_emb_df.reset_index(drop=True)], axis=1)
-    
-    df['is_major_event'] = df['title'].str.contains(
-        'championship|final|cup|election|champion', 
-        case=False, regex=True
-    ).astype(int)
-    
-    df['is_major_sport'] = df['title'].str.contains(
-        'NFL|NBA|MLB|Premier League', 
-        case=False, regex=True
-    ).astype(int)
-    
-    feature_cols = artifacts['feature_cols']
-    X = df[feature_cols]
-    
-    return X, df
+    return EmbeddingCache(
+        artifacts['sentence_model_name'],
+        artifacts.get('pca_version') or pca_fingerprint(pca),
+        dim=pca.n_components_,
+        capacity=capacity,
+        disk_dir=disk_dir,
+    )
+
+
+def load_sentence_model(name):
+    """SentenceTransformer by name. Imported here, not at the top: it pulls in torch,
+    which takes seconds and isn't needed by code that never encodes"""
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(name)
+
+
+def encode_titles(titles, sentence_model, pca):
+    """Sentence embeddings reduced with the fitted PCA"""
+    with metrics.timer("predict.encode"):
+        embeddings = sentence_model.encode(titles)
+    with metrics.timer("predict.pca"):
+        return pca.transform(embeddings)
+
+
+_predictor = None
+_predictor_lock = threading.Lock()
+
+
+def get_predictor():
+    """Process-wide Predictor, created on first use"""
+    global _predictor
+    if _predictor is None:
+        with _predictor_lock:
+            if _predictor is None:
+                _predictor = Predictor()
+    return _predictor
+
+
+def preprocess_new_data(data_json, artifacts, sentence_model=None, embedding_cache=None):
+    """(model input, DataFrame of the inputs) built by FeatureBuilder, the one feature definition"""
+    import pandas as pd
+
+    records = [data_json] if isinstance(data_json, dict) else list(data_json)
+    titles = [str(r.get('title', '')) for r in records]
+    if sentence_model is None:
+        sentence_model = load_sentence_model(artifacts['sentence_model_name'])
+    pca = artifacts['pca']
+    if embedding_cache is not None:
+        # Only titles the cache hasn't seen are encoded
+        title_emb = embedding_cache.get_many(titles, lambda batch: encode_titles(batch, sentence_model, pca))
+    else:
+        title_emb = encode_titles(titles, sentence_model, pca)
+
+    X = FeatureBuilder(artifacts['feature_cols'], artifacts['title_emb_cols']).transform(records, title_emb)
+    return X, pd.DataFrame(records)
 
 
 def predict_volume(data_json):
-    pipe, artifacts = load_model()
+    return get_predictor().predict(data_json)
 
-    X, df_full = preprocess_new_data(data_json, artifacts)
 
-    y_pred_log = pipe.predict(X)
-    y_pred = np.expm1(y_pred_log)
-    
-    return y_pred, df_full
+def score_records(records, predictor=None):
+    """Predict a list of market dicts and return the result rows"""
+    predictor = predictor or get_predictor()
+    predictions = predictor.predict_records(records)
+    return [
+        {
+            'title': record.get('title'),
+            'category': record.get('category'),
+            'predicted_volume': int(pred),
+            'duration': record.get('duration'),
+        }
+        for record, pred in zip(records, predictions.tolist())
+    ]
 
 
 def predict_from_json_file(filepath):
-    with open(filepath, 'r') as f:
-        data = json.load(f)
-    
-    predictions, df = predict_volume(data)
-    
-    results = []
-    for idx, pred in enumerate(predictions):
-        results.append({
-            'title': df['title'].iloc[idx],
-            'category': df['category'].iloc[idx],
-            'predicted_volume': int(pred),
-            'duration': df['duration'].iloc[idx]
-        })
-    
-    return results
+    # .ndjson/.jsonl/.parquet/.arrow crawler output goes through the faster columnar readers
+    if market_io.output_format(filepath) == "json":
+        with open(filepath, 'r') as f:
+            data = json.load(f)
+    else:
+        data = market_io.read_dataframe(filepath).to_dict("records")
+
+    return score_records(data)
+
+
+def _iter_json_array(f, read_size=1 << 20):
+    """Yield the elements of a top-level JSON array without parsing the whole file at once"""
+    decoder = json.JSONDecoder()
+    buf = f.read(read_size).lstrip()
+    if not buf.startswith('['):
+        raise ValueError("expected a JSON array")
+    buf = buf[1:]
+    eof = False
+    while True:
+        buf = buf.lstrip().lstrip(',').lstrip()
+        if buf.startswith(']'):
+            return
+        try:
+            obj, end = decoder.raw_decode(buf)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The element straddles the read boundary, pull in more
+            more = f.read(read_size)
+            eof = not more
+            buf += more
+            continue
+        yield obj
+        buf = buf[end:]
+        if len(buf) < read_size and not eof:
+            more = f.read(read_size)
+            eof = not more
+            buf += more
+
+
+def iter_input_records(filepath):
+    """Stream market dicts from a JSON array, NDJSON, Parquet or Arrow file"""
+    fmt = market_io.output_format(filepath)
+    if fmt != "json":
+        yield from market_io.iter_rows(filepath)
+        return
+    with open(filepath, 'r', encoding='utf-8') as f:
+        yield from _iter_json_array(f)
+
+
+def iter_chunks(records, batch_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == batch_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _init_worker(model_path, artifacts_path, embedding_cache_dir):
+    global _predictor
+    _predictor = Predictor(model_path, artifacts_path, embedding_cache_dir=embedding_cache_dir).warm_up()
+
+
+def _score_chunk(records):
+    return score_records(records)
+
+
+def predict_file(input_path, output_path, batch_size=1000, workers=1,
+                 model_path=MODEL_PATH, artifacts_path=None, embedding_cache_dir=None):
+    """Bulk-score input_path into output_path chunk by chunk; returns the number of rows written.
+
+    Input is streamed, every chunk goes through one encode -> PCA -> pipe.predict,
+    and results are written as they come back, so memory is bounded by
+    batch_size * workers rather than by the file size. With workers > 1 the
+    chunks are spread over a process pool, each process loading the model once.
+    """
+    chunks = iter_chunks(iter_input_records(input_path), batch_size)
+    fmt = market_io.output_format(output_path)
+
+    with market_io.open_sink(output_path, fmt=fmt, columns=None) as sink:
+        if workers <= 1:
+            predictor = Predictor(model_path, artifacts_path, embedding_cache_dir=embedding_cache_dir)
+            for chunk in chunks:
+                sink.write_page(score_records(chunk, predictor))
+        else:
+            _score_in_pool(chunks, sink, workers, model_path, artifacts_path, embedding_cache_dir)
+    # Buffered sinks (Parquet, Arrow) only count rows once they are flushed on close
+    return sink.rows_written
+
+
+def _score_in_pool(chunks, sink, workers, model_path, artifacts_path, embedding_cache_dir):
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(model_path, artifacts_path, embedding_cache_dir),
+    ) as pool:
+        # Keep a couple of chunks queued per worker and write results back in input order
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(pool.submit(_score_chunk, chunk))
+            if len(in_flight) >= workers * 2:
+                sink.write_page(in_flight.popleft().result())
+        while in_flight:
+            sink.write_page(in_flight.popleft().result())
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Predict market volume for a JSON / NDJSON / Parquet / Arrow file of markets")
+    parser.add_argument("input", nargs="?", default="test.json")
+    parser.add_argument("-o", "--output", help="write results here (.ndjson, .json, .parquet or .arrow) instead of printing")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=1, help="processes to score chunks in parallel")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--artifacts", default=default_artifacts_path(), help="pickled artifacts or an artifact directory")
+    parser.add_argument("--embedding-cache-dir", help="directory for the on-disk embedding cache")
+    args = parser.parse_args()
+
+    if args.output:
+        n = predict_file(
+            args.input, args.output,
+            batch_size=args.batch_size, workers=args.workers,
+            model_path=args.model, artifacts_path=args.artifacts,
+            embedding_cache_dir=args.embedding_cache_dir,
+        )
+        print(f"Wrote {n} predictions to {args.output}")
+        return
+
+    global _predictor
+    _predictor = Predictor(args.model, args.artifacts, embedding_cache_dir=args.embedding_cache_dir)
+    results = predict_from_json_file(args.input)
 
-if __name__ == "__main__":
-    results = predict_from_json_file('test.json')
-    
     for r in results:
         print(f"\n{r['title']}")
         print(f"  Category: {r['category']}")
         print(f"  Predicted Volume: {r['predicted_volume']:,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""On-disk cache of /series metadata (category, frequency) keyed by series ticker.
+
+A series' category and frequency almost never change, so lookups are kept in
+SQLite between crawls and only refreshed once they are older than the TTL.
+All fresh rows are loaded into memory in one query at startup, so the hot
+path is a dict lookup.
+"""
+import sqlite3
+import time
+
+DEFAULT_TTL = 7 * 24 * 3600
+
+
+class SeriesCache:
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        """path=None keeps everything in memory for the life of the process"""
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # series_ticker -> (category, frequency, fetched_at)
+        self._memory = {}
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS series ("
+                " series_ticker TEXT PRIMARY KEY,"
+                " category TEXT,"
+                " frequency TEXT,"
+                " fetched_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def __contains__(self, series_ticker):
+        return self.get(series_ticker, count=False) is not None
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _fresh(self, fetched_at, now=None):
+        return self.ttl is None or (now or time.time()) - fetched_at < self.ttl
+
+    def warm(self):
+        """Load every non-expired row from disk in one pass; returns how many were loaded"""
+        if self._db is None:
+            return 0
+        cutoff = 0 if self.ttl is None else time.time() - self.ttl
+        rows = self._db.execute(
+            "SELECT series_ticker, category, frequency, fetched_at FROM series WHERE fetched_at >= ?",
+            (cutoff,),
+        ).fetchall()
+        for series_ticker, category, frequency, fetched_at in rows:
+            self._memory[series_ticker] = (category, frequency, fetched_at)
+        return len(rows)
+
+    def get(self, series_ticker, count=True):
+        """(category, frequency) if cached and not expired, else None"""
+        entry = self._memory.get(series_ticker)
+        if entry is not None and self._fresh(entry[2]):
+            if count:
+                self.hits += 1
+            return entry[0], entry[1]
+        if count:
+            self.misses += 1
+        return None
+
+    def put(self, series_ticker, category, frequency, persist=True):
+        self.put_many([(series_ticker, category, frequency)], persist=persist)
+
+    def put_many(self, rows, persist=True):
+        """rows: iterable of (series_ticker, category, frequency)"""
+        now = time.time()
+        rows = [(t, c, f, now) for t, c, f in rows]
+        for series_ticker, category, frequency, fetched_at in rows:
+            self._memory[series_ticker] = (category, frequency, fetched_at)
+        if persist and self._db is not None and rows:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO series (series_ticker, category, frequency, fetched_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._memory),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,337 @@
+"""Append-only, time-partitioned store of market volume snapshots.
+
+volume_poller.py writes one poll of every open market at a time, but only
+the markets whose volume changed since their last stored value (delta
+encoding), so the history of a ticker is a step function: its volume at time
+t is the last record at or before t.
+
+    <root>/store.json                   partition length
+    <root>/<YYYYMMDDTHHMM>/tickers.txt  the partition's tickers, line number = id
+    <root>/<YYYYMMDDTHHMM>/log.bin      records appended as they are polled
+    <root>/<YYYYMMDDTHHMM>/polls.bin    one (ts, markets, changed, complete) per poll
+
+A record is 16 bytes: ticker id, poll time (epoch seconds) and volume. The
+first poll into a partition writes every market, so each partition stands on
+its own and old ones can be deleted or moved freely. Writer memory is the
+last volume of each market open in the current partition, nothing more.
+
+Once a partition is over it is sealed: the records are rewritten sorted by
+ticker and time (data.npy) next to an index of each ticker's slice
+(index.npy), both read with a memory map. history() is then a binary search
+per partition; the open partition is scanned from log.bin.
+
+    python snapshot_store.py volume_snapshots KXHIGHNY-25JAN01-T40   # print a ticker's history
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+RECORD_DTYPE = np.dtype([("ticker", "<u4"), ("ts", "<u4"), ("volume", "<i8")])
+POLL_DTYPE = np.dtype([("ts", "<u4"), ("markets", "<u4"), ("changed", "<u4"), ("complete", "<u4")])
+STORE_FILE = "store.json"
+TICKERS_FILE = "tickers.txt"
+LOG_FILE = "log.bin"
+POLLS_FILE = "polls.bin"
+DATA_FILE = "data.npy"
+INDEX_FILE = "index.npy"
+DEFAULT_PARTITION_SECONDS = 24 * 3600
+
+
+def partition_name(start):
+    return time.strftime("%Y%m%dT%H%M", time.gmtime(start))
+
+
+def read_records(path, dtype=RECORD_DTYPE):
+    """Every whole record in an append-only file (a torn last record is ignored)"""
+    if not os.path.exists(path):
+        return np.empty(0, dtype=dtype)
+    count = os.path.getsize(path) // dtype.itemsize
+    return np.fromfile(path, dtype=dtype, count=count)
+
+
+def read_tickers(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        # A line without its newline was cut off mid-write
+        return [line[:-1] for line in f if line.endswith("\n")]
+
+
+def last_per_ticker(records):
+    """The latest record of each ticker id in records"""
+    if not len(records):
+        return records
+    order = np.lexsort((records["ts"], records["ticker"]))
+    ordered = records[order]
+    last = np.ones(len(ordered), dtype=bool)
+    last[:-1] = ordered["ticker"][1:] != ordered["ticker"][:-1]
+    return ordered[last]
+
+
+class SnapshotStore:
+
+    def __init__(self, root, partition_seconds=None):
+        """partition_seconds only applies to a new store; an existing one keeps its own"""
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        store_path = os.path.join(root, STORE_FILE)
+        if os.path.exists(store_path):
+            with open(store_path, "r") as f:
+                self.partition_seconds = json.load(f)["partition_seconds"]
+        else:
+            self.partition_seconds = int(partition_seconds or DEFAULT_PARTITION_SECONDS)
+            with open(store_path, "w") as f:
+                json.dump({"partition_seconds": self.partition_seconds}, f)
+
+        # Writer state for the open partition
+        self.partition = None
+        self.ticker_ids = {}
+        self.last_volume = {}
+        self.seen = set()
+        self.poll_ts = None
+        self.poll_markets = 0
+        self.poll_changed = 0
+        self.records_written = 0
+        self._tickers = None
+        self._log = None
+
+    # --- reading ---
+
+    def partitions(self, start=None, end=None):
+        """Partition directory names overlapping [start, end], oldest first"""
+        names = sorted(
+            name for name in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, name)) and name[:8].isdigit()
+        )
+        selected = []
+        for name in names:
+            begins = self._partition_start(name)
+            if end is not None and begins > end:
+                continue
+            if start is not None and begins + self.partition_seconds <= start:
+                continue
+            selected.append(name)
+        return selected
+
+    def is_sealed(self, name):
+        return os.path.exists(os.path.join(self.root, name, DATA_FILE))
+
+    def history(self, ticker, start=None, end=None):
+        """(ts, volume) arrays of every stored change of ticker between start and end"""
+        chunks = []
+        for name in self.partitions(start, end):
+            directory = os.path.join(self.root, name)
+            if self.is_sealed(name):
+                index = np.load(os.path.join(directory, INDEX_FILE), mmap_mode="r")
+                key = ticker.encode("utf-8")
+                i = np.searchsorted(index["ticker"], key)
+                if i == len(index) or index["ticker"][i] != key:
+                    continue
+                data = np.load(os.path.join(directory, DATA_FILE), mmap_mode="r")
+                records = np.array(data[index["start"][i]:index["stop"][i]])
+            else:
+                tickers = read_tickers(os.path.join(directory, TICKERS_FILE))
+                if ticker not in tickers:
+                    continue
+                records = read_records(os.path.join(directory, LOG_FILE))
+                records = records[records["ticker"] == tickers.index(ticker)]
+            chunks.append(records)
+
+        records = np.concatenate(chunks) if chunks else np.empty(0, dtype=RECORD_DTYPE)
+        keep = np.ones(len(records), dtype=bool)
+        if start is not None:
+            keep &= records["ts"] >= start
+        if end is not None:
+            keep &= records["ts"] <= end
+        records = records[keep]
+        return records["ts"].astype(np.int64), records["volume"]
+
+    def snapshot_at(self, ts):
+        """ticker -> volume as of ts, from the partition holding the last poll at or before ts"""
+        for name in reversed(self.partitions(end=ts)):
+            directory = os.path.join(self.root, name)
+            if self.is_sealed(name):
+                records = np.load(os.path.join(directory, DATA_FILE), mmap_mode="r")
+            else:
+                records = read_records(os.path.join(directory, LOG_FILE))
+            records = last_per_ticker(records[records["ts"] <= ts])
+            if not len(records):
+                continue
+            tickers = read_tickers(os.path.join(directory, TICKERS_FILE))
+            return {tickers[i]: v for i, v in zip(records["ticker"].tolist(), records["volume"].tolist())}
+        return {}
+
+    def polls(self, name):
+        return read_records(os.path.join(self.root, name, POLLS_FILE), POLL_DTYPE)
+
+    def stats(self):
+        names = self.partitions()
+        size = 0
+        for name in names:
+            directory = os.path.join(self.root, name)
+            size += sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+        return {
+            "partitions": len(names),
+            "bytes": size,
+            "records_written": self.records_written,
+            "open_markets": len(self.last_volume),
+        }
+
+    # --- writing ---
+
+    def begin_poll(self, ts):
+        """Start a poll stamped ts, rolling over (and sealing) the partition if ts is past it"""
+        ts = int(ts)
+        name = partition_name(ts - ts % self.partition_seconds)
+        if name != self.partition:
+            self._open_partition(name)
+        self.poll_ts = ts
+        self.poll_markets = 0
+        self.poll_changed = 0
+        self.seen = set()
+
+    def record(self, tickers, volumes):
+        """Append the markets of one page whose volume changed; returns how many were written"""
+        last_volume = self.last_volume
+        changed = []
+        for ticker, volume in zip(tickers, volumes):
+            self.seen.add(ticker)
+            if last_volume.get(ticker) != volume:
+                last_volume[ticker] = volume
+                changed.append((ticker, volume))
+        self.poll_markets += len(tickers)
+        if not changed:
+            return 0
+
+        new_tickers = [ticker for ticker, _ in changed if ticker not in self.ticker_ids]
+        if new_tickers:
+            for ticker in new_tickers:
+                self.ticker_ids[ticker] = len(self.ticker_ids)
+            # Names go to disk before any record that refers to them
+            self._tickers.write("".join(ticker + "\n" for ticker in new_tickers))
+            self._tickers.flush()
+
+        records = np.empty(len(changed), dtype=RECORD_DTYPE)
+        records["ticker"] = [self.ticker_ids[ticker] for ticker, _ in changed]
+        records["ts"] = self.poll_ts
+        records["volume"] = [volume for _, volume in changed]
+        self._log.write(records.tobytes())
+        self.poll_changed += len(changed)
+        self.records_written += len(changed)
+        return len(changed)
+
+    def end_poll(self, complete=True):
+        """Make the poll durable; after a complete poll, markets it didn't see (closed) are forgotten"""
+        self._tickers.flush()
+        self._log.flush()
+        os.fsync(self._tickers.fileno())
+        os.fsync(self._log.fileno())
+        if complete:
+            for ticker in [t for t in self.last_volume if t not in self.seen]:
+                del self.last_volume[ticker]
+        self.seen = set()
+        poll = np.array([(self.poll_ts, self.poll_markets, self.poll_changed, int(complete))], dtype=POLL_DTYPE)
+        with open(os.path.join(self.root, self.partition, POLLS_FILE), "ab") as f:
+            f.write(poll.tobytes())
+        return self.poll_changed
+
+    def seal(self, name):
+        """Rewrite a finished partition's log sorted by ticker and time, with its index"""
+        directory = os.path.join(self.root, name)
+        records = read_records(os.path.join(directory, LOG_FILE))
+        # Stored as bytes: tickers are ASCII, and a unicode array takes four bytes a character
+        tickers = np.array([t.encode("utf-8") for t in read_tickers(os.path.join(directory, TICKERS_FILE))], dtype=bytes)
+        if len(tickers) == 0:
+            tickers = np.empty(0, dtype="S1")
+        records = records[records["ticker"] < len(tickers)]
+
+        # Rank of each ticker id by name, so the index can be binary searched by ticker
+        rank = np.empty(len(tickers), dtype=np.int64)
+        rank[np.argsort(tickers, kind="stable")] = np.arange(len(tickers))
+        record_rank = rank[records["ticker"]]
+        order = np.lexsort((records["ts"], record_rank))
+        records = records[order]
+        record_rank = record_rank[order]
+
+        by_name = np.argsort(tickers, kind="stable")
+        index = np.empty(len(tickers), dtype=[("ticker", tickers.dtype), ("start", "<i8"), ("stop", "<i8")])
+        index["ticker"] = tickers[by_name]
+        index["start"] = np.searchsorted(record_rank, np.arange(len(tickers)), side="left")
+        index["stop"] = np.searchsorted(record_rank, np.arange(len(tickers)), side="right")
+
+        # data.npy marks the partition sealed, so it is written last
+        for filename, array in ((INDEX_FILE, index), (DATA_FILE, records)):
+            tmp_path = os.path.join(directory, filename + ".tmp.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, os.path.join(directory, filename))
+        if os.path.exists(os.path.join(directory, LOG_FILE)):
+            os.remove(os.path.join(directory, LOG_FILE))
+        return len(records)
+
+    def close(self):
+        for f in (self._tickers, self._log):
+            if f is not None:
+                f.close()
+        self._tickers = self._log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _partition_start(self, name):
+        return float(np.datetime64(f"{name[:4]}-{name[4:6]}-{name[6:8]}T{name[9:11]}:{name[11:13]}", "s")
+                     .astype(np.int64))
+
+    def _open_partition(self, name):
+        self.close()
+        # Seal every earlier partition left open, e.g. by a poller that was stopped
+        for earlier in self.partitions():
+            if earlier < name and not self.is_sealed(earlier):
+                print(f"Sealing partition {earlier}: {self.seal(earlier)} records")
+
+        directory = os.path.join(self.root, name)
+        os.makedirs(directory, exist_ok=True)
+        tickers_path = os.path.join(directory, TICKERS_FILE)
+        log_path = os.path.join(directory, LOG_FILE)
+        tickers = read_tickers(tickers_path)
+        records = read_records(log_path)
+
+        # Drop whatever a crash left half-written, so appends start on a boundary
+        with open(tickers_path, "a", encoding="utf-8") as f:
+            f.truncate(sum(len(t.encode("utf-8")) + 1 for t in tickers))
+        with open(log_path, "ab") as f:
+            f.truncate(len(records) * RECORD_DTYPE.itemsize)
+
+        # Picking up a partition after a restart: carry on from its stored values
+        self.ticker_ids = {ticker: i for i, ticker in enumerate(tickers)}
+        last = last_per_ticker(records[records["ticker"] < len(tickers)])
+        self.last_volume = {tickers[i]: v for i, v in zip(last["ticker"].tolist(), last["volume"].tolist())}
+        self.partition = name
+        self._tickers = open(tickers_path, "a", encoding="utf-8")
+        self._log = open(log_path, "ab")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Print a ticker's stored volume history")
+    parser.add_argument("root", help="volume_poller.py --store directory")
+    parser.add_argument("ticker")
+    parser.add_argument("--seal", action="store_true", help="seal every partition before the newest first")
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.root)
+    if args.seal:
+        for name in store.partitions()[:-1]:
+            if not store.is_sealed(name):
+                print(f"Sealed {name}: {store.seal(name)} records")
+    for ts, volume in zip(*store.history(args.ticker)):
+        print(f"{time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))}  {volume}")
+
+
+if __name__ == "__main__":
+    main()
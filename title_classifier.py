@@ -0,0 +1,128 @@
+"""Offline classifier for a market title's category, frequency and can_close_early.
+
+Trained on crawled markets (Market.to_dict already carries all three
+labels), using the same PCA-reduced sentence embeddings predict.py feeds the
+volume model, so at serving time the embedding is computed once and reused.
+Each label is a logistic regression; a prediction is only trusted when every
+label's top probability clears the confidence threshold, otherwise the web
+app falls back to the LLM.
+
+    python title_classifier.py data.ndjson            # train -> title_classifier.pkl
+"""
+import argparse
+import pickle
+
+import numpy as np
+
+CLASSIFIER_PATH = 'title_classifier.pkl'
+LABELS = ["category", "frequency", "can_close_early"]
+
+
+class TitleClassifier:
+
+    def __init__(self, models, sentence_model_name=None, pca_version=None, threshold=0.6):
+        self.models = models
+        self.sentence_model_name = sentence_model_name
+        self.pca_version = pca_version
+        self.threshold = threshold
+
+    @classmethod
+    def fit(cls, embeddings, rows, sentence_model_name=None, pca_version=None, threshold=0.6, max_iter=1000):
+        """Fit one classifier per label on (n, dim) embeddings and the matching market dicts"""
+        from sklearn.linear_model import LogisticRegression
+
+        models = {}
+        for label in LABELS:
+            y = np.array([row.get(label) for row in rows], dtype=object)
+            known = np.array([v is not None for v in y])
+            classes = set(y[known].tolist())
+            if len(classes) < 2:
+                print(f"Skipping {label}: only {len(classes)} class in the training data")
+                continue
+            model = LogisticRegression(max_iter=max_iter)
+            model.fit(embeddings[known], y[known].astype(str))
+            models[label] = model
+        return cls(models, sentence_model_name, pca_version, threshold)
+
+    def predict_proba(self, embeddings):
+        """Per row: {label: (value, probability)} for every trained label"""
+        embeddings = np.atleast_2d(embeddings)
+        results = [{} for _ in range(len(embeddings))]
+        for label, model in self.models.items():
+            proba = model.predict_proba(embeddings)
+            best = proba.argmax(axis=1)
+            for row, (i, p) in enumerate(zip(best, proba[np.arange(len(best)), best])):
+                value = str(model.classes_[i])
+                if label == "can_close_early":
+                    value = value == "True"
+                results[row][label] = (value, float(p))
+        return results
+
+    def classify(self, embedding):
+        """(labels dict, confident) for one embedding"""
+        scored = self.predict_proba(embedding)[0]
+        labels = {label: value for label, (value, _) in scored.items()}
+        confident = len(scored) == len(LABELS) and all(p >= self.threshold for _, p in scored.values())
+        return labels, confident
+
+    def compatible_with(self, artifacts):
+        """True if trained on the same sentence model / PCA as these predict.py artifacts"""
+        if self.pca_version is None:
+            return True
+        from embedding_cache import pca_fingerprint
+        version = artifacts.get('pca_version') or pca_fingerprint(artifacts['pca'])
+        return version == self.pca_version and artifacts['sentence_model_name'] == self.sentence_model_name
+
+    def save(self, path=CLASSIFIER_PATH):
+        # A plain dict, so loading doesn't depend on how this module was imported
+        with open(path, 'wb') as f:
+            pickle.dump({
+                'models': self.models,
+                'sentence_model_name': self.sentence_model_name,
+                'pca_version': self.pca_version,
+                'threshold': self.threshold,
+            }, f)
+
+
+def load_classifier(path=CLASSIFIER_PATH):
+    with open(path, 'rb') as f:
+        return TitleClassifier(**pickle.load(f))
+
+
+def train_from_file(data_path, predictor, output_path=CLASSIFIER_PATH, threshold=0.6):
+    """Train on a crawl output file using predictor's embeddings and save the classifier"""
+    import market_io
+    from embedding_cache import pca_fingerprint
+
+    rows = [row for row in market_io.iter_rows(data_path) if row.get("title")]
+    model = predictor.current()
+    embeddings = predictor.embed([row["title"] for row in rows], model)
+    artifacts = model.artifacts
+    classifier = TitleClassifier.fit(
+        embeddings, rows,
+        sentence_model_name=artifacts['sentence_model_name'],
+        pca_version=artifacts.get('pca_version') or pca_fingerprint(artifacts['pca']),
+        threshold=threshold,
+    )
+    classifier.save(output_path)
+    print(f"Trained on {len(rows)} markets, labels: {sorted(classifier.models)} -> {output_path}")
+    return classifier
+
+
+def main():
+    import predict
+
+    parser = argparse.ArgumentParser(description="Train the local title classifier from crawled markets")
+    parser.add_argument("data", help="crawl output (.arrow, .ndjson, .json or .parquet)")
+    parser.add_argument("-o", "--output", default=CLASSIFIER_PATH)
+    parser.add_argument("--threshold", type=float, default=0.6, help="min probability to skip the LLM")
+    parser.add_argument("--model", default=predict.MODEL_PATH)
+    parser.add_argument("--artifacts", default=predict.default_artifacts_path())
+    args = parser.parse_args()
+
+    predictor = predict.Predictor(args.model, args.artifacts)
+    train_from_file(args.data, predictor, args.output, threshold=args.threshold)
+
+
+if __name__ == "__main__":
+    main()
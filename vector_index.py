@@ -0,0 +1,354 @@
+"""Approximate nearest-neighbour search over PCA-reduced title embeddings.
+
+The vectors are the ones predict.py already computes for the volume model
+(Predictor.embed), normalised so a dot product is cosine similarity. An
+index directory holds:
+
+    vectors.f32     append-only float32 matrix, memory-mapped for reads
+    ids.txt         the id of each row, one per line
+    cells.N.i32     the IVF cell of each row (-1 until the index is trained)
+    centroids.N.npy k-means centroids of the cells
+    meta.json       row count, dim, sentence model / PCA version, training info
+                    and which cells/centroids files are current
+
+meta.json is replaced last on every write and only `rows` rows of the other
+files are trusted, so a reader never sees a half-written batch. A training
+run writes its cells and centroids under new names (N counts the runs), which
+go live when meta.json names them. Writers (add, train) hold an fcntl lock
+on write.lock and re-read meta.json under it, so several processes can add
+to one index without discarding each other's rows.
+
+Below `min_train_rows` a search scans every vector. Past that the vectors
+are clustered with spherical k-means on a sample and a query only scans the
+`nprobe` cells whose centroids are closest. Rows added later are assigned to
+their nearest existing centroid, so the index grows incrementally; once it
+has grown to `retrain_factor` times what the centroids were fitted on they
+are refitted.
+
+    python vector_index.py data.ndjson                 # add new markets to ./vector_index
+"""
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+INDEX_DIR = 'vector_index'
+
+
+def normalize_rows(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def spherical_kmeans(vectors, n_clusters, iterations=10, seed=0):
+    """Centroids (unit length) of unit vectors, clustering by cosine similarity"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = (vectors @ centroids.T).argmax(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        # Empty cells restart from a random point instead of dying
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IndexState:
+    """Everything a search needs, swapped in as one object when the index changes"""
+
+    def __init__(self, ids, cells, centroids, vectors):
+        self.ids = ids
+        self.row_of = {id_: row for row, id_ in enumerate(ids)}
+        self.cells = cells
+        self.centroids = centroids
+        self.vectors = vectors
+        self.order = None
+        self.offsets = None
+        if centroids is not None and len(cells):
+            # Rows grouped by cell: rows of cell c are order[offsets[c]:offsets[c + 1]]
+            # (unassigned rows, cell -1, come first)
+            self.order = np.argsort(cells, kind="stable")
+            unassigned = int((cells < 0).sum())
+            counts = np.bincount(cells[cells >= 0], minlength=len(centroids))
+            self.offsets = np.concatenate([[unassigned], unassigned + np.cumsum(counts)])
+
+
+class VectorIndex:
+
+    def __init__(self, directory=INDEX_DIR, dim=None, model_name=None, pca_version=None,
+                 nprobe=8, min_train_rows=10000, retrain_factor=4.0, check_interval=5.0):
+        self.directory = directory
+        self.nprobe = nprobe
+        self.min_train_rows = min_train_rows
+        self.retrain_factor = retrain_factor
+        self.check_interval = check_interval
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.ids_path = os.path.join(directory, "ids.txt")
+        self.lock_path = os.path.join(directory, "write.lock")
+        self.meta = {"rows": 0, "ids_bytes": 0, "dim": dim, "model_name": model_name, "pca_version": pca_version,
+                     "trained_rows": 0, "generation": 0, "cells_file": "cells.0.i32",
+                     "centroids_file": "centroids.0.npy"}
+        self._state = IndexState([], np.empty(0, np.int32), None, None)
+        self._meta_mtime = None
+        self._last_check = 0.0
+        self._write_lock = threading.RLock()
+        if os.path.exists(self.meta_path):
+            self._load()
+
+    @property
+    def dim(self):
+        return self.meta["dim"]
+
+    @property
+    def pca_version(self):
+        return self.meta["pca_version"]
+
+    @property
+    def model_name(self):
+        return self.meta["model_name"]
+
+    def __len__(self):
+        return len(self._state.ids)
+
+    def __contains__(self, id_):
+        return str(id_) in self._state.row_of
+
+    def _load(self):
+        try:
+            self._read()
+        except FileNotFoundError:
+            # A training run replaced and deleted the files this meta.json named; read the new one
+            self._read()
+
+    def _read(self):
+        self._meta_mtime = os.path.getmtime(self.meta_path)
+        with open(self.meta_path, "r") as f:
+            meta = json.load(f)
+        # Indexes written before training runs got their own file names
+        meta.setdefault("generation", 0)
+        meta.setdefault("cells_file", "cells.i32")
+        meta.setdefault("centroids_file", "centroids.npy")
+        rows, dim = meta["rows"], meta["dim"]
+        with open(self.ids_path, "r", encoding="utf-8") as f:
+            ids = f.read().splitlines()[:rows]
+        cells = np.fromfile(os.path.join(self.directory, meta["cells_file"]), dtype=np.int32, count=rows)
+        centroids = np.load(os.path.join(self.directory, meta["centroids_file"])) if meta["trained_rows"] else None
+        vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, dim)) if rows else None
+        self.meta = meta
+        self._state = IndexState(ids, cells, centroids, vectors)
+
+    def refresh(self):
+        """Pick up rows another process has added, checking at most every `check_interval` seconds"""
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+        if not os.path.exists(self.meta_path) or os.path.getmtime(self.meta_path) == self._meta_mtime:
+            return False
+        self._load()
+        return True
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Exclusive write access across threads and processes, with the latest committed state loaded"""
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.lock_path, "a") as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                try:
+                    # Another process may have committed rows since this instance last looked
+                    if os.path.exists(self.meta_path):
+                        self._load()
+                    yield
+                finally:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _write_meta(self):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def add(self, ids, vectors):
+        """Append vectors under the given ids, skipping ids already indexed; returns how many were added"""
+        ids = [str(id_) for id_ in ids]
+        vectors = normalize_rows(vectors)
+
+        with self._writing():
+            state = self._state
+            seen = set()
+            keep = []
+            for i, id_ in enumerate(ids):
+                if id_ not in state.row_of and id_ not in seen:
+                    seen.add(id_)
+                    keep.append(i)
+            if not keep:
+                return 0
+            ids = [ids[i] for i in keep]
+            vectors = np.ascontiguousarray(vectors[keep])
+
+            if self.meta["dim"] is None:
+                self.meta["dim"] = vectors.shape[1]
+            elif vectors.shape[1] != self.meta["dim"]:
+                raise ValueError(f"index holds {self.meta['dim']}-dim vectors, got {vectors.shape[1]}")
+            rows = self.meta["rows"]
+            if state.centroids is not None:
+                cells = (vectors @ state.centroids.T).argmax(axis=1).astype(np.int32)
+            else:
+                cells = np.full(len(ids), -1, dtype=np.int32)
+
+            # Drop anything past the last committed row (an interrupted write) before appending
+            ids_text = "".join(id_ + "\n" for id_ in ids).encode("utf-8")
+            for path, size, data in (
+                (self.vectors_path, rows * 4 * self.meta["dim"], vectors.tobytes()),
+                (os.path.join(self.directory, self.meta["cells_file"]), rows * 4, cells.tobytes()),
+                (self.ids_path, self.meta["ids_bytes"], ids_text),
+            ):
+                with open(path, "ab") as f:
+                    f.truncate(size)
+                    f.write(data)
+            self.meta["rows"] = rows + len(ids)
+            self.meta["ids_bytes"] += len(ids_text)
+            self._write_meta()
+            self._load()
+
+            trained_rows = self.meta["trained_rows"]
+            if (not trained_rows and len(self) >= self.min_train_rows) or \
+                    (trained_rows and len(self) >= self.retrain_factor * trained_rows):
+                # Already holding the write lock, which train() would take again
+                self._train()
+        return len(ids)
+
+    def train(self, n_lists=None, sample_size=100000, iterations=10, seed=0):
+        """(Re)fit the IVF centroids on a sample and reassign every row"""
+        with self._writing():
+            self._train(n_lists, sample_size, iterations, seed)
+
+    def _train(self, n_lists=None, sample_size=100000, iterations=10, seed=0):
+        state = self._state
+        n_rows = len(state.ids)
+        if n_rows == 0:
+            return
+        n_lists = n_lists or int(np.clip(4 * np.sqrt(n_rows), 1, 65536))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n_rows, min(sample_size, n_rows), replace=False))
+        centroids = spherical_kmeans(np.asarray(state.vectors[sample]), min(n_lists, len(sample)), iterations, seed)
+
+        cells = np.empty(n_rows, dtype=np.int32)
+        for start in range(0, n_rows, 100000):
+            block = np.asarray(state.vectors[start:start + 100000])
+            cells[start:start + len(block)] = (block @ centroids.T).argmax(axis=1)
+
+        # Written under new names, never over the live files; replacing meta.json is the commit
+        previous = {self.meta["cells_file"], self.meta["centroids_file"]}
+        generation = self.meta["generation"] + 1
+        self.meta.update(generation=generation, cells_file=f"cells.{generation}.i32",
+                         centroids_file=f"centroids.{generation}.npy")
+        np.save(os.path.join(self.directory, self.meta["centroids_file"]), centroids)
+        cells.tofile(os.path.join(self.directory, self.meta["cells_file"]))
+        self.meta["trained_rows"] = n_rows
+        self.meta["n_lists"] = len(centroids)
+        self._write_meta()
+        self._load()
+        # Readers may still be loading the previous files; anything older than those is unused
+        current = {self.meta["cells_file"], self.meta["centroids_file"]}
+        for name in os.listdir(self.directory):
+            if name.startswith(("cells.", "centroids.")) and name not in current | previous:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.directory, name))
+        print(f"Trained vector index: {n_rows} rows in {len(centroids)} cells")
+
+    def vectors_for(self, ids):
+        """(n, dim) unit vectors for ids and a mask of which ids were found (missing rows are zero)"""
+        state = self._state
+        rows = np.array([state.row_of.get(str(id_), -1) for id_ in ids], dtype=np.int64)
+        found = rows >= 0
+        out = np.zeros((len(rows), self.dim or 0), dtype=np.float32)
+        if found.any():
+            out[found] = state.vectors[rows[found]]
+        return out, found
+
+    def search(self, query, k=10, nprobe=None):
+        """[(id, cosine similarity)] of the k nearest rows, best first"""
+        state = self._state
+        if not state.ids:
+            return []
+        query = normalize_rows(query)[0]
+        if state.centroids is None:
+            candidates = None
+            scores = np.concatenate([
+                np.asarray(state.vectors[start:start + 100000]) @ query
+                for start in range(0, len(state.ids), 100000)
+            ])
+        else:
+            nprobe = min(nprobe or self.nprobe, len(state.centroids))
+            probe = np.argpartition(-(state.centroids @ query), nprobe - 1)[:nprobe]
+            # Unassigned rows (-1) sit at the front of `order` and are always scanned
+            parts = [state.order[:state.offsets[0]]]
+            parts += [state.order[state.offsets[c]:state.offsets[c + 1]] for c in probe]
+            candidates = np.sort(np.concatenate(parts))
+            if not len(candidates):
+                return []
+            scores = state.vectors[candidates] @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        rows = top if candidates is None else candidates[top]
+        return [(state.ids[row], float(scores[i])) for row, i in zip(rows, top)]
+
+
+def update_from_file(data_path, predictor, index_dir=INDEX_DIR, id_field=None, batch_size=4096):
+    """Embed and add every row of a crawl output whose id isn't in the index yet; returns the index"""
+    import market_io
+    from embedding_cache import pca_fingerprint
+
+    model = predictor.current()
+    artifacts = model.artifacts
+    pca_version = artifacts.get('pca_version') or pca_fingerprint(artifacts['pca'])
+    index = VectorIndex(index_dir, model_name=artifacts['sentence_model_name'], pca_version=pca_version)
+    if index.pca_version != pca_version or index.model_name != artifacts['sentence_model_name']:
+        raise ValueError(f"{index_dir} was built with a different sentence model/PCA, rebuild it with --rebuild")
+
+    added = 0
+    for batch in market_io.iter_row_batches(data_path, batch_size=batch_size):
+        field = id_field or ("id" if "id" in batch[0] else "full_ticker")
+        rows = [row for row in batch if row.get(field) is not None and row.get("title") and row[field] not in index]
+        if rows:
+            added += index.add([row[field] for row in rows], predictor.embed([row["title"] for row in rows], model))
+    print(f"Added {added} markets to {index_dir} ({len(index)} total)")
+    return index
+
+
+def main():
+    import shutil
+
+    import predict
+
+    parser = argparse.ArgumentParser(description="Build or extend the title vector index from crawled markets")
+    parser.add_argument("data", help="crawl output (.arrow, .ndjson, .json or .parquet)")
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    parser.add_argument("--id-field", help="row field used as the id (default: id if present, else full_ticker)")
+    parser.add_argument("--rebuild", action="store_true", help="start from an empty index")
+    parser.add_argument("--model", default=predict.MODEL_PATH)
+    parser.add_argument("--artifacts", default=predict.default_artifacts_path())
+    args = parser.parse_args()
+
+    if args.rebuild and os.path.isdir(args.index_dir):
+        shutil.rmtree(args.index_dir)
+    predictor = predict.Predictor(args.model, args.artifacts)
+    update_from_file(args.data, predictor, args.index_dir, id_field=args.id_field)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Poll the volume of every open market and keep its intraday trajectory.
+
+The crawl only ever sees final_volume of settled markets. This polls
+/markets?status=open every --interval seconds through crawler.py's pooled,
+rate-limited client, parses each page down to (ticker, volume) with
+data_collection.parse_volumes, and hands it to a SnapshotStore, which writes
+only the markets whose volume moved since the previous poll. Pages are
+processed as they arrive, so memory is one page plus the last volume of
+each open market, however many markets there are.
+
+    python volume_poller.py --store volume_snapshots --interval 60
+    python kalshi_stub.py --status open --markets 50000 --trades-per-second 200 &
+    python volume_poller.py --base-url http://127.0.0.1:8765/trade-api/v2 --polls 5
+
+A poll that fails part way is kept (what it saw is still true) but marked
+incomplete, and the next one starts on schedule.
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+import metrics
+from crawler import AsyncCrawler
+from data_collection import BASE_URL, parse_volumes
+from snapshot_store import DEFAULT_PARTITION_SECONDS, SnapshotStore
+
+DEFAULT_INTERVAL = 60.0
+
+
+async def poll_once(crawler, store, limit=1000, max_pages=1000):
+    """One pass over every open market into store; returns (markets, changed, complete)"""
+    store.begin_poll(time.time())
+    complete = True
+    try:
+        with metrics.timer("poll.sweep"):
+            async for (tickers, volumes), _ in crawler.pages({"status": "open", "limit": limit}, max_pages=max_pages,
+                                                              verbose=False, parse=parse_volumes):
+                store.record(tickers.tolist(), volumes.tolist())
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Poll stopped after {store.poll_markets} markets: {e}")
+        metrics.inc("poll.failed")
+        complete = False
+    markets = store.poll_markets
+    changed = store.end_poll(complete=complete)
+    metrics.inc("poll.markets", markets)
+    metrics.inc("poll.changed", changed)
+    return markets, changed, complete
+
+
+async def run_async(store, base_url=BASE_URL, interval=DEFAULT_INTERVAL, polls=None, limit=1000, **crawler_kwargs):
+    """Poll every `interval` seconds (back to back if a poll takes longer), `polls` times or forever"""
+    count = 0
+    async with AsyncCrawler(base_url, **crawler_kwargs) as crawler:
+        while polls is None or count < polls:
+            started = time.monotonic()
+            markets, changed, complete = await poll_once(crawler, store, limit=limit)
+            count += 1
+            seconds = time.monotonic() - started
+            print(f"Poll {count} ({store.partition}): {markets} open markets, {changed} changed, "
+                  f"{seconds:.1f}s ({markets / seconds:.0f}/s){'' if complete else ', incomplete'}")
+            if seconds > interval:
+                print(f"Poll took longer than the {interval:g}s interval")
+            elif polls is None or count < polls:
+                await asyncio.sleep(interval - seconds)
+    return count
+
+
+def run(store, base_url=BASE_URL, interval=DEFAULT_INTERVAL, polls=None, **kwargs):
+    """Blocking wrapper around run_async for scripts"""
+    return asyncio.run(run_async(store, base_url=base_url, interval=interval, polls=polls, **kwargs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record the volume of every open Kalshi market over time")
+    parser.add_argument("--store", default="volume_snapshots", help="snapshot_store.py directory")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="seconds between poll starts")
+    parser.add_argument("--polls", type=int, help="stop after this many polls (default: run until interrupted)")
+    parser.add_argument("--partition-hours", type=float, default=DEFAULT_PARTITION_SECONDS / 3600,
+                        help="length of a store partition, for a new store")
+    parser.add_argument("--base-url", default=BASE_URL, help="API root, e.g. a local kalshi_stub server")
+    parser.add_argument("--rate", type=float, default=10.0, help="max requests per second")
+    parser.add_argument("--concurrency", type=int, default=20, help="max open connections")
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.store, partition_seconds=int(args.partition_hours * 3600))
+    metrics.register_stats("snapshot_store", store.stats)
+    try:
+        run(store, base_url=args.base_url, interval=args.interval, polls=args.polls,
+            rate=args.rate, max_connections=args.concurrency)
+    except KeyboardInterrupt:
+        print("Stopped")
+    finally:
+        store.close()
+    print("\nPoll metrics:\n" + metrics.REGISTRY.summary())
+
+
+if __name__ == "__main__":
+    main()